@@ -0,0 +1,101 @@
+"""Time taken per DOM property access, for each class of node
+
+    python bench/access.py [pxdom-directory ...]
+
+For every Node class, times reading a property the class defines a getter
+for (nodeType), one inherited from Node (parentNode), and writing one with a
+setter (nodeValue, set to what it already is, which does nothing where it is
+always null). Nodes that are read-only have no write time. The cost of the
+loop itself is taken off, so the times are those of the access alone.
+"""
+
+import sys, os
+import common
+
+NUMBER= 100000
+
+DOCUMENT= '''<!DOCTYPE a [
+  <!ELEMENT a ANY>
+  <!ATTLIST a b CDATA #IMPLIED>
+  <!ENTITY e "x">
+  <!NOTATION n SYSTEM "n">
+]><a b="c">t<!--c--><?p d?><![CDATA[x]]>&e;</a>'''
+
+def getNodes(pxdom):
+    """Get an example of each class of node, by name
+    """
+    doc= pxdom.parseString(DOCUMENT, {'cdata-sections': True})
+    element= doc.documentElement
+    doctype= doc.doctype
+    nodes= {
+        'Document': doc, 'DocumentType': doctype, 'Element': element,
+        'Attr': element.getAttributeNode('b'), 'Text': element.childNodes[0],
+        'Comment': element.childNodes[1],
+        'ProcessingInstruction': element.childNodes[2],
+        'CDATASection': element.childNodes[3],
+        'EntityReference': element.childNodes[4],
+        'DocumentFragment': doc.createDocumentFragment(),
+        'Entity': doctype.entities.item(0),
+        'Notation': doctype.notations.item(0)
+    }
+    for name, mapName in (
+        ('ElementDeclaration', 'pxdomElements'),
+        ('AttributeListDeclaration', 'pxdomAttlists')
+    ):
+        try:
+            nodes[name]= getattr(doctype, mapName).item(0)
+        except AttributeError:
+            pass
+    if nodes.has_key('AttributeListDeclaration'):
+        nodes['AttributeDeclaration']= (
+            nodes['AttributeListDeclaration'].declarations.item(0)
+        )
+    return nodes
+
+def getTimes(pxdom):
+    """Time the accesses on each node, in nanoseconds, by class name
+    """
+    times= {}
+    nodes= getNodes(pxdom)
+    for name, node in nodes.items():
+        loop= common.best(lambda node= node: node, NUMBER)
+        read= common.best(lambda node= node: node.nodeType, NUMBER)
+        inherited= common.best(lambda node= node: node.parentNode, NUMBER)
+        value= node.nodeValue
+        setter= lambda node= node, value= value: setattr(
+            node, 'nodeValue', value
+        )
+        try:
+            setter()
+        except pxdom.DOMException:
+            write= None
+        else:
+            write= (common.best(setter, NUMBER)-loop)*1e9
+        times[name]= ((read-loop)*1e9, (inherited-loop)*1e9, write)
+    return times
+
+def main(args):
+    paths= common.getPaths(args)
+    results= map(lambda path: getTimes(common.load(path)), paths)
+    names= results[-1].keys()
+    names.sort()
+    print 'ns per access (nodeType read, parentNode read, write)'
+    print '%-26s' % '' + ''.join(
+        map(lambda path: '%21s' % os.path.basename(path)[:20], paths)
+    )
+    for name in names:
+        row= '%-26s' % name
+        for times in results:
+            if times.has_key(name):
+                read, inherited, write= times[name]
+                row= row+'%9.0f%6.0f' % (read, inherited)
+                if write is None:
+                    row= row+'%6s' % '-'
+                else:
+                    row= row+'%6.0f' % write
+            else:
+                row= row+'%21s' % '-'
+        print row
+
+if __name__=='__main__':
+    main(sys.argv[1:])
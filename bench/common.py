@@ -0,0 +1,38 @@
+"""Shared helpers for the pxdom benchmark scripts
+
+Each script takes the directories of any number of pxdom.py copies on the
+command line, so that one can be compared with another, eg. a checkout of an
+older revision against the working copy. With no arguments, the pxdom.py
+next to this directory is used.
+"""
+
+import sys, os, imp, time
+
+HERE= os.path.dirname(os.path.abspath(__file__))
+
+def getPaths(args):
+    """Get the pxdom directories to run against from the command-line
+    """
+    if len(args)==0:
+        return [os.path.dirname(HERE)]
+    return map(os.path.abspath, args)
+
+def load(path):
+    """Import the pxdom.py in a directory under a name of its own
+    """
+    name= 'pxdom_%d' % abs(hash(path))
+    if sys.modules.has_key(name):
+        return sys.modules[name]
+    return imp.load_source(name, os.path.join(path, 'pxdom.py'))
+
+def best(function, number, repeat= 3):
+    """Time the fastest of several runs of a function called number times,
+    in seconds per call
+    """
+    times= []
+    for i in range(repeat):
+        start= time.time()
+        for j in xrange(number):
+            function()
+        times.append(time.time()-start)
+    return min(times)/number
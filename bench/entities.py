@@ -0,0 +1,69 @@
+"""Parse time for text dense with entity and character references
+
+    python bench/entities.py [pxdom-directory ...]
+
+Each document is parsed at two sizes, the larger with four times as many
+references. Parsing in linear time takes about four times as long for the
+larger; text built up by copying the whole of it for each reference takes
+about sixteen times as long. Both settings of the 'entities' parameter are
+tried, as references are either kept as nodes or replaced by their text.
+"""
+
+import sys, os, time
+import common
+
+SIZES= (5000, 20000)
+
+def _amp(n):
+    return '<p>'+'&amp;'*n+'</p>'
+def _charref(n):
+    return '<p>'+'a&#233;&#x20AC;'*n+'</p>'
+def _internal(n):
+    return '<!DOCTYPE p [<!ENTITY e "x&#233;y">]><p>'+'&e;'*n+'</p>'
+def _attribute(n):
+    return '<p a="'+'&lt;&#65;'*n+'"/>'
+def _declaration(n):
+    return '<!DOCTYPE p [<!ENTITY e "'+'&#65;&#x42;'*n+'">]><p/>'
+
+DOCUMENTS= [
+    ('built-in entities', _amp),
+    ('character references', _charref),
+    ('internal entities', _internal),
+    ('attribute value', _attribute),
+    ('entity declaration', _declaration)
+]
+
+def parseTime(pxdom, data, entities):
+    """Time the fastest of three parses of a document, in seconds
+    """
+    times= []
+    for i in range(3):
+        parser= pxdom.LSParser()
+        parser.domConfig.setParameter('entities', entities)
+        input= pxdom.LSInput()
+        input.stringData= data
+        start= time.time()
+        parser.parse(input)
+        times.append(time.time()-start)
+    return min(times)
+
+def main(args):
+    paths= common.getPaths(args)
+    print 'seconds to parse, at %d and %d references' % SIZES
+    print '%-40s' % '' + ''.join(
+        map(lambda path: '%24s' % os.path.basename(path)[:23], paths)
+    )
+    for label, make in DOCUMENTS:
+        for entities in (True, False):
+            row= '%-40s' % ('%s, entities=%s' % (label, entities))
+            for path in paths:
+                pxdom= common.load(path)
+                small, large= map(lambda n, pxdom= pxdom, make= make,
+                    entities= entities: parseTime(pxdom, make(n), entities),
+                    SIZES
+                )
+                row= row+'%9.3f%9.3f%5.1fx' % (small, large, large/small)
+            print row
+
+if __name__=='__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,88 @@
+"""Memory used per node, for each type of node
+
+    python bench/memory.py [pxdom-directory ...]
+
+Each count is made in a process of its own, which builds a large number of
+nodes of one type and measures how much its resident memory grew. This takes
+in everything a node carries, including containers made for it and the
+space its parent's list of children takes for it, which sizes of single
+objects would miss. Needs a /proc filesystem, as on Linux.
+"""
+
+import sys, os, gc
+import common
+
+COUNT= 50000
+
+def _element(doc, parent):
+    return parent.appendChild(doc.createElement('e'))
+def _attributedElement(doc, parent):
+    element= parent.appendChild(doc.createElement('e'))
+    element.setAttribute('a', 'v')
+    return element
+def _text(doc, parent):
+    return parent.appendChild(doc.createTextNode('t'))
+def _cdata(doc, parent):
+    return parent.appendChild(doc.createCDATASection('t'))
+def _comment(doc, parent):
+    return parent.appendChild(doc.createComment('c'))
+def _pi(doc, parent):
+    return parent.appendChild(doc.createProcessingInstruction('p', 'd'))
+def _entityReference(doc, parent):
+    return parent.appendChild(doc.createEntityReference('amp'))
+def _attr(doc, parent):
+    attr= doc.createAttribute('a')
+    attr.value= 'v'
+    return attr
+
+TYPES= [
+    ('Element', _element),
+    ('Element+Attr', _attributedElement),
+    ('Text', _text),
+    ('CDATASection', _cdata),
+    ('Comment', _comment),
+    ('ProcessingInstruction', _pi),
+    ('EntityReference', _entityReference),
+    ('Attr', _attr)
+]
+
+def resident():
+    """Get the resident memory of this process, in bytes
+    """
+    pages= int(open('/proc/self/statm').read().split()[1])
+    return pages*os.sysconf('SC_PAGE_SIZE')
+
+def measure(path, label):
+    """Count the bytes per node of one type, in this process
+    """
+    pxdom= common.load(path)
+    make= dict(TYPES)[label]
+    doc= pxdom.parseString('<root/>')
+    parent= doc.documentElement
+    nodes= []
+    gc.collect()
+    before= resident()
+    for i in xrange(COUNT):
+        nodes.append(make(doc, parent))
+    gc.collect()
+    return float(resident()-before)/COUNT-8 # less the list of nodes
+
+def main(args):
+    if len(args)==3 and args[0]=='--one':
+        print measure(args[1], args[2])
+        return
+    paths= common.getPaths(args)
+    print '%-22s' % 'bytes per node' + ''.join(
+        map(lambda path: '%12s' % os.path.basename(path)[:11], paths)
+    )
+    for label, make in TYPES:
+        row= '%-22s' % label
+        for path in paths:
+            output= os.popen('"%s" "%s" --one "%s" "%s"' % (
+                sys.executable, os.path.abspath(__file__), path, label
+            )).read()
+            row= row+'%12.0f' % float(output)
+        print row
+
+if __name__=='__main__':
+    main(sys.argv[1:])
@@ -7,13 +7,14 @@ Includes pure-Python non-validating parser.
 __version__= 1,6
 __author__= 'Andrew Clover <and@doxdesk.com>'
 __date__= 2010,12,30
-__all__= ['getDOMImplementation', 'getDOMImplementations', 'parse', 'parseString', 'DOMException']
+__all__= ['getDOMImplementation', 'getDOMImplementations', 'parse', 'parseString', 'iterparse', 'parseMany', 'DTDCache', 'ParserPool', 'DOMException']
 
 
 # Setup, utility functions
 # ============================================================================
 
-import os, sys, string, StringIO, urlparse, urllib, httplib
+import os, sys, string, re, time, copy, StringIO, urlparse, urllib, httplib
+import marshal, tempfile
 r= string.replace
 
 def _insertMethods():
@@ -30,6 +31,14 @@ def _insertMethods():
             class_, method= string.split(key[1:], '__', 1)
             setattr(globals()[class_], method, value)
 
+    # Accessor methods may have just been added to the classes, so the
+    # properties generated when they were created are now out of date
+    #
+    if property is not None:
+        for value in globals().values():
+            if isinstance(value, _DOMType):
+                _makeProperties(value)
+
 
 # Backwards-compatibility boolean type (<2.2.1)
 #
@@ -38,6 +47,14 @@ try:
 except NameError:
     globals()['True'], globals()['False']= None is None, None is not None
 
+# Iterator protocol (2.2+). Before then, iterators can only be looped over
+# through __getitem__, which ends with an IndexError
+#
+try:
+    StopIteration
+except NameError:
+    StopIteration= IndexError
+
 # Use sets where available for low-level character matching
 #
 try:
@@ -49,6 +66,14 @@ except NameError:
     except ImportError:
         frozenset= lambda x: x
 
+# Use new-style classes where available (2.2+), so that DOM properties can be
+# real descriptors instead of being looked up through __getattr__
+#
+try:
+    property, object
+except NameError:
+    property= None
+
 # Check unicode is supported (Python 1.6+), provide dummy class to use with
 # isinstance
 #
@@ -61,6 +86,27 @@ else:
     Unicode= type(unicode(''))
     import unicodedata, codecs
 
+# Incremental decoders (2.5+) allow input to be decoded a chunk at a time
+#
+INCREMENTAL= unicode is not None and hasattr(codecs, 'getincrementaldecoder')
+
+# Binary search on sorted lists, with the left/right variants only from 2.1
+#
+try:
+    from bisect import bisect_left, bisect_right
+except ImportError:
+    from bisect import bisect
+    bisect_right= bisect
+    def bisect_left(a, x):
+        lo, hi= 0, len(a)
+        while lo<hi:
+            mid= (lo+hi)/2
+            if a[mid]<x:
+                lo= mid+1
+            else:
+                hi= mid
+        return lo
+
 # Allow thread-specific storage when threading is available
 #
 try:
@@ -68,12 +114,59 @@ try:
 except ImportError:
     get_ident= lambda: None
 
+# Asynchronous LSParsers run on a thread of their own, so are only available
+# when threading is
+#
+try:
+    import threading
+except ImportError:
+    threading= None
+
+# Locks for objects that may be shared between threads, doing nothing when
+# there can only be the one thread
+#
+if threading is not None:
+    _Lock= threading.Lock
+else:
+    class _Lock:
+        def acquire(self):
+            pass
+        def release(self):
+            pass
+
+# Weak references, so that a document's mutation log doesn't keep nodes that
+# have left it alive. Without them, the log holds nodes until it rotates
+#
+try:
+    import weakref
+    _weakRef= weakref.ref
+except ImportError:
+    _weakRef= lambda obj: lambda obj= obj: obj
+
+# Batch parsing spreads documents over worker processes where multiprocessing
+# is available, and parses them one at a time in this process where not
+#
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing= None
+
+# Pickling, for DTDCaches kept on disk and results passed back from worker
+# processes. Objects with slots can only be pickled with the binary protocol
+# of 2.3 and later.
+#
+try:
+    import cPickle
+    pickle= cPickle
+except ImportError:
+    import pickle
+PICKLE_PROTOCOL= getattr(pickle, 'HIGHEST_PROTOCOL', 1)
+
 # XML character classes. Provide only an XML 1.1 character model for NAMEs, as
 # 1.0's rules are insanely complex.
 #
 DEC= frozenset('0123456789')
 HEX= frozenset('0123456789abcdefABDCDEF')
-LS= ('\r\n', '\r')
 WHITE= ' \t\n\r'
 
 NOTCHAR= frozenset('\x00\x01\x02\x03\x04\x05\x06\x07\x08\x0B\x0C\x0E\x0F\x10\x11\x12\x13\x14\x15\x16\x17\x18\x19\x7F')
@@ -96,6 +189,38 @@ if unicode is not None:
         (0x2041,0x2070), (0x2190,0x2C00), (0x2FF0,0x3001), (0xE000,0xF900), (0xFDD0,0xFDF0), (0xFFFE, 0x10000)
     )
 
+# Compiled patterns for runs of the above classes, for scanning. Each is a
+# pair, to use on narrow and on Unicode strings respectively, as the extra
+# Unicode classes do not apply to characters in narrow strings.
+#
+def _charClass(chars, ranges= ()):
+    """ Make the inside of a regular expression character class, from a
+        sequence of characters and some (start, end) ranges of code points.
+    """
+    parts= map(re.escape, list(chars))
+    for c0, c1 in ranges:
+        parts.append(re.escape(unichr(c0))+'-'+re.escape(unichr(c1-1)))
+    return string.join(parts, '')
+
+DECS= re.compile('[0-9]*'), re.compile('[0-9]*')
+HEXES= re.compile('[0-9a-fA-F]*'), re.compile('[0-9a-fA-F]*')
+WHITES= re.compile('[%s]*' % _charClass(WHITE)), None
+NAMES= re.compile('[^%s]*' % _charClass(list(NOTNAME)+list(NOTCHAR))), None
+NOTCHARS= re.compile('[%s]' % _charClass(NOTCHAR)), None
+SPECIALS= re.compile('[\r%s]' % _charClass(NOTCHAR)), None
+if unicode is not None:
+    WHITES= WHITES[0], re.compile(unicode('[%s]*') % _charClass(WHITE+WHITEU))
+    NAMES= NAMES[0], re.compile(unicode('[^%s]*') % _charClass(
+        list(NOTNAME)+list(NOTCHAR)+list(NOTCHARU), NOTNAMEU
+    ))
+    NOTFIRSTRE= re.compile(unicode('[%s]') % _charClass(NOTFIRST, NOTFIRSTU))
+    NOTCHARS= NOTCHARS[0], re.compile(unicode('[%s]') % _charClass(
+        list(NOTCHAR)+list(NOTCHARU)
+    ))
+    SPECIALS= SPECIALS[0], re.compile(unicode('[\r%s]') % _charClass(
+        list(LSU)+list(NOTCHAR)+list(NOTCHARU)
+    ))
+
 # Unicode character normalisation (>=2.3). Also includes a kludge for
 # composing-characters that we can't check through unicodedata, see
 # 'Character Model for the World Wide Web', Appendix C
@@ -137,6 +262,15 @@ class _NONS:
         return '(non-namespace)'
 NONS= _NONS()
 
+# Shared empty child sequence for nodes that have never had children, so that
+# leaf nodes don't each need a list of their own
+#
+NOCHILDREN= ()
+
+# A parsed node's line and column are stored as line*LOCATION_COLUMNS+column
+#
+LOCATION_COLUMNS= 2**32
+
 # Media types to allow in addition to anything labelled '...+xml' when using
 # parameter supported-media-types-only
 #
@@ -159,21 +293,12 @@ def _checkName(name, nc= False):
     """
     if name=='':
         raise InvalidCharacterErr(name, '')
-    if name[0] in NOTFIRST:
+    isU= isinstance(name, Unicode)
+    if name[0] in NOTFIRST or isU and NOTFIRSTRE.match(name):
         raise InvalidCharacterErr(name, name[0])
-    if isinstance(name, Unicode):
-        for c0, c1 in NOTFIRSTU:
-            if ord(name[0])>=c0 and ord(name[0])<c1:
-                raise InvalidCharacterErr(name, char)
-    for char in name:
-        if char in NOTNAME or char in NOTCHAR:
-            raise InvalidCharacterErr(name, char)
-        if isinstance(char, Unicode):
-            if char in NOTCHARU:
-                raise InvalidCharacterErr(name, char)
-            for c0, c1 in NOTNAMEU:
-                if ord(char)>=c0 and ord(char)<c1:
-                    raise InvalidCharacterErr(name, char)
+    index= NAMES[isU].match(name).end()
+    if index<len(name):
+        raise InvalidCharacterErr(name, name[index])
     if nc and ':' in name:
         raise NamespaceErr(name, None)
 
@@ -207,14 +332,77 @@ def _encodeURI(s):
     return uri
 
 
-class DOMObject:
+# When an object is readonly, there are a few attributes that can be set
+# regardless. Readonly is one (obviously), but due to a wart in the DOM spec it
+# must also be possible to set nodeValue and textContent to anything on nodes
+# where these properties are defined to be null (with no effect). Check
+# specifically for these property names as a nasty hack to conform exactly to
+# the spec.
+#
+READONLY_EXEMPT= ('readonly', 'nodeValue', 'textContent')
+
+if property is not None:
+    class _DOMProperty(property):
+        """Descriptor generated from a class's _get_ and _set_ methods"""
+        pass
+
+    def _getMember(cls, name):
+        """Find a member in a class or its bases without binding it"""
+        for base in cls.__mro__:
+            if base.__dict__.has_key(name):
+                return base.__dict__[name]
+        return None
+
+    def _makeSetter(key, setter):
+        if setter is None:
+            def set(self, value, key= key):
+                raise NoModificationAllowedErr(self, key)
+        elif key in READONLY_EXEMPT:
+            set= setter
+        else:
+            def set(self, value, key= key, setter= setter):
+                if self._readonly:
+                    raise NoModificationAllowedErr(self, key)
+                setter(self, value)
+        return set
+
+    def _makeProperties(cls):
+        """Generate a descriptor for each _get_ method in a DOMObject class
+
+        An ordinary attribute of the same name anywhere in the class's
+        ancestry would have hidden the getter from __getattr__, so leave
+        those alone.
+        """
+        for name in dir(cls):
+            if name[:5]=='_get_':
+                key= name[5:]
+                member= _getMember(cls, key)
+                if member is None or isinstance(member, _DOMProperty):
+                    setattr(cls, key, _DOMProperty(_getMember(cls, name),
+                        _makeSetter(key, _getMember(cls, '_set_'+key))
+                    ))
+
+    class _DOMType(type):
+        """Metaclass for DOMObjects, so that subclasses get properties too"""
+        def __init__(cls, name, bases, members):
+            type.__init__(cls, name, bases, members)
+            _makeProperties(cls)
+
+    _DOMBase= _DOMType('_DOMBase', (object,), {'__slots__': ()})
+else:
+    class _DOMBase: pass
+
+
+class DOMObject(_DOMBase):
     """Base class for objects implementing DOM interfaces
 
-    Provide properties in a way compatible with old versions of Python:
-    subclass should provide method _get_propertyName to make a read-only
+    Subclass should provide method _get_propertyName to make a read-only
     property, and also _set_propertyName for a writable. If the readonly
-    property is set, all other properties become immutable.
+    property is set, all other properties become immutable. Where Python
+    supports descriptors these are used to implement the properties; on
+    older versions they are looked up on each access by __getattr__.
     """
+    __slots__= ('_readonly',)
     def __init__(self, readonly= False):
         self._readonly= readonly
     def _get_readonly(self):
@@ -231,27 +419,20 @@ class DOMObject:
             raise AttributeError, key
         return getter()
 
-    def __setattr__(self, key, value):
-        if key[:1]=='_':
-            self.__dict__[key]= value
-            return
-
-        # When an object is readonly, there are a few attributes that can be set
-        # regardless. Readonly is one (obviously), but due to a wart in the DOM
-        # spec it must also be possible to set nodeValue and textContent to
-        # anything on nodes where these properties are defined to be null (with no
-        # effect). Check specifically for these property names as a nasty hack
-        # to conform exactly to the spec.
-        #
-        if self._readonly and key not in ('readonly', 'nodeValue', 'textContent'):
-            raise NoModificationAllowedErr(self, key)
-        try:
-            setter= getattr(self, '_set_'+key)
-        except AttributeError:
-            if hasattr(self, '_get_'+key):
+    if property is None:
+        def __setattr__(self, key, value):
+            if key[:1]=='_':
+                self.__dict__[key]= value
+                return
+            if self._readonly and key not in READONLY_EXEMPT:
                 raise NoModificationAllowedErr(self, key)
-            raise AttributeError, key
-        setter(value)
+            try:
+                setter= getattr(self, '_set_'+key)
+            except AttributeError:
+                if hasattr(self, '_get_'+key):
+                    raise NoModificationAllowedErr(self, key)
+                raise AttributeError, key
+            setter(value)
 
 
 # Node-structure classes
@@ -260,6 +441,7 @@ class DOMObject:
 class DOMList(DOMObject):
     """Sequence that responds to Python and DOM-style access
     """
+    __slots__= ('_list',)
     def __init__(self, initial= None):
         DOMObject.__init__(self)
         if initial is None:
@@ -318,6 +500,7 @@ class DOMList(DOMObject):
 class NodeList(DOMList):
     """Abstract list of nodes dependent on an owner node.
     """
+    __slots__= ('_ownerNode',)
     def __init__(self, ownerNode= None):
         DOMList.__init__(self)
         self._ownerNode= ownerNode
@@ -329,7 +512,18 @@ class ChildNodeList(NodeList):
     Python-style alterations to the list result in calls to the parent's
     corresponding DOM methods. This seems to be required by a literal reading of
     the Python DOM bindings spec, but tends not to be relied on in practice.
+
+    The list shares its storage with the parent's internal list of children,
+    which is allocated now if the parent has never had any.
     """
+    __slots__= ()
+    def __init__(self, ownerNode):
+        NodeList.__init__(self, ownerNode)
+        if ownerNode._children is NOCHILDREN:
+            ownerNode._children= []
+        self._list= ownerNode._children
+        self._readonly= True
+
     def __setitem__(self, index, value):
         self._ownerNode.replaceChild(value, self._list[index])
 
@@ -340,30 +534,52 @@ class ChildNodeList(NodeList):
 class NodeListByTagName(NodeList):
     """Live NodeList returned by Element.getElementsByTagName[NS] methods
 
-    As a 'live' list, the internal _list acts only as a cache, and is
-    recalculated if the owner Element's contents have changed since it was
-    last built.
+    As a 'live' list, the internal _list acts only as a cache. When the owner
+    is in its document's tree the list is taken from the document's tag
+    index, and only recalculated when that index has changed; otherwise it is
+    recalculated by walking the owner if the document's mutation log says the
+    owner's contents have changed since it was last built. The mutation count
+    is kept with the document it came from, as the owner may be adopted into
+    another.
     """
     def __init__(self, ownerNode, namespaceURI, localName):
         NodeList.__init__(self, ownerNode)
         self._namespaceURI= namespaceURI
         self._localName= localName
         self._sequence= None
+        self._index= None
+
+    def _isStale(self):
+        if self._index is not None:
+            return (
+                self._sequence!=self._index._version or
+                self._index is not self._ownerNode._ownerDocument._tagIndex
+            )
+        document= self._ownerNode._ownerDocument
+        if self._sequence is None:
+            return True
+        built, mutations= self._sequence
+        if built is not document:
+            return True
+        if document._changedSince(self._ownerNode, mutations):
+            return True
+        self._sequence= document, document._mutations
+        return False
 
     def _get_length(self):
-        if self._sequence!=self._ownerNode._sequence: self._calculate()
+        if self._isStale(): self._calculate()
         return NodeList._get_length(self)
 
     def item(self, index):
-        if self._sequence!=self._ownerNode._sequence: self._calculate()
+        if self._isStale(): self._calculate()
         return NodeList.item(self, index)
 
     def __getitem__(self, index):
-        if self._sequence!=self._ownerNode._sequence: self._calculate()
+        if self._isStale(): self._calculate()
         return NodeList.__getitem__(self, index)
 
     def __len__(self):
-        if self._sequence!=self._ownerNode._sequence: self._calculate()
+        if self._isStale(): self._calculate()
         return NodeList.__len__(self)
 
     def __repr__(self):
@@ -378,14 +594,24 @@ class NodeListByTagName(NodeList):
 
         This method does the actual work of the getElementsByTagName call
         """
-        self._list= []
-        self._walk(self._ownerNode)
-        self._sequence= self._ownerNode._sequence
+        self._index= self._ownerNode._ownerDocument._getTagIndex(
+            self._ownerNode
+        )
+        if self._index is not None:
+            self._list= self._index._select(
+                self._ownerNode, self._namespaceURI, self._localName
+            )
+            self._sequence= self._index._version
+        else:
+            self._list= []
+            self._walk(self._ownerNode)
+            document= self._ownerNode._ownerDocument
+            self._sequence= document, document._mutations
 
     def _walk(self, element):
         """Recurse through child elements looking for matches
         """
-        for childNode in element.childNodes:
+        for childNode in element._children:
             if childNode.nodeType==Node.ELEMENT_NODE:
                 if (
                     self._localName=='*' and
@@ -405,19 +631,272 @@ class NodeListByTagName(NodeList):
                 self._walk(childNode)
 
 
+class _TagIndex:
+    """Document-wide index of Elements by name, in document order
+
+    Every Element in the document tree is filed under each of the keys that
+    getElementsByTagName[NS] can select it by: ('*', '*'), (namespaceURI,
+    '*'), ('*', localName), (NONS, nodeName) and (namespaceURI, localName).
+    Each Element is also given an integer position, spaced out so that most
+    insertions fit between existing positions without renumbering. Since
+    the Elements of any subtree then have a contiguous range of positions,
+    the matches inside one owner can be found by bisection.
+
+    The index is created the first time a live list is read for a node in
+    the tree, and is kept up to date by the document as Elements are
+    inserted, removed or renamed. Any such change increments its version.
+    """
+    GAP= 1024
+
+    def __init__(self, document):
+        self._document= document
+        self._version= 0
+        self._build()
+
+    def _build(self):
+        """(Re)number and file every Element in the document tree
+        """
+        self._positions= {}
+        self._buckets= {}
+        elements= []
+        self._collect(self._document, elements)
+        position= 0
+        for element in elements:
+            position= position+self.GAP
+            self._file(element, position)
+        self._version= self._version+1
+
+    def _keys(self, element):
+        namespaceURI= element.namespaceURI
+        localName= element.localName
+        keys= []
+        seen= {}
+        for key in (
+            ('*', '*'), (namespaceURI, '*'), ('*', localName),
+            (NONS, element.nodeName), (namespaceURI, localName)
+        ):
+            if not seen.has_key(key):
+                seen[key]= True
+                keys.append(key)
+        return keys
+
+    def _file(self, element, position):
+        keys= self._keys(element)
+        self._positions[element]= (position, keys)
+        for key in keys:
+            if not self._buckets.has_key(key):
+                self._buckets[key]= ([], [])
+            positions, elements= self._buckets[key]
+            index= bisect_right(positions, position)
+            positions.insert(index, position)
+            elements.insert(index, element)
+
+    def _unfile(self, element):
+        position, keys= self._positions[element]
+        del self._positions[element]
+        for key in keys:
+            positions, elements= self._buckets[key]
+            index= bisect_left(positions, position)
+            del positions[index]
+            del elements[index]
+            if len(positions)==0:
+                del self._buckets[key]
+
+    # Tree walking. Elements are found in the same places NodeListByTagName
+    # walks: inside Elements and EntityReferences, but not Attrs. The walks
+    # keep their own stacks, so that deep trees don't exhaust Python's.
+    #
+    def _collect(self, node, elements):
+        """Add the Elements in a subtree to a list in document order
+        """
+        stack= [node]
+        while len(stack)>0:
+            node= stack.pop()
+            if node.nodeType==Node.ELEMENT_NODE:
+                elements.append(node)
+            children= node._children
+            for index in range(len(children)-1, -1, -1):
+                if children[index].nodeType in (
+                    Node.ELEMENT_NODE, Node.ENTITY_REFERENCE_NODE
+                ):
+                    stack.append(children[index])
+
+    def _last(self, node):
+        """Get the last Element in document order in a subtree, or None.
+        Each node is looked at after its descendants, last child first.
+        """
+        stack= [(node, False)]
+        while len(stack)>0:
+            node, done= stack.pop()
+            if done:
+                if node.nodeType==Node.ELEMENT_NODE:
+                    return node
+                continue
+            stack.append((node, True))
+            for child in node._children:
+                if child.nodeType in (
+                    Node.ELEMENT_NODE, Node.ENTITY_REFERENCE_NODE
+                ):
+                    stack.append((child, False))
+        return None
+
+    def _preceding(self, node):
+        """Get the Element nearest before a node in document order, or None
+        """
+        while node is not self._document:
+            sibling= node._previousSibling
+            while sibling is not None:
+                if sibling.nodeType in (
+                    Node.ELEMENT_NODE, Node.ENTITY_REFERENCE_NODE
+                ):
+                    last= self._last(sibling)
+                    if last is not None:
+                        return last
+                sibling= sibling._previousSibling
+            node= node._containerNode
+            if node.nodeType==Node.ELEMENT_NODE:
+                return node
+        return None
+
+    def _contains(self, node):
+        """Check whether a node is in the document tree (and so indexed). Only
+        the nodes up to the nearest Element need be walked, as an Element is
+        in the tree exactly when it has a position.
+        """
+        while node is not None:
+            if node is self._document:
+                return True
+            if node.nodeType==Node.ELEMENT_NODE:
+                return self._positions.has_key(node)
+            if node.nodeType==Node.ATTRIBUTE_NODE:
+                return False
+            node= node._containerNode
+        return False
+
+    # Updates
+    #
+    def _add(self, nodes):
+        """File the Elements in a run of adjacent nodes just put in the tree,
+        numbering them between their neighbours if there is room.
+        """
+        elements= []
+        for node in nodes:
+            if node.nodeType in (
+                Node.ELEMENT_NODE, Node.ENTITY_REFERENCE_NODE
+            ):
+                self._collect(node, elements)
+        if len(elements)==0:
+            return
+        low= 0
+        preceding= self._preceding(nodes[0])
+        if preceding is not None:
+            low= self._positions[preceding][0]
+        step= self.GAP
+        if self._buckets.has_key(('*', '*')):
+            positions= self._buckets[('*', '*')][0]
+            index= bisect_right(positions, low)
+            if index<len(positions):
+                step= (positions[index]-low)/(len(elements)+1)
+        if step<1:
+            self._build()
+            return
+
+        # The new positions are all between the same two neighbours, so each
+        # bucket gets its new Elements as one run, spliced in at one place.
+        #
+        runs= {}
+        for element in elements:
+            low= low+step
+            keys= self._keys(element)
+            self._positions[element]= (low, keys)
+            for key in keys:
+                if not runs.has_key(key):
+                    runs[key]= ([], [])
+                runs[key][0].append(low)
+                runs[key][1].append(element)
+        for key, (runPositions, runElements) in runs.items():
+            if not self._buckets.has_key(key):
+                self._buckets[key]= ([], [])
+            positions, bucketElements= self._buckets[key]
+            index= bisect_right(positions, runPositions[0])
+            positions[index:index]= runPositions
+            bucketElements[index:index]= runElements
+        self._version= self._version+1
+
+    def _remove(self, node):
+        """Unfile the Elements in a subtree just taken out of the tree
+        """
+        if node.nodeType not in (
+            Node.ELEMENT_NODE, Node.ENTITY_REFERENCE_NODE
+        ):
+            return
+        elements= []
+        self._collect(node, elements)
+        if len(elements)==0:
+            return
+        for element in elements:
+            self._unfile(element)
+        self._version= self._version+1
+
+    def _refile(self, element):
+        """Move an Element to the keys of its new name, if it is indexed
+        """
+        if self._positions.has_key(element):
+            position= self._positions[element][0]
+            self._unfile(element)
+            self._file(element, position)
+            self._version= self._version+1
+
+    # Lookup
+    #
+    def _select(self, owner, namespaceURI, localName):
+        """Get a list of the matching Elements inside an owner in the tree
+        """
+        if localName=='*' and namespaceURI in ('*', NONS):
+            key= ('*', '*')
+        else:
+            key= (namespaceURI, localName)
+        if not self._buckets.has_key(key):
+            return []
+        positions, elements= self._buckets[key]
+        if owner is self._document:
+            return elements[:]
+        low= bisect_right(positions, self._positions[owner][0])
+        high= bisect_right(positions, self._positions[self._last(owner)][0])
+        return elements[low:high]
+
+
 class NamedNodeMap(NodeList):
     """Abstract dictionary-style object used for mappings
 
     Subclass should initialise with the nodeType for nodes it is intending to
     hold as values.
+
+    Once a map holds more than INDEX_MIN items it keeps a dictionary index
+    from each item's nodeName and (namespaceURI, localName) to the items with
+    that name, in list order, so that lookups needn't scan the list. Items
+    renamed in place must be passed to _refile to keep the index in step.
     """
+    __slots__= ('_childTypes', '_index', '_keys')
+    INDEX_MIN= 8
+
     def __init__(self, ownerNode, childType):
         NodeList.__init__(self, ownerNode)
         self._childTypes= (childType,)
+        self._index= None
+        self._keys= None
 
     def getNamedItemNS(self, namespaceURI, localName):
         if namespaceURI=='':
             namespaceURI= None
+        if self._index is not None:
+            if namespaceURI is NONS:
+                nodes= self._index.get(localName)
+            else:
+                nodes= self._index.get((namespaceURI, localName))
+            if nodes:
+                return nodes[0]
+            return None
         for node in self._list:
             if (
                 (namespaceURI is NONS and localName==node.nodeName) or
@@ -476,6 +955,59 @@ class NamedNodeMap(NodeList):
             self._list[index:index+1]= [newItem]
         else:
             self._list[index:index+1]= []
+        if self._index is not None:
+            if oldItem is not None:
+                self._unfile(oldItem)
+            if newItem is not None:
+                self._file(newItem)
+        elif len(self._list)>self.INDEX_MIN:
+            self._rehash()
+
+    def _append(self, value):
+        NodeList._append(self, value)
+        if self._index is not None:
+            self._file(value)
+        elif len(self._list)>self.INDEX_MIN:
+            self._rehash()
+
+    # Name index maintenance
+    #
+    def _rehash(self):
+        """Rebuild the name index from scratch
+        """
+        self._index= {}
+        self._keys= {}
+        for node in self._list:
+            self._file(node)
+
+    def _file(self, node):
+        keys= (node.nodeName, (node.namespaceURI, node.localName))
+        self._keys[node]= keys
+        for key in keys:
+            nodes= self._index.get(key)
+            if nodes is None:
+                self._index[key]= [node]
+            else:
+                nodes.append(node)
+                if node is not self._list[-1]:
+                    nodes.sort(lambda a, b, l= self._list:
+                        cmp(l.index(a), l.index(b))
+                    )
+
+    def _unfile(self, node):
+        for key in self._keys[node]:
+            nodes= self._index[key]
+            nodes.remove(node)
+            if len(nodes)==0:
+                del self._index[key]
+        del self._keys[node]
+
+    def _refile(self, node):
+        """Update the index for an item whose name has changed in place
+        """
+        if self._index is not None and self._keys.has_key(node):
+            self._unfile(node)
+            self._file(node)
 
     # Python dictionary-style methods. This is inconsistent with how Python
     # dictionaries normally work; it is only here for compatibility with
@@ -531,6 +1063,7 @@ class AttrMap(NamedNodeMap):
 
     Defaulted attributes are updated automatically on changes.
     """
+    __slots__= ()
     def __init__(self, ownerNode):
         NamedNodeMap.__init__(self, ownerNode, Node.ATTRIBUTE_NODE)
     def _writeItem(self, oldItem, newItem):
@@ -539,21 +1072,48 @@ class AttrMap(NamedNodeMap):
         ):
             raise InuseAttributeErr(newItem)
         NamedNodeMap._writeItem(self, oldItem, newItem)
+        if newItem is not None:
+            newItem._idChanged()
+        if oldItem is not None:
+            document= self._ownerNode._ownerDocument
+            if document is not None and document._ids is not None:
+                document._unfileOldIds(self._ownerNode)
         if oldItem is not None:
             if newItem is None or newItem.nodeName!=oldItem.nodeName:
                 ownerDocument= self._ownerNode.ownerDocument
                 if ownerDocument is not None:
                     doctype= ownerDocument.doctype
                     if doctype is not None:
-                        declarationList= doctype._attlists.getNamedItem(
+                        defaults= doctype._getAttributeTable(
                             self._ownerNode.nodeName
-                        )
-                        if declarationList is not None:
-                            declaration= declarationList.declarations.getNamedItem(oldItem.nodeName)
-                            if (declaration is not None and declaration.defaultType in (
-                                AttributeDeclaration.DEFAULT_VALUE, AttributeDeclaration.FIXED_VALUE
-                            )):
+                        )[0]
+                        for declaration in defaults:
+                            if declaration.nodeName==oldItem.nodeName:
                                 declaration._createAttribute(self._ownerNode)
+                                break
+
+
+class DeclarationMap(NamedNodeMap):
+    """A node mapping for a DocumentType's attlists or an attlist's declarations
+
+    Changes drop the DocumentType's compiled attribute table.
+    """
+    __slots__= ()
+    def __init__(self, ownerNode, childType):
+        NamedNodeMap.__init__(self, ownerNode, childType)
+    def _writeItem(self, oldItem, newItem):
+        NamedNodeMap._writeItem(self, oldItem, newItem)
+        self._changed()
+    def _append(self, value):
+        NamedNodeMap._append(self, value)
+        value._containerNode= self._ownerNode
+        self._changed()
+    def _changed(self):
+        doctype= self._ownerNode
+        if doctype.nodeType==Node.ATTRIBUTE_LIST_NODE:
+            doctype= doctype._containerNode
+        if doctype is not None:
+            doctype._table= None
 
 
 # Core non-node classes
@@ -685,6 +1245,8 @@ class DOMConfiguration(DOMObject):
         'pxdom-assume-element-content':              (False, True ),
         'pxdom-resolve-resources':                   (True,  True ),
         'pxdom-html-compatible':                     (False, True ),
+        'pxdom-track-locations':                     (True,  True ),
+        'pxdom-dtd-cache':                           (None,  True ),
         # Switches to make required normalizeDocument operations optional
         'pxdom-normalize-text':                      (True,  True ),
         'pxdom-reset-identity':                      (True,  True ),
@@ -714,11 +1276,15 @@ class DOMConfiguration(DOMObject):
         """
         DOMObject.__init__(self)
         self._parameters= {}
+        self._snap= None
+        self._errors= 0
         for (name, (value, canSet)) in self._defaults.items():
             if copyFrom is not None:
                 self._parameters[name]= copyFrom._parameters[name]
             else:
                 self._parameters[name]= value
+        if copyFrom is not None:
+            self._snap= copyFrom._snapshot()
 
     def canSetParameter(self, name, value):
         name= string.lower(name)
@@ -747,7 +1313,9 @@ class DOMConfiguration(DOMObject):
             if value:
                 for b in False, True:
                     for p in self._complexparameters[name][b]:
-                        self._parameters[p]= b
+                        if self._parameters[p]!=b:
+                            self._parameters[p]= b
+                            self._snap= None
             if name=='infoset':
                 return
         if not self._defaults.has_key(name):
@@ -756,6 +1324,26 @@ class DOMConfiguration(DOMObject):
             if not self._defaults[name][1]:
                 raise NotSupportedErr(self, name)
             self._parameters[name]= value
+            self._snap= None
+
+    def _copy(self):
+        """Copy the configuration cheaply for one parse, sharing the snapshot
+        but with a count of errors of its own
+        """
+        config= copy.copy(self)
+        config._parameters= self._parameters.copy()
+        config._errors= 0
+        return config
+
+    def _snapshot(self):
+        """Get the current parameter values as a _ConfigSnapshot
+
+        The snapshot is kept until setParameter next changes a value, so
+        per-node code can call this cheaply instead of getParameter.
+        """
+        if self._snap is None:
+            self._snap= _ConfigSnapshot(self)
+        return self._snap
 
     def _get_parameterNames(self):
         return DOMList(self._parameters.keys()+['infoset'])
@@ -779,9 +1367,11 @@ class DOMConfiguration(DOMObject):
 
     # Convenience method for pxdom to callback the error-handler if one is set
     # on the DOMConfiguration, and raise an exception if the error or handler
-    # says processing should not continue.
+    # says processing should not continue. Errors are counted so a parser can
+    # tell whether parsing some text reported any.
     #
     def _handleError(self, error):
+        self._errors= self._errors+1
         handler= self._parameters['error-handler']
         cont= None
         if handler is not None:
@@ -790,6 +1380,23 @@ class DOMConfiguration(DOMObject):
             raise error
 
 
+class _ConfigSnapshot:
+    """Immutable copy of a DOMConfiguration's parameter values
+
+    Each parameter is an attribute, named with underscores in place of
+    hyphens (eg. snapshot.canonical_form), including the derived values of
+    'infoset' and 'canonical-form'.
+    """
+    def __init__(self, config):
+        for name, value in config._parameters.items():
+            self.__dict__[r(name, '-', '_')]= value
+        for name in config._complexparameters.keys():
+            self.__dict__[r(name, '-', '_')]= config.getParameter(name)
+
+    def __setattr__(self, name, value):
+        raise NoModificationAllowedErr(self, name)
+
+
 # LSParsers can't have well-formed set to False, and default entities and
 # cdata-sections to False instead of True
 #
@@ -844,18 +1451,9 @@ class TypeInfo(DOMObject):
 
     def _getType(self):
         if self._ownerNode.nodeType==Node.ATTRIBUTE_NODE:
-            if (
-                self._ownerNode.ownerElement is not None and
-                self._ownerNode.ownerDocument is not None and
-                self._ownerNode.ownerDocument.doctype is not None
-            ):
-                attlist= self._ownerNode.ownerDocument.doctype._attlists.getNamedItem(self._ownerNode.ownerElement.tagName)
-                if attlist is not None:
-                    attdecl= attlist.declarations.getNamedItem(self._ownerNode.name)
-                    if attdecl is not None:
-                        return (DTNS, AttributeDeclaration.ATTR_NAMES[attdecl.attributeType])
-            if (self._ownerNode.name=='xml:id'):
-                return (DTNS, 'ID')
+            typeName= self._ownerNode._getTypeName()
+            if typeName is not None:
+                return (DTNS, typeName)
         return (None, None)
 
     def isDerivedFrom(self, typeNamespaceArg, typeNameArg, derivationMethod):
@@ -914,6 +1512,23 @@ class UserDataHandler:
 # Core node classes
 # ============================================================================
 
+def _linkSiblings(children, start, end):
+  """ Reset the sibling links of the nodes at indexes start to end inclusive in
+      a list of children, after the nodes around them have changed.
+  """
+  start= max(start, 0)
+  end= min(end, len(children)-1)
+  for index in range(start, end+1):
+    node= children[index]
+    if index>0:
+      node._previousSibling= children[index-1]
+    else:
+      node._previousSibling= None
+    if index<len(children)-1:
+      node._nextSibling= children[index+1]
+    else:
+      node._nextSibling= None
+
 class Node(DOMObject):
   """ Abstract base class for all DOM Nodes.
   """
@@ -928,31 +1543,34 @@ class Node(DOMObject):
   DOCUMENT_POSITION_CONTAINED_BY,DOCUMENT_POSITION_IMPLEMENTATION_SPECIFIC
   ]= map(lambda n: 1<<n, range(6))
 
-  # Node properties
+  # Node properties. The list of children is the shared NOCHILDREN until a
+  # child is added, and the ChildNodeList and user data dictionary are only
+  # made when they are first needed, so that leaf nodes stay small. Only
+  # NamedNodeNS subclasses store namespace details, and only Elements store
+  # attributes. Each child also links directly to its siblings, so that
+  # navigating between them doesn't have to search the parent's list. The
+  # line and column a parsed node was found at are packed into one number.
+  # Nodes can be weakly referenced, by their document's mutation log.
   #
-  def __init__(self,
-    ownerDocument= None, namespaceURI= None, localName= None, prefix= None
-  ):
+  __slots__= (
+    '_ownerDocument', '_containerNode', '_children', '_childNodes',
+    '_previousSibling', '_nextSibling', '_userData', '_location', '__weakref__'
+  )
+  _namespaceURI= _localName= _prefix= _attributes= None
+
+  def __init__(self, ownerDocument= None):
     DOMObject.__init__(self)
     self._ownerDocument= ownerDocument
     self._containerNode= None
-    self._namespaceURI= namespaceURI
-    self._localName= localName
-    self._prefix= prefix
-    self._childNodes= ChildNodeList(self)
-    self._attributes= None
-    self._userData= {}
-    self._childNodes.readonly= True
-    self._sequence= 0
-    self._row= -1
-    self._col= -1
+    self._children= NOCHILDREN
+    self._childNodes= None
+    self._previousSibling= None
+    self._nextSibling= None
+    self._userData= None
+    self._location= -1
   def _cloneTo(self, node):
     node._ownerDocument= self._ownerDocument
-    node._namespaceURI= self._namespaceURI
-    node._localName= self._localName
-    node._prefix= self._prefix
-    node._row= self._row
-    node._col= self._col
+    node._location= self._location
 
   def _get_ownerDocument(self): return self._ownerDocument
   def _get_parentNode(self): return self._containerNode
@@ -962,7 +1580,10 @@ class Node(DOMObject):
   def _get_namespaceURI(self): return self._namespaceURI
   def _get_localName(self): return self._localName
   def _get_prefix(self): return self._prefix
-  def _get_childNodes(self): return self._childNodes
+  def _get_childNodes(self):
+    if self._childNodes is None:
+      self._childNodes= ChildNodeList(self)
+    return self._childNodes
   def _get_attributes(self): return self._attributes
   def _set_nodeValue(self, value):
     pass
@@ -978,36 +1599,20 @@ class Node(DOMObject):
   # Hierarchy access
   #
   def _get_firstChild(self):
-    if self.childNodes.length>0:
-      return self.childNodes.item(0)
+    if len(self._children)>0:
+      return self._children[0]
     return None
 
   def _get_lastChild(self):
-    if self.childNodes.length>0:
-      return self._childNodes.item(self.childNodes.length-1)
+    if len(self._children)>0:
+      return self._children[-1]
     return None
 
   def _get_previousSibling(self):
-    if self.parentNode is None:
-      return None
-    try:
-      index= self.parentNode.childNodes._index(self)
-    except ValueError:
-      return None
-    if index<1:
-      return None
-    return self.parentNode.childNodes.item(index-1)
+    return self._previousSibling
 
   def _get_nextSibling(self):
-    if self.parentNode is None:
-      return None
-    try:
-      index= self.parentNode.childNodes._index(self)
-    except ValueError:
-      return None
-    if index>=self.parentNode.childNodes.length-1:
-      return None
-    return self.parentNode.childNodes.item(index+1)
+    return self._nextSibling
 
   def hasAttributes(self):
     if self._attributes is not None:
@@ -1016,7 +1621,7 @@ class Node(DOMObject):
     return False
 
   def hasChildNodes(self):
-    return self._childNodes.length>0
+    return len(self._children)>0
 
   # Hierarchy alteration
   #
@@ -1046,47 +1651,120 @@ class Node(DOMObject):
     self._writeChild(None, oldChild, True)
     return oldChild
 
+  def pxdomAppendChildren(self, newChildren):
+    """ Append a sequence of nodes, with the same result as calling
+        appendChild on each in turn, but checking them all before anything
+        is changed and splicing them into the child list in one go.
+    """
+    newChildren= list(newChildren)
+    if None in newChildren:
+      raise NotFoundErr(self, None, None)
+    if len(newChildren)>0:
+      self._writeChildren(newChildren, None, False)
+
   def _writeChild(self, newChild, oldChild, removeOld):
+    if newChild is None:
+      self._writeChildren([], oldChild, removeOld)
+    else:
+      self._writeChildren([newChild], oldChild, removeOld)
+
+  def _writeChildren(self, newChildren, oldChild, removeOld):
     if self._readonly:
       raise NoModificationAllowedErr(self, 'Child')
-    if oldChild is not None and oldChild not in self._childNodes:
+    if oldChild is not None and (
+      oldChild._containerNode is not self or
+      oldChild.nodeType not in self._childTypes
+    ):
       raise NotFoundErr(self, oldChild.namespaceURI, oldChild.localName)
-    if oldChild is newChild:
+    if len(newChildren)==1 and newChildren[0] is oldChild:
       return
 
-    if newChild is not None:
-      if newChild.ownerDocument not in (self._ownerDocument, None):
-        raise WrongDocumentErr(newChild, self._ownerDocument)
-      ancestor= self
-      while ancestor is not None:
-        if newChild is ancestor:
-          raise HierarchyRequestErr(newChild, self)
-        ancestor= ancestor.parentNode
-      if newChild.nodeType==Node.DOCUMENT_FRAGMENT_NODE:
-        newNodes= list(newChild._childNodes._list)
-      else:
-        newNodes= [newChild]
+    # Check all the new children before changing anything, and make the flat
+    # list of nodes they add up to. A node given more than once ends up where
+    # it was last given, and a DocumentFragment only gives those of its
+    # children that an earlier node hasn't already taken away from it.
+    #
+    # Only this node or one with children can be among its ancestors, so the
+    # ancestors are only walked, once, if one of those is being inserted.
+    #
+    newNodes= []
+    if len(newChildren)>0:
+      inside= []
+      parents= filter(
+        lambda node, self= self: node is self or len(node._children)>0,
+        newChildren
+      )
+      if len(parents)>0:
+        ancestor= self
+        while ancestor is not None:
+          for node in parents:
+            if node is ancestor:
+              inside.append(node)
+          ancestor= ancestor._containerNode
+      added= {}
+      for newChild in newChildren:
+        if newChild.ownerDocument not in (self._ownerDocument, None):
+          raise WrongDocumentErr(newChild, self._ownerDocument)
+        for node in inside:
+          if node is newChild:
+            raise HierarchyRequestErr(newChild, self)
+        if newChild.nodeType==Node.DOCUMENT_FRAGMENT_NODE:
+          nodes= newChild._children
+        else:
+          nodes= [newChild]
+        for node in nodes:
+          if node.nodeType not in self._childTypes:
+            raise HierarchyRequestErr(node, self)
+          if node._containerNode is not None:
+            if node._containerNode._readonly:
+              raise NoModificationAllowedErr(node._containerNode, 'Child')
+          if added.has_key(node):
+            if node is newChild:
+              newNodes.remove(node)
+            else:
+              continue
+          added[node]= True
+          newNodes.append(node)
       for node in newNodes:
-        if node.nodeType not in self._childTypes:
-          raise HierarchyRequestErr(node, self)
-        if node.parentNode is not None:
-          node.parentNode.removeChild(node)
-
-    self._childNodes.readonly= False
+        if node._containerNode is not None:
+          node._containerNode.removeChild(node)
+
+    tagIndex= None
+    if self._ownerDocument is not None:
+      tagIndex= self._ownerDocument._tagIndex
+      if tagIndex is not None and not tagIndex._contains(self):
+        tagIndex= None
+
+    children= self._children
+    if children is NOCHILDREN:
+      children= self._children= []
     if oldChild is None:
-      index= self._childNodes.length
+      index= len(children)
     else:
-      index= self._childNodes._index(oldChild)
+      index= children.index(oldChild)
     if removeOld:
       oldChild._containerNode= None
-      del self._childNodes._list[index]
-    if newChild is not None:
-      if newChild.ownerDocument is None:
-        newChild._recurse(True, ownerDocument= self._ownerDocument)
-      self._childNodes._insertseq(index, newNodes)
+      oldChild._previousSibling= None
+      oldChild._nextSibling= None
+      del children[index]
+      if tagIndex is not None:
+        tagIndex._remove(oldChild)
+      if self._ownerDocument is not None and self._ownerDocument._ids is not None:
+        self._ownerDocument._dropIds(oldChild)
+    if len(newNodes)>0:
+      for node in newNodes:
+        if node._ownerDocument is None:
+          node._recurse(True, ownerDocument= self._ownerDocument)
+      children[index:index]= newNodes
       for node in newNodes:
         node._containerNode= self
-    self._childNodes.readonly= True
+      _linkSiblings(children, index-1, index+len(newNodes))
+      if tagIndex is not None:
+        tagIndex._add(newNodes)
+      self._noteIds(newNodes)
+    else:
+      _linkSiblings(children, index-1, index)
+      self._noteIds()
     self._changed()
 
   def isSupported(self, feature, version):
@@ -1098,28 +1776,55 @@ class Node(DOMObject):
     return None
 
   def _get_pxdomLocation(self):
-    return DOMLocator(self, self._row, self._col)
+    if self._location==-1:
+      return DOMLocator(self, -1, -1)
+    row, col= divmod(self._location, LOCATION_COLUMNS)
+    return DOMLocator(self, row, col)
   def _setLocation(self, (row, col)):
-    self._row= row
-    self._col= col
+    self._location= row*LOCATION_COLUMNS+col
 
   def _renameNode(self, namespaceURI, qualifiedName):
     raise NotSupportedErr(self, 'renameNode')
 
-  def _changed(self):
-    """Backend sequence number update
-
-    Works iteratively over parents, not recursively. This is possible because
-    no node subclass changes the behaviour of _changed, allowing node updates
-    over the recursion limit.
+  def _noteIds(self, nodes= ()):
+    """Add Elements that may have gained an ID to the document's ID index,
+    if it has one: the owner of an Attr whose value this node is part of,
+    and Elements in any newly inserted nodes.
     """
+    document= self._ownerDocument
+    if document is None or document._ids is None:
+      return
     node= self
-    while node is not None:
-      node._sequence= node._sequence+1
+    while node is not None and node.nodeType in (
+      Node.TEXT_NODE, Node.ENTITY_REFERENCE_NODE
+    ):
       node= node._containerNode
+    if node is not None and node.nodeType==Node.ATTRIBUTE_NODE:
+      node._idChanged()
+    for node in nodes:
+      document._addIds(node)
+
+  def _renamed(self):
+    """Refile the node in whatever indexes it by name, after an in-place
+    change of name: the document's tag index for Elements, or the owner
+    Element's attributes map for Attrs.
+    """
+    if self._ownerDocument is not None:
+      if self._ownerDocument._tagIndex is not None:
+        self._ownerDocument._tagIndex._refile(self)
+
+  def _changed(self):
+    """Backend change notification
+
+    Counts a change to the node's subtree in its document's mutation log.
+    Nothing is done to the node's ancestors; caches on a subtree instead ask
+    the document whether anything in it has changed since they were made.
+    """
+    if self._ownerDocument is not None:
+      self._ownerDocument._noteMutation(self)
 
   def _getDescendants(self, descendants):
-    for child in self._childNodes:
+    for child in self._children:
       descendants.append(child)
       child._getDescendants(descendants)
 
@@ -1130,7 +1835,7 @@ class Node(DOMObject):
       for attr in self._attributes:
         if attr._containsUnboundPrefix():
           return True
-    for child in self._childNodes:
+    for child in self._children:
       if child._containsUnboundPrefix():
         return True
     return False
@@ -1140,8 +1845,9 @@ class NamedNode(Node):
   """ Base class for nodes who have specific names but no namespace
       capability (entity references and so on).
   """
+  __slots__= ('_nodeName',)
   def __init__(self, ownerDocument= None, nodeName= None):
-    Node.__init__(self, ownerDocument, None, None, None)
+    Node.__init__(self, ownerDocument)
     if nodeName is not None:
       _checkName(nodeName)
     self._nodeName= nodeName
@@ -1160,13 +1866,22 @@ class NamedNodeNS(Node):
       trying to read either namespaceURI or localName will result in a null
       value as specified by DOM Level 2 Core.
   """
+  __slots__= ('_namespaceURI', '_localName', '_prefix')
   def __init__(self,
     ownerDocument= None, namespaceURI= None, localName= None, prefix= None
   ):
     for name in (prefix, localName):
       if name is not None:
         _checkName(name, nc= namespaceURI is not NONS)
-    Node.__init__(self, ownerDocument, namespaceURI, localName, prefix)
+    Node.__init__(self, ownerDocument)
+    self._namespaceURI= namespaceURI
+    self._localName= localName
+    self._prefix= prefix
+  def _cloneTo(self, node):
+    Node._cloneTo(self, node)
+    node._namespaceURI= self._namespaceURI
+    node._localName= self._localName
+    node._prefix= self._prefix
   def _get_nodeName(self):
     if self._namespaceURI is NONS or self._prefix is None:
       return self._localName
@@ -1194,6 +1909,7 @@ class NamedNodeNS(Node):
     ):
       raise NamespaceErr((value or '')+':'+self._localName,self._namespaceURI)
     self._prefix= value
+    self._renamed()
     self._changed()
 
   def _renameNode(self, namespaceURI, qualifiedName):
@@ -1223,8 +1939,18 @@ class NamedNodeNS(Node):
 class Document(Node):
   """ Implementation of DOM 3 Document interface.
   """
+  __slots__= (
+    '_xmlStandalone', '_xmlVersion', '_xmlEncoding', '_inputEncoding',
+    '_documentURI', '_strictErrorChecking', '_domConfig', '_userdatacalls',
+    '_tagIndex', '_ids', '_idValues', '_mutations', '_mutationLog'
+  )
   def __init__(self):
-    Node.__init__(self, self, None, None, None)
+    Node.__init__(self, self)
+    self._tagIndex= None
+    self._ids= None
+    self._idValues= None
+    self._mutations= 0
+    self._mutationLog= []
     self._xmlStandalone= False
     self._xmlVersion= '1.0'
     self._xmlEncoding= None
@@ -1257,12 +1983,12 @@ class Document(Node):
   def _get_implementation(self):
     return _implementation
   def _get_documentElement(self):
-    for child in self._childNodes:
+    for child in self._children:
       if child.nodeType==Node.ELEMENT_NODE:
         return child
     return None
   def _get_doctype(self):
-    for child in self._childNodes:
+    for child in self._children:
        if child.nodeType==Node.DOCUMENT_TYPE_NODE:
         return child
     return None
@@ -1355,15 +2081,165 @@ class Document(Node):
     if namespaceURI=='':
       namespaceURI= None
     return NodeListByTagName(self, namespaceURI, localName)
+  # Mutation log. Every change is counted in _mutations, and the changed node
+  # (the parent, for changes to a list of children) is kept in a log of the
+  # last few changes. A cache over a subtree remembers the count when it was
+  # made, and is only out of date if one of the changes since was inside its
+  # subtree, or if too many changes have happened to still be in the log.
+  # The log holds weak references: a node that has gone can no longer be in
+  # anyone's subtree, as it would have been kept alive by it.
+  #
+  MUTATION_LOG_SIZE= 64
+
+  def _noteMutation(self, node):
+    self._mutations= self._mutations+1
+    log= self._mutationLog
+    log.append(_weakRef(node))
+    if len(log)>self.MUTATION_LOG_SIZE*2:
+      del log[:-self.MUTATION_LOG_SIZE]
+
+  def _changedSince(self, node, mutations):
+    """ Check whether node or its descendants have changed since the mutation
+        count was at a given value.
+    """
+    count= self._mutations-mutations
+    if count==0:
+      return False
+    if count<0 or count>len(self._mutationLog):
+      return True
+    for changed in self._mutationLog[-count:]:
+      changed= changed()
+      while changed is not None:
+        if changed is node:
+          return True
+        changed= changed._containerNode
+    return False
+
+  def _getTagIndex(self, node):
+    """ Get the tag index, creating it if need be, if node is in the tree.
+    """
+    if self._tagIndex is None:
+      ancestor= node
+      while ancestor is not self:
+        if ancestor is None or ancestor.nodeType==Node.ATTRIBUTE_NODE:
+          return None
+        ancestor= ancestor._containerNode
+      self._tagIndex= _TagIndex(self)
+    elif not self._tagIndex._contains(node):
+      return None
+    return self._tagIndex
+
+  # The ID index maps ID values to Elements that have had an ID attribute
+  # with that value. It is made on the first getElementById call, after which
+  # Elements are refiled as they gain or lose ID attributes, are inserted or
+  # renamed, or their ID attributes' values change, and unfiled as they are
+  # removed. Each candidate is still checked before being returned, in case
+  # an ID has changed some way the index is not told of.
+  #
   def getElementById(self, elementId):
+    if self._ids is None:
+      self._ids= {}
+      self._idValues= {}
+      self._addIds(self)
+    if not self._ids.has_key(elementId):
+      return None
+    matches= []
+    for element in self._ids[elementId][:]:
+      if self._hasId(element, elementId):
+        matches.append(element)
+      else:
+        self._unfileId(element, elementId)
+    if len(matches)==0:
+      return None
+    if len(matches)==1:
+      return matches[0]
     return self._getElementById(self, elementId)
+
+  def _addIds(self, node):
+    if node._attributes is not None:
+      for attr in node._attributes:
+        attr._idChanged()
+    if Node.ELEMENT_NODE in node._childTypes:
+      for child in node._children:
+        self._addIds(child)
+
+  # ID index upkeep. Each Element is filed under the values of its ID
+  # attributes, and the values it is filed under are kept too, so that it can
+  # be unfiled when it leaves the tree or loses an ID.
+  #
+  def _fileId(self, element, value):
+    self._unfileOldIds(element)
+    if not self._ids.has_key(value):
+      self._ids[value]= [element]
+    elif element not in self._ids[value]:
+      self._ids[value].append(element)
+    if not self._idValues.has_key(element):
+      self._idValues[element]= [value]
+    elif value not in self._idValues[element]:
+      self._idValues[element].append(value)
+
+  def _unfileId(self, element, value):
+    candidates= self._ids.get(value)
+    if candidates is not None and element in candidates:
+      candidates.remove(element)
+      if len(candidates)==0:
+        del self._ids[value]
+    values= self._idValues.get(element)
+    if values is not None and value in values:
+      values.remove(value)
+      if len(values)==0:
+        del self._idValues[element]
+
+  def _unfileOldIds(self, element):
+    """ Unfile an Element from values it no longer has an ID attribute with.
+    """
+    if not self._idValues.has_key(element):
+      return
+    current= []
+    for attr in element._attributes._list:
+      if attr.isId:
+        current.append(attr.value)
+    for value in self._idValues[element][:]:
+      if value not in current:
+        self._unfileId(element, value)
+
+  def _dropIds(self, node):
+    """ Unfile the Elements in a subtree just taken out of the tree.
+    """
+    stack= [node]
+    while len(stack)>0 and len(self._idValues)>0:
+      node= stack.pop()
+      if self._idValues.has_key(node):
+        for value in self._idValues[node][:]:
+          self._unfileId(node, value)
+      for child in node._children:
+        if child.nodeType in (
+          Node.ELEMENT_NODE, Node.ENTITY_REFERENCE_NODE
+        ):
+          stack.append(child)
+
+  def _hasId(self, element, elementId):
+    """ Check an ID index candidate is still in the tree with the given ID.
+    """
+    for attr in element._attributes:
+      if attr.isId and attr.value==elementId:
+        break
+    else:
+      return False
+    ancestor= element
+    while ancestor is not self:
+      if ancestor is None or ancestor.nodeType==Node.ATTRIBUTE_NODE:
+        return False
+      ancestor= ancestor._containerNode
+    return True
+
   def _getElementById(self, node, elementId):
     if node._attributes is not None:
       for attr in node._attributes:
         if attr.isId and attr.value==elementId:
           return node
     if Node.ELEMENT_NODE in node._childTypes:
-      for child in node._childNodes:
+      for child in node._children:
         element= self._getElementById(child, elementId)
         if element is not None:
           return element
@@ -1383,19 +2259,21 @@ class Document(Node):
     self._flushUserData()
     return n
 
-  def _writeChild(self, newChild, oldChild, removeOld):
+  def _writeChildren(self, newChildren, oldChild, removeOld):
     """ Before allowing a child hierarchy change to go ahead, check that
         allowing it wouldn't leave the document containing two Element or two
         DocumentType children.
     """
-    if newChild is not None:
+    newNodes= []
+    for newChild in newChildren:
       if newChild.nodeType==Node.DOCUMENT_FRAGMENT_NODE:
-        newNodes= newChild._childNodes._list
+        newNodes.extend(newChild._children)
       else:
-        newNodes= [newChild]
+        newNodes.append(newChild)
+    if len(newNodes)>0:
       doctype= None
       documentElement= None
-      afterNodes= list(self._childNodes._list)
+      afterNodes= list(self._children)
       if removeOld and oldChild in afterNodes:
         afterNodes.remove(oldChild)
       for node in afterNodes+newNodes:
@@ -1407,7 +2285,15 @@ class Document(Node):
           if documentElement not in (node, None):
             raise HierarchyRequestErr(node, self)
           documentElement= node
-    Node._writeChild(self, newChild, oldChild, removeOld)
+    Node._writeChildren(self, newChildren, oldChild, removeOld)
+
+    # Attribute types come from the doctype, so a new one may change IDs
+    #
+    for node in newNodes:
+      if node.nodeType==Node.DOCUMENT_TYPE_NODE:
+        self._ids= self._idValues= None
+    if removeOld and oldChild.nodeType==Node.DOCUMENT_TYPE_NODE:
+      self._ids= self._idValues= None
 
   def __repr__(self):
     if self.documentURI is not None:
@@ -1417,8 +2303,9 @@ class Document(Node):
 
 
 class DocumentFragment(Node):
+  __slots__= ()
   def __init__(self, ownerDocument= None):
-    Node.__init__(self, ownerDocument, None, None, None)
+    Node.__init__(self, ownerDocument)
   def _get_nodeType(self):
     return Node.DOCUMENT_FRAGMENT_NODE
   def _get_nodeName(self):
@@ -1430,6 +2317,7 @@ class DocumentFragment(Node):
 class Element(NamedNodeNS):
   """ Implementation of DOM 3 Element interface.
   """
+  __slots__= ('_attributes',)
   def __init__(self,
     ownerDocument= None, namespaceURI= None, localName= None, prefix= None
   ):
@@ -1530,11 +2418,20 @@ class Element(NamedNodeNS):
     if idAttr not in self._attributes._list:
       raise NotFoundErr(self._attributes, NONS, idAttr.name)
     idAttr._isId= isId
+    idAttr._idChanged()
 
   def _renameNode(self, namespaceURI, qualifiedName):
     self._setDefaultAttributes(False)
     NamedNodeNS._renameNode(self, namespaceURI, qualifiedName)
     self._setDefaultAttributes()
+    self._renamed()
+
+  def _renamed(self):
+    """ A new name can change which attributes the DTD declares as IDs.
+    """
+    Node._renamed(self)
+    for attr in self._attributes:
+      attr._idChanged()
 
 
   def _setDefaultAttributes(self, set= True):
@@ -1542,22 +2439,17 @@ class Element(NamedNodeNS):
     """
     if self._ownerDocument is None or self._ownerDocument.doctype is None:
       return
-    declarationList= self._ownerDocument.doctype._attlists.getNamedItem(
-      self.tagName
-    )
-    if declarationList is not None:
-      for declaration in declarationList.declarations:
-        if declaration.defaultType in (
-          AttributeDeclaration.DEFAULT_VALUE, AttributeDeclaration.FIXED_VALUE
-        ):
-          oldNode= self.getAttributeNode(declaration.nodeName)
-          if set:
-            if oldNode is None:
-              declaration._createAttribute(self)
-          elif oldNode is not None and not oldNode.specified:
-            self.removeAttributeNode(oldNode)
+    defaults= self._ownerDocument.doctype._getAttributeTable(self.tagName)[0]
+    for declaration in defaults:
+      oldNode= self.getAttributeNode(declaration.nodeName)
+      if set:
+        if oldNode is None:
+          declaration._createAttribute(self)
+      elif oldNode is not None and not oldNode.specified:
+        self.removeAttributeNode(oldNode)
 
 class Attr(NamedNodeNS):
+  __slots__= ('_specified', '_isId')
   def __init__(self,
     ownerDocument= None,
     namespaceURI= None, localName= None, prefix= None, specified= True
@@ -1577,12 +2469,12 @@ class Attr(NamedNodeNS):
   def _get_name(self):
     return self.nodeName
   def _get_value(self):
-    c= self._childNodes
-    if c.length==1 and c[0].nodeType==Node.TEXT_NODE:
+    c= self._children
+    if len(c)==1 and c[0].nodeType==Node.TEXT_NODE:
       value= c[0].data
     else:
       value= self.textContent
-    if self.schemaTypeInfo.typeName in ('CDATA', None):
+    if self._getTypeName() in ('CDATA', None):
       return value
     else:
       return string.join(
@@ -1609,7 +2501,37 @@ class Attr(NamedNodeNS):
   def _get_specified(self):
     return self._specified
   def _get_isId(self):
-    return self._isId or self.schemaTypeInfo.typeName=='ID'
+    if self._isId:
+      return True
+    table= self._getAttributeTable()
+    if table is not None and table[1].has_key(self.nodeName):
+      return table[2].has_key(self.nodeName)
+    return self.nodeName=='xml:id'
+
+  def _getAttributeTable(self):
+    """ Get the doctype's compiled attribute information for the owner
+        element, or None if there is no element or doctype.
+    """
+    element= self._containerNode
+    if element is None or self._ownerDocument is None:
+      return None
+    doctype= self._ownerDocument.doctype
+    if doctype is None:
+      return None
+    return doctype._getAttributeTable(element.nodeName)
+
+  def _getTypeName(self):
+    """ Get the name of the type the attribute is declared with, or ID for an
+        undeclared xml:id, or None.
+    """
+    table= self._getAttributeTable()
+    if table is not None:
+      typeName= table[1].get(self.nodeName)
+      if typeName is not None:
+        return typeName
+    if self.nodeName=='xml:id':
+      return 'ID'
+    return None
 
   def _renameNode(self, namespaceURI, qualifiedName):
     owner= self._containerNode
@@ -1619,10 +2541,30 @@ class Attr(NamedNodeNS):
     if owner is not None:
       owner.setAttributeNodeNS(self)
 
+  def _renamed(self):
+    if self._containerNode is not None:
+      self._containerNode._attributes._refile(self)
+    self._idChanged()
+
+  def _idChanged(self):
+    """ Refile the owner Element in the document's ID index, if there is one:
+        under this attribute's value if it is an ID, and out of any values it
+        no longer has.
+    """
+    element= self._containerNode
+    document= self._ownerDocument
+    if element is None or document is None or document._ids is None:
+      return
+    if self.isId:
+      document._fileId(element, self.value)
+    else:
+      document._unfileOldIds(element)
+
 
 class CharacterData(Node):
+  __slots__= ('_data',)
   def __init__(self, ownerDocument= None):
-    Node.__init__(self, ownerDocument, None, None, None)
+    Node.__init__(self, ownerDocument)
     self._data= ''
   def _cloneTo(self, node):
     Node._cloneTo(self, node)
@@ -1642,6 +2584,7 @@ class CharacterData(Node):
     return len(self._data)
   def _set_data(self, value):
     self._data= value
+    self._noteIds()
 
   def substringData(self, offset, count):
     if offset<0 or count<0 or offset>len(self._data):
@@ -1651,6 +2594,7 @@ class CharacterData(Node):
     if self._readonly:
       raise NoModificationAllowedErr(self, 'data')
     self._data= self._data+arg
+    self._noteIds()
   def insertData(self, offset, arg):
     self.replaceData(offset, 0, arg)
   def deleteData(self, offset, count):
@@ -1661,6 +2605,7 @@ class CharacterData(Node):
     if offset<0 or count<0 or offset>len(self._data):
       raise IndexSizeErr(self._data, offset)
     self._data= self._data[:offset]+arg+self._data[offset+count:]
+    self._noteIds()
 
   def __repr__(self):
     t= repr(self.nodeValue)
@@ -1672,6 +2617,7 @@ class CharacterData(Node):
 
 
 class Comment(CharacterData):
+  __slots__= ()
   def _get_nodeType(self):
     return Node.COMMENT_NODE
   def _get_nodeName(self):
@@ -1679,6 +2625,7 @@ class Comment(CharacterData):
 
 
 class Text(CharacterData):
+  __slots__= ()
   def _get_nodeType(self):
     return Node.TEXT_NODE
   def _get_nodeName(self):
@@ -1690,47 +2637,15 @@ class Text(CharacterData):
         don't know the content model, guess either ANY (by default), or
         element-only (if the appropriate config parameter is set).
     """
-    # Find the nearest element ancestor, as we might be in nested entity
-    # references.
-    #
     pn= self.parentNode
-    while pn is not None:
-      if pn.nodeType==Node.ENTITY_REFERENCE_NODE:
-        pn= pn.parentNode
-        continue
-      if pn.nodeType==Node.ELEMENT_NODE:
-        break
-      return False
-    else:
-      return False
-
-    # Get the DOMConfiguration to look at - usually the current Document's,
-    # but an LS process might pass an alternative in. Get the default content
-    # model from this.
-    #
-    if config is None:
-      config= self._ownerDocument.domConfig
-    contentType= ElementDeclaration.ANY_CONTENT
-    if config.getParameter('pxdom-assume-element-content'):
-      contentType= ElementDeclaration.ELEMENT_CONTENT
-
-    # See if the element has a different content model declared. If the final
-    # content model is not element-only, can't be ECW.
-    #
-    if self._ownerDocument.doctype is not None:
-      eldecl= self._ownerDocument.doctype._elements.getNamedItem(pn.nodeName)
-      if eldecl is not None:
-        contentType= eldecl.contentType
-    if contentType!=ElementDeclaration.ELEMENT_CONTENT:
+    if pn is None or not pn._isElementContent(config):
       return False
 
     # Finally check the node does only have whitespaces. (For it not to do so
     # would be invalid, but still well-formed.)
     #
-    for c in self._data:
-      if not(c in WHITE or isinstance(c, Unicode) and c in WHITEU):
-        return False
-    return True
+    data= self._data
+    return WHITES[isinstance(data, Unicode)].match(data).end()==len(data)
 
   def splitText(self, offset):
     """ Move character data following the offset point from this node to a new
@@ -1745,6 +2660,7 @@ class Text(CharacterData):
 
 
 class CDATASection(Text):
+  __slots__= ()
   def _get_nodeType(self):
     return Node.CDATA_SECTION_NODE
   def _get_nodeName(self):
@@ -1752,6 +2668,7 @@ class CDATASection(Text):
 
 
 class ProcessingInstruction(NamedNode):
+  __slots__= ('_data',)
   def __init__(self, ownerDocument= None, target= None):
     NamedNode.__init__(self, ownerDocument, target)
     self._data= ''
@@ -1776,6 +2693,7 @@ class ProcessingInstruction(NamedNode):
 
 
 class EntityReference(NamedNode):
+  __slots__= ()
   def __init__(self, ownerDocument= None, nodeName= None):
     NamedNode.__init__(self, ownerDocument, nodeName)
   def _get_nodeType(self):
@@ -1787,7 +2705,19 @@ class DocumentType(NamedNode):
       interface in providing maps for attlists and entity declarations of the
       internal subset (attlists are required internally to support attribute
       defaulting).
+
+      A doctype may also share a read-only doctype owned by no document, as
+      kept by a DTDCache, whose declarations apply wherever this one doesn't
+      declare the same name. Internal lookups go to both; only when the maps
+      are asked for as a whole are the shared declarations copied into them.
+
+      What the attlists say about each element type is compiled into a table
+      on first use, which is dropped whenever an attlist changes.
   """
+  __slots__= (
+    '_publicId', '_systemId', '_internalSubset', '_entities', '_notations',
+    '_elements', '_attlists', '_processed', '_shared', '_table'
+  )
   def __init__(self,
     ownerDocument= None, name= None, publicId=None, systemId= None
   ):
@@ -1798,8 +2728,10 @@ class DocumentType(NamedNode):
     self._entities= NamedNodeMap(self, Node.ENTITY_NODE)
     self._notations= NamedNodeMap(self, Node.NOTATION_NODE)
     self._elements= NamedNodeMap(self, Node.ELEMENT_DECLARATION_NODE)
-    self._attlists= NamedNodeMap(self, Node.ATTRIBUTE_LIST_NODE)
+    self._attlists= DeclarationMap(self, Node.ATTRIBUTE_LIST_NODE)
     self._processed= True
+    self._shared= None
+    self._table= None
   def _cloneTo(self, node):
     NamedNode._cloneTo(self, node)
     node._publicId= self._publicId
@@ -1817,20 +2749,127 @@ class DocumentType(NamedNode):
   def _get_internalSubset(self):
     return self._internalSubset
   def _get_entities(self):
+    self._expand()
     return self._entities
   def _get_notations(self):
+    self._expand()
     return self._notations
   def _get_pxdomElements(self):
+    self._expand()
     return self._elements
   def _get_pxdomAttlists(self):
+    self._expand()
     return self._attlists
   def _get_pxdomProcessed(self):
     return self._processed
   def _set_internalSubset(self, value):
     self._internalSubset= value
 
+  # Declarations shared with other doctypes
+  #
+  def _lookup(self, mapName, name):
+    """ Get the declaration of a name from one of the maps, or from the shared
+        declarations if this doctype doesn't declare it.
+    """
+    node= getattr(self, mapName).getNamedItem(name)
+    if node is None and self._shared is not None:
+      node= getattr(self._shared, mapName).getNamedItem(name)
+    return node
+
+  def _getAttributeTable(self, tagName):
+    """ Get what the attlists declare for an element type: a list of the
+        declarations of attributes with default values, a dictionary of
+        attribute names to the names of their types, and a dictionary of the
+        names of ID attributes.
+    """
+    table= self._table
+    if table is None:
+      table= self._table= {}
+    entry= table.get(tagName)
+    if entry is None:
+      attlist= self._attlists.getNamedItem(tagName)
+      if attlist is None and self._shared is not None:
+        entry= self._shared._getAttributeTable(tagName)
+      else:
+        defaults, types, ids= [], {}, {}
+        if attlist is not None:
+          for declaration in attlist._declarations._list:
+            name= declaration.nodeName
+            if types.has_key(name):
+              continue
+            types[name]= AttributeDeclaration.ATTR_NAMES[
+              declaration.attributeType
+            ]
+            if declaration.attributeType==AttributeDeclaration.ID_ATTR:
+              ids[name]= True
+            if declaration.defaultType in (
+              AttributeDeclaration.DEFAULT_VALUE,
+              AttributeDeclaration.FIXED_VALUE
+            ):
+              defaults.append(declaration)
+        entry= defaults, types, ids
+      table[tagName]= entry
+    return entry
+
+  def _share(self, shared):
+    """ Take on the declarations of a read-only doctype. Attribute lists for
+        elements this doctype also has one for are merged into its own.
+    """
+    for attlist in self._attlists._list:
+      other= shared._attlists.getNamedItem(attlist.nodeName)
+      if other is not None:
+        declarations= attlist._declarations
+        for declaration in other._declarations._list:
+          if declarations.getNamedItem(declaration.nodeName) is None:
+            declarations.setNamedItem(declaration._copy(self._ownerDocument))
+    if not shared._processed:
+      self._processed= False
+    self._shared= shared
+    self._table= None
+
+  def _expand(self):
+    """ Copy any shared declarations into the maps, so they can be used as a
+        whole.
+    """
+    if self._shared is not None:
+      shared, self._shared= self._shared, None
+      maps= (self._entities, self._notations, self._elements, self._attlists)
+      readonly= map(lambda m: m._readonly, maps)
+      for m in maps:
+        m._readonly= False
+      self._merge(shared)
+      for m, ro in map(None, maps, readonly):
+        m._readonly= ro
+
+  def _merge(self, source):
+    """ Add copies of the declarations in another doctype, except where this
+        one already has a declaration of the same name, as the ones from an
+        internal subset take precedence over an external subset's.
+    """
+    document= self._ownerDocument
+    for mapName in ('_notations', '_entities', '_elements'):
+      nodes= getattr(self, mapName)
+      for node in getattr(source, mapName)._list:
+        if nodes.getNamedItem(node.nodeName) is None:
+          nodes.setNamedItem(node._copy(document))
+    for attlist in source._attlists._list:
+      existing= self._attlists.getNamedItem(attlist.nodeName)
+      if existing is None:
+        self._attlists.setNamedItem(attlist._copy(document))
+      else:
+        declarations= existing._declarations
+        for declaration in attlist._declarations._list:
+          if declarations.getNamedItem(declaration.nodeName) is None:
+            declarations.setNamedItem(declaration._copy(document))
+    if not source._processed:
+      self._processed= False
+
 
 class Entity(NamedNode):
+  __slots__= (
+    '_publicId', '_systemId', '_notationName', '_baseURI', '_xmlVersion',
+    '_xmlEncoding', '_inputEncoding', '_documentURI', '_available'
+  )
   def __init__(self,
     ownerDocument= None, nodeName= None, publicId= None, systemId= None,
     notationName= None, baseURI= None
@@ -1850,6 +2889,7 @@ class Entity(NamedNode):
     node._publicId= self._publicId
     node._systemId= self._systemId
     node._notationName= self._notationName
+    node._baseURI= self._baseURI
     node._available= self._available
     node._xmlVersion= self._xmlVersion
     node._xmlEncoding= self._xmlEncoding
@@ -1877,6 +2917,7 @@ class Entity(NamedNode):
     return self._documentURI
 
 class Notation(NamedNode):
+  __slots__= ('_publicId', '_systemId', '_baseURI')
   def __init__(self, ownerDocument= None,
     nodeName= None, publicId= None, systemId= None, baseURI= None
   ):
@@ -1888,6 +2929,7 @@ class Notation(NamedNode):
     NamedNode._cloneTo(self, node)
     node._publicId= self._publicId
     node._systemId= self._systemId
+    node._baseURI= self._baseURI
   def _get_nodeType(self):
     return Node.NOTATION_NODE
   def _get_parentNode(self):
@@ -1910,6 +2952,7 @@ class ElementDeclaration(NamedNode):
   """
   [EMPTY_CONTENT, ANY_CONTENT, MIXED_CONTENT, ELEMENT_CONTENT
   ]= range(1, 5)
+  __slots__= ('_contentType', '_elements')
   def __init__(
     self, ownerDocument= None, nodeName= None,
     contentType= ANY_CONTENT, elements= None
@@ -1959,9 +3002,10 @@ class ContentDeclaration(DOMList):
 
 
 class AttributeListDeclaration(NamedNode):
+  __slots__= ('_declarations',)
   def __init__(self, ownerDocument= None, nodeName= None):
     NamedNode.__init__(self, ownerDocument, nodeName)
-    self._declarations= NamedNodeMap(self, Node.ATTRIBUTE_DECLARATION_NODE)
+    self._declarations= DeclarationMap(self, Node.ATTRIBUTE_DECLARATION_NODE)
   def _cloneTo(self, node):
     NamedNode._cloneTo(self, node)
   def _get_nodeType(self):
@@ -1988,6 +3032,7 @@ class AttributeDeclaration(NamedNode):
     'ID', 'IDREF', 'IDREFS', 'ENTITY', 'ENTITIES', 'NMTOKEN', 'NMTOKENS',
     'NOTATION', 'CDATA', 'ENUMERATION'
   ]
+  __slots__= ('_attributeType', '_typeValues', '_defaultType')
   def __init__(self,
     ownerDocument= None, nodeName= None, attributeType= None,
     typeValues= None, defaultType= None
@@ -1997,7 +3042,7 @@ class AttributeDeclaration(NamedNode):
     self._typeValues= typeValues
     self._defaultType= defaultType
   def _cloneTo(self, node):
-    Node._cloneTo(self, node)
+    NamedNode._cloneTo(self, node)
     node._attributeType= self.attributeType
     node._typeValues= self.typeValues
     node._defaultType= self.defaultType
@@ -2031,10 +3076,11 @@ class AttributeDeclaration(NamedNode):
       attr=element.ownerDocument.createAttribute(self.nodeName)
       attr._namespaceURI= namespaceURI
       attr._prefix, attr._localName= _splitName(self.nodeName)
-    self._ownerDocument._initUserData()
-    for child in self._childNodes:
-      attr.appendChild(child.cloneNode(True))
-    self._ownerDocument._initUserData() # don't flush! should not call handlers
+    document= element._ownerDocument
+    document._initUserData()
+    for child in self._children:
+      attr.appendChild(child._recurse(True, clone= True, ownerDocument= document))
+    document._initUserData() # don't flush! should not call handlers
     element.setAttributeNodeNS(attr)
     attr._specified= False
 
@@ -2071,13 +3117,15 @@ def _Document__cloneNode(self, deep):
   self._cloneTo(doc)
   doc._ownerDocument= doc
   if deep:
-    doc._childNodes.readonly= False
     self._initUserData()
-    for child in self._childNodes:
+    children= []
+    for child in self._children:
       r= child._recurse(True, clone= True, ownerDocument=doc)
-      doc._childNodes._append(r)
+      children.append(r)
       r._containerNode= doc
-    doc._childNodes.readonly= True
+    if len(children)>0:
+      doc._children= children
+      _linkSiblings(children, 0, len(children)-1)
     self._flushUserData()
   else:
     ns, name= self.documentElement.namespaceURI, self.documentElement.nodeName
@@ -2146,13 +3194,15 @@ def _Node___recurse(self, deep, clone= False, ownerDocument= None, readonly= Non
   self._recurseTo(node, clone, ownerDocument, readonly)
 
   if deep:
-    node._childNodes.readonly= False
-    for child in self._childNodes:
+    children= []
+    for child in self._children:
       r= child._recurse(deep, clone, ownerDocument, readonly)
       if clone:
-        node._childNodes._append(r)
+        children.append(r)
         r._containerNode= node
-    node._childNodes.readonly= True
+    if len(children)>0:
+      node._children= children
+      _linkSiblings(children, 0, len(children)-1)
 
   if readonly is not None:
     node.readonly= readonly
@@ -2195,6 +3245,44 @@ def _EntityReference___recurse(self,
     r._normalize(DOMCONFIG_ENTS_BIND)
   return r
 
+def _Node___copy(self, ownerDocument):
+  """ Make an exact copy of a node with its attributes and descendants, owned
+      by the given document, for the parser to instantiate entity templates
+      and cached declarations. Unlike cloneNode, no user data handlers are
+      called, readonly flags are kept and entity references keep the children
+      they have rather than being renormalised.
+  """
+  node= self.__class__()
+  self._cloneTo(node)
+  node._ownerDocument= ownerDocument
+  node._readonly= self._readonly
+  if self._attributes is not None:
+    for attr in self._attributes._list:
+      r= attr._copy(ownerDocument)
+      node._attributes._append(r)
+      r._containerNode= node
+    node._attributes._readonly= self._attributes._readonly
+  if len(self._children)>0:
+    children= []
+    for child in self._children:
+      r= child._copy(ownerDocument)
+      children.append(r)
+      r._containerNode= node
+    node._children= children
+    _linkSiblings(children, 0, len(children)-1)
+  return node
+
+def _AttributeListDeclaration___copy(self, ownerDocument):
+  """ Attribute list declarations copy their attribute declarations too.
+  """
+  node= Node._copy(self, ownerDocument)
+  for declaration in self._declarations._list:
+    r= declaration._copy(ownerDocument)
+    node._declarations._append(r)
+    r._containerNode= node
+  node._declarations._readonly= self._declarations._readonly
+  return node
+
 def _Node___recurseTo(self, node, clone, ownerDocument, readonly):
   """ Fire off recursive operations to child nodes and attributes. May be
       extended by specific node types to send the ops to other nodes they
@@ -2221,8 +3309,10 @@ def _Element___recurseTo(self, node, clone, ownerDocument, readonly):
 
 def _DocumentType___recurseTo(self, node, clone, ownerDocument, readonly):
   """ Distribute recursive operations to the nodes in a doctype's extra
-      NamedNodeMaps.
+      NamedNodeMaps. A clone gets its own copies of any shared declarations.
   """
+  if clone:
+    self._expand()
   for mapName in ('_entities', '_notations', '_elements', '_attlists'):
     selfMap= getattr(self, mapName)
     nodeMap= getattr(node, mapName)
@@ -2236,7 +3326,7 @@ def _DocumentType___recurseTo(self, node, clone, ownerDocument, readonly):
         nodeMap._append(r)
     nodeMap._readonly= mro
 
-def _AttributeListDeclaration____recurseTo(
+def _AttributeListDeclaration___recurseTo(
   self, node, clone, ownerDocument, readonly
 ):
   """ Distribute recursive operations to attribute declaration nodes.
@@ -2250,10 +3340,14 @@ def _AttributeListDeclaration____recurseTo(
 # DOM 3 UserData
 #
 def _Node__getUserData(self, key):
+  if self._userData is None:
+    return None
   return self._userData.get(key, (None, None))[0]
 
 def _Node__setUserData(self, key, data, handler):
   oldData= self.getUserData(key)
+  if self._userData is None:
+    self._userData= {}
   self._userData[key]= (data, handler)
   return oldData
 
@@ -2266,7 +3360,7 @@ def _Node___callUserDataHandlers(self, operation, src, dst):
     The operation is added to a list per document/thread and well be flushed
     to the actual UserDataHandlers when Document._flushUserData() is called.
     """
-    if self._userData=={}:
+    if not self._userData:
         return
     callbacks= self._ownerDocument._userdatacalls[get_ident()]
     for (key, (data, handler)) in self._userData.items():
@@ -2326,7 +3420,7 @@ def _EntityReference___get_baseURI(self):
   document= self._ownerDocument
   entity= None
   if document.doctype is not None:
-    entity= document.doctype.entities.getNamedItem(self.nodeName)
+    entity= document.doctype._lookup('_entities', self.nodeName)
   if entity is not None:
     return entity._get_baseURI()
   return None
@@ -2346,7 +3440,7 @@ def _Node___getParentURI(self):
     entity= parent
   elif parent.nodeType==Node.ENTITY_REFERENCE_NODE:
     if document.doctype is not None:
-      entity= document.doctype.entities.getNamedItem(parent.nodeName)
+      entity= document.doctype._lookup('_entities', parent.nodeName)
   if entity is not None and entity._documentURI is not None:
     return entity._documentURI
   return parent.baseURI
@@ -2477,12 +3571,10 @@ def _Node__isEqualNode(self, other):
   if self.attributes is not None:
     if not self.attributes._isEqualMap(other.attributes):
       return False
-  if self.childNodes.length!=other.childNodes.length:
+  if len(self._children)!=len(other._children):
     return False
-  for index in range(self.childNodes.length):
-    if not self.childNodes.item(index).isEqualNode(
-      other.childNodes.item(index)
-    ):
+  for index in range(len(self._children)):
+    if not self._children[index].isEqualNode(other._children[index]):
       return False
   return True
 
@@ -2497,9 +3589,9 @@ def _DocumentType__isEqualNode(self, other):
   for property in ps:
     if getattr(self, property)!=getattr(other, property):
       return False
-  if not self._entities._isEqualMap(other._entities):
+  if not self.entities._isEqualMap(other.entities):
     return False
-  if not self._notations._isEqualMap(other._notations):
+  if not self.notations._isEqualMap(other.notations):
     return False
   return True
 
@@ -2579,16 +3671,16 @@ def _Node__compareDocumentPosition(self, other):
     return (
       Node.DOCUMENT_POSITION_CONTAINED_BY + Node.DOCUMENT_POSITION_FOLLOWING
     )
-  if (other_determining in container._childNodes):
-    if (self_determining in container._childNodes):
+  if (other_determining in container._children):
+    if (self_determining in container._children):
       if (
-        container._childNodes._index(other_determining) >
-        container._childNodes._index(self_determining)
+        container._children.index(other_determining) >
+        container._children.index(self_determining)
       ):
         return Node.DOCUMENT_POSITION_FOLLOWING
       return Node.DOCUMENT_POSITION_PRECEDING
     return Node.DOCUMENT_POSITION_FOLLOWING
-  if (self_determining in container._childNodes):
+  if (self_determining in container._children):
     return Node.DOCUMENT_POSITION_PRECEDING
   if other_determining.nodeType!=self_determining.nodeType:
     if other_determining.nodeType>self_determining.nodeType:
@@ -2619,12 +3711,41 @@ def _Node__compareDocumentPosition(self, other):
 # DOM 3 textual content access
 # ============================================================================
 
+def _Node___isElementContent(self, config= None):
+  """ Return whether whitespace-only text in this node would be element content
+      whitespace: whether the nearest element, looking through any entity
+      references, has element-only content. An element with no declaration
+      is taken to have ANY content unless pxdom-assume-element-content is set
+      in the config, by default the document's.
+  """
+  element= self
+  while element is not None:
+    if element.nodeType==Node.ELEMENT_NODE:
+      break
+    if element.nodeType!=Node.ENTITY_REFERENCE_NODE:
+      return False
+    element= element.parentNode
+  else:
+    return False
+
+  if config is None:
+    config= self._ownerDocument.domConfig
+  contentType= ElementDeclaration.ANY_CONTENT
+  if config._snapshot().pxdom_assume_element_content:
+    contentType= ElementDeclaration.ELEMENT_CONTENT
+  doctype= self._ownerDocument.doctype
+  if doctype is not None:
+    eldecl= doctype._lookup('_elements', element.nodeName)
+    if eldecl is not None:
+      contentType= eldecl.contentType
+  return contentType==ElementDeclaration.ELEMENT_CONTENT
+
 def _Node___set_textContent(self, value):
   if self.readonly:
     raise NoModificationAllowedErr(self, 'textContent')
   if (Node.TEXT_NODE not in self._childTypes):
     raise HierarchyRequestErr(self, Text())
-  while self._childNodes.length>0:
+  while len(self._children)>0:
     self.removeChild(self.firstChild)
   text= Text(self._ownerDocument)
   text.data= value
@@ -2649,8 +3770,7 @@ def _Notation___set_textContent(self, value):
 
 def _Node___get_textContent(self):
   value= ''
-  for index in range(self._childNodes.length):
-    child= self._childNodes.item(index)
+  for child in self._children:
     if child.nodeType not in [
       Node.COMMENT_NODE, Node.PROCESSING_INSTRUCTION_NODE
     ]:
@@ -2659,8 +3779,7 @@ def _Node___get_textContent(self):
 
 def _Attr___get_textContent(self):
   value= ''
-  for index in range(self._childNodes.length):
-    child= self._childNodes.item(index)
+  for child in self._children:
     if child.nodeType==Node.TEXT_NODE:
       value= value+child.textContent
     elif child.nodeType==Node.ENTITY_REFERENCE_NODE:
@@ -2723,6 +3842,7 @@ def _Text__replaceWholeText(self, value):
   if value=='':
     return None
   self._data= value
+  self._noteIds()
   return self
 
 def _Text___getLogicallyAdjacentTextNodes(self):
@@ -2813,30 +3933,30 @@ def _Node___normalize(self, config):
   """ Normalisation back-end. Perform a number of different normalisations on
       child nodes, in the appropriate order.
   """
-  p= config.getParameter
+  cfg= config._snapshot()
 
   # If entities are off, do a first pass replacing available entities with
   # their contents. Their contents may include other entity references so keep
   # doing this until there are no more available entity children. When
   # replacing try to preserve the baseURI.
   #
-  if not p('entities'):
+  if not cfg.entities:
     doctype=self._ownerDocument.doctype
     if doctype is not None:
       while True:
-        for child in self._childNodes._list[:]:
+        for child in list(self._children):
           if child.nodeType==Node.ENTITY_REFERENCE_NODE:
             entity= doctype.entities.getNamedItem(child.nodeName)
             if entity is not None and entity._available:
               child._normalize(DOMCONFIG_ENTS_BIND)
               child._recurse(True, readonly= False)
-              for grandchild in child.childNodes._list[:]:
+              for grandchild in list(child._children):
                 if grandchild.nodeType not in self._childTypes:
                   config._handleError(InvalidEntityForAttrErr(child, False))
                 else:
                   baseURI= grandchild.baseURI
                   self.insertBefore(grandchild, child)
-                  if config.getParameter('pxdom-preserve-base-uri'):
+                  if cfg.pxdom_preserve_base_uri:
                     if baseURI!=grandchild.baseURI:
                       if grandchild.nodeType==Node.ELEMENT_NODE:
                         baseAttr= self._ownerDocument.createAttributeNS(
@@ -2857,18 +3977,18 @@ def _Node___normalize(self, config):
 
   # Main loop. Begin by normalising the children themselves
   #
-  for child in self._childNodes._list[:]:
+  for child in list(self._children):
     child._normalize(config)
 
     # Remove comments if unwanted
     #
-    if child.nodeType==Node.COMMENT_NODE and not p('comments'):
+    if child.nodeType==Node.COMMENT_NODE and not cfg.comments:
       self.removeChild(child)
       continue
 
     # If unwanted, change CDATA sections to text nodes
     #
-    if child.nodeType==Node.CDATA_SECTION_NODE and not p('cdata-sections'):
+    if child.nodeType==Node.CDATA_SECTION_NODE and not cfg.cdata_sections:
       newChild= self.ownerDocument.createTextNode(child.data)
       self.replaceChild(newChild, child)
       child= newChild
@@ -2877,12 +3997,12 @@ def _Node___normalize(self, config):
     #
     if child.nodeType==Node.TEXT_NODE:
       if (
-        p('pxdom-normalize-text') and child.data=='' or not
-        p('element-content-whitespace') and child.isElementContentWhitespace
+        cfg.pxdom_normalize_text and child.data=='' or not
+        cfg.element_content_whitespace and child.isElementContentWhitespace
       ):
         self.removeChild(child)
         continue
-      elif p('pxdom-normalize-text'):
+      elif cfg.pxdom_normalize_text:
         previous= child.previousSibling
         if previous is not None and previous.nodeType==Node.TEXT_NODE:
           previous.data= config._cnorm(previous.data+child.data, child)
@@ -2892,10 +4012,10 @@ def _Node___normalize(self, config):
     #
     if (
       child.nodeType==Node.CDATA_SECTION_NODE
-      and p('pxdom-examine-cdata-sections')
+      and cfg.pxdom_examine_cdata_sections
       and string.find(child.data, ']]>')!=-1
     ):
-      if not config.getParameter('split-cdata-sections'):
+      if not cfg.split_cdata_sections:
         config._handleError(WfInvalidCharacterErr(child))
       else:
         datas= string.split(child.data, ']]>')
@@ -2910,11 +4030,8 @@ def _Node___normalize(self, config):
 
 
   # Some forms of normalisation might require NodeListByTagNames recalculated.
-  # Don't bother bounce up to parents as with the normal _changed() method, as
-  # they will already know about the normalization, but make sure our own
-  # change count is updated.
   #
-  self._sequence= self._sequence+1
+  self._changed()
 
 
 def _NamedNode___normalize(self, config):
@@ -2931,8 +4048,11 @@ def _NamedNode___normalize(self, config):
 def _NamedNodeNS___normalize(self, config):
   """ Additional normalisations required by namespace-aware nodes.
   """
+  cfg= config._snapshot()
+
   # Character-normalise name parts.
   #
+  name= (self._namespaceURI, self._prefix, self._localName)
   self._localName= config._cnorm(self._localName, self)
   if self._prefix is not None:
     self._prefix= config._cnorm(self._prefix, self)
@@ -2940,7 +4060,7 @@ def _NamedNodeNS___normalize(self, config):
   # Generate a warning (but with ERROR severity due to spec) if Level 1 nodes
   # are encountered.
   #
-  if config.getParameter('namespaces') and self._namespaceURI is NONS:
+  if cfg.namespaces and self._namespaceURI is NONS:
     config._handleError(Level1NodeErr(self))
 
   Node._normalize(self, config)
@@ -2949,11 +4069,13 @@ def _NamedNodeNS___normalize(self, config):
   # unbound) see if we've inherited an in-scope namespace from outside that
   # might bind it up
   #
-  if config.getParameter('pxdom-fix-unbound-namespaces'):
+  if cfg.pxdom_fix_unbound_namespaces:
     if self._namespaceURI is None and self._containerNode is not None:
       self._namespaceURI= self._containerNode._getNamespaces(
         {}
       ).get(self._prefix, None)
+  if name!=(self._namespaceURI, self._prefix, self._localName):
+    self._renamed()
 
 
 def _Element___normalize(self, config):
@@ -2961,18 +4083,22 @@ def _Element___normalize(self, config):
       normalisations, may need to add namespace declarations make it
       namespace-well-formed, and normalise or remove some attributes.
   """
+  cfg= config._snapshot()
+
   # Normalise element and each attribute name, reordered if in canonical-form
   # mode
   #
   NamedNodeNS._normalize(self, config)
   for attr in self._attributes:
     attr._normalize(config)
-  if config.getParameter('canonical-form'):
+  if cfg.canonical_form:
     self._attributes._list.sort(_canonicalAttrSort)
+    if self._attributes._index is not None:
+      self._attributes._rehash()
 
   # Fix element, attributes namespaces in place
   #
-  if config.getParameter('namespaces'):
+  if cfg.namespaces:
     create, reprefix= self._getFixups(
       self._getNamespaces(FIXEDNS.copy(), ignoreSelf= True)
     )
@@ -2983,19 +4109,20 @@ def _Element___normalize(self, config):
       self.setAttributeNS(NSNS, name, namespaceURI or '')
     for attr, prefix in reprefix:
       attr._prefix= prefix
+      attr._renamed()
 
   # Remove any namespace declarations that are redundant in canonical-form
   # mode, or all of them if namespace-declarations is off
   #
-  if config.getParameter('canonical-form'):
+  if cfg.canonical_form:
     nsframe= {}
     if self._containerNode is not None:
       nsframe= self._containerNode._getNamespaces({})
   for attr in self.attributes._list[:]:
     if attr.namespaceURI==NSNS:
-      if not config.getParameter('namespace-declarations'):
+      if not cfg.namespace_declarations:
         self.removeAttributeNode(attr)
-      elif config.getParameter('canonical-form'):
+      elif cfg.canonical_form:
         prefix= [attr.localName, None][attr.prefix is None]
         namespaceURI= nsframe.get(prefix, None) or ''
         if attr.value==namespaceURI:
@@ -3005,22 +4132,27 @@ def _Element___normalize(self, config):
 def _Attr___normalize(self, config):
   """ Normalisation for attributes. User-determined isIDness is discarded.
   """
+  cfg= config._snapshot()
   NamedNodeNS._normalize(self, config)
-  if config.getParameter('pxdom-reset-identity'):
+  if cfg.pxdom_reset_identity:
     self._isId= False
 
 def _CharacterData___normalize(self, config):
   """ Normalisation for text-based nodes. Only need to normalise characters.
   """
   Node._normalize(self, config)
-  self._data= config._cnorm(self._data, self)
+  data= config._cnorm(self._data, self)
+  if data!=self._data:
+    self._data= data
+    self._noteIds()
 
 
 def _Comment___normalize(self, config):
   """ Normalisations for comment nodes. Only need to check well-formedness.
   """
+  cfg= config._snapshot()
   CharacterData._normalize(self, config)
-  if config.getParameter('well-formed') and (
+  if cfg.well_formed and (
     self._data[-1:]=='-' or string.find(self._data, '--')!=-1
   ):
     config._handleError(WfInvalidCharacterErr(self))
@@ -3029,8 +4161,9 @@ def _Comment___normalize(self, config):
 def _ProcessingInstruction___normalize(self, config):
   """ Normalisations for PI nodes. Only need to check well-formedness.
   """
+  cfg= config._snapshot()
   NamedNode._normalize(self, config)
-  if config.getParameter('well-formed') and string.find(self._data, '?>')!=-1:
+  if cfg.well_formed and string.find(self._data, '?>')!=-1:
     config._handleError(WfInvalidCharacterErr(self))
 
 
@@ -3038,19 +4171,20 @@ def _EntityReference___normalize(self, config):
   """ Normalisations for entity references. Remove any child nodes and replace
       them with up-to-date replacement nodes from the doctype's entity list.
   """
-  if config.getParameter('pxdom-update-entities'):
+  cfg= config._snapshot()
+  if cfg.pxdom_update_entities:
     self._readonly= False
 
-    while self._childNodes.length>0:
-      self.removeChild(self._childNodes.item(0))
+    while len(self._children)>0:
+      self.removeChild(self._children[0])
     if self._ownerDocument.doctype:
       entity=self._ownerDocument.doctype.entities.getNamedItem(self.nodeName)
       if entity is not None:
-        for child in entity.childNodes:
+        for child in entity._children:
           clone= child._recurse(True, clone= True, readonly= False)
           self.appendChild(clone)
 
-    bind= config.getParameter('pxdom-fix-unbound-namespaces')
+    bind= cfg.pxdom_fix_unbound_namespaces
     config.setParameter('pxdom-fix-unbound-namespaces', True)
     try:
       NamedNode._normalize(self, config)
@@ -3065,11 +4199,13 @@ def _EntityReference___normalize(self, config):
 def _DOMImplementation__createLSParser(
   self, mode= DOMImplementation.MODE_SYNCHRONOUS, schemaType= None
 ):
-  if mode!=DOMImplementation.MODE_SYNCHRONOUS:
+  if mode not in (
+    DOMImplementation.MODE_SYNCHRONOUS, DOMImplementation.MODE_ASYNCHRONOUS
+  ) or mode==DOMImplementation.MODE_ASYNCHRONOUS and threading is None:
     raise NotSupportedErr(self, 'createLSParser.mode')
   if schemaType is not None and schemaType!=DTNS:
     raise NotSupportedErr(self, 'createLSParser.schemaType')
-  return LSParser()
+  return LSParser(None, mode)
 
 def _DOMImplementation__createLSInput(self):
   return LSInput()
@@ -3124,14 +4260,22 @@ class InputBuffer:
   """ Wrapper for reading from an LSInput (or user object implementing this
       interface) or other resource with possible encoding change if an XML
       declaration is encountered.
+
+      The input is read and decoded a chunk at a time, as the parser asks for
+      more of it. A document's buffer, which is only read through once, can
+      also release the text the parser has finished with, so that its size
+      depends on the largest token rather than on the size of the input.
   """
+  _CHARCHUNK= 16384
+
   def __init__(self, input, offset, config, isDocument):
     self.config= config
     charsetCertain= config.getParameter('charset-overrides-xml-encoding')
     checkMT= isDocument and config.getParameter('supported-media-types-only')
 
-    # URI of input source
+    # Input source, and its URI
     #
+    self.input= input
     self.uri= None
     if input.systemId is not None:
       self.uri= _encodeURI(input.systemId)
@@ -3144,7 +4288,27 @@ class InputBuffer:
     #
     self.bytes= None
     self.encoding= None
-    self.chars= None
+    self.chars= ''
+
+    # Stream still being read from (None once it is exhausted), whether it
+    # gives bytes to be decoded, and the decoder for them. A carriage return
+    # at the end of a chunk is held back until we know whether a line feed
+    # follows. Once the encoding is settled, new text is checked for invalid
+    # characters as it is read.
+    #
+    self.stream= None
+    self.isBytes= False
+    self.closeStream= False
+    self.decoder= None
+    self.cr= ''
+    self.started= False
+    self.checking= False
+
+    # Amount read from the stream so far, and in total if known, in the same
+    # units (bytes or chars) as the stream gives, for progress reporting.
+    #
+    self.position= 0
+    self.totalSize= 0
 
     # Whilst parsing, keep pointer into character data. Keep an offset into
     # data from uri so that we can know what the 'real' index was when dealing
@@ -3153,20 +4317,24 @@ class InputBuffer:
     #
     self.offset= offset
     self.parent= None
+    self.streaming= isDocument
     self.reset()
+    self._clearLines()
 
-    # Read data from the input source as characters or bytes. If we come out
-    # of this with bytes and an encoding, that encoding's certainty is
-    # dependent on the charset-overrides-xml-encoding parameter.
+    # Find the stream to read data from the input source as characters or
+    # bytes. If we come out of this with bytes and an encoding, that
+    # encoding's certainty is dependent on the charset-overrides-xml-encoding
+    # parameter.
     #
     if input.characterStream is not None:
-      self.chars= input.characterStream.read()
+      self.stream= input.characterStream
       if unicode is not None:
         self.encoding= 'utf-16'
       else:
         self.encoding= 'utf-8'
     elif input.byteStream is not None:
-      self.bytes= input.byteStream.read()
+      self.stream= input.byteStream
+      self.isBytes= True
     elif input.stringData not in (None, ''):
 
       # Hack. Allow string data to be a blank string by hiding it in a tuple.
@@ -3178,11 +4346,12 @@ class InputBuffer:
 
       # Treat stringData as bytes if it's a narrow string, or chars in Unicode
       #
+      self.stream= StringIO.StringIO(data)
+      self.totalSize= len(data)
       if isinstance(data, Unicode):
-        self.chars= data
         self.encoding= 'utf-16'
       else:
-        self.bytes= data
+        self.isBytes= True
         self.encoding= 'utf-8'
 
     elif self.uri is not None:
@@ -3195,89 +4364,234 @@ class InputBuffer:
         if contentType not in XMLTYPES and contentType[-4:]!='+xml':
           self.config._handleError(UnsupportedMediaTypeErr(None))
       self.encoding= stream.info().getparam('charset')
-      self.bytes= stream.read()
-      stream.close()
+      self.stream= stream
+      self.isBytes= True
+      self.closeStream= True
+      try:
+        self.totalSize= int(stream.info().getheader('content-length'))
+      except (TypeError, ValueError):
+        pass
     else:
       self.config._handleError(NoInputErr(None))
 
-    # If we have bytes, attempt to convert them to characters. If we are
-    # certain of the encoding, drop the original bytes on the floor.
+    # Read the first chunk. If we have bytes, attempt to convert them to
+    # characters. If we are certain of the encoding, don't keep the original
+    # bytes in case they have to be decoded again.
     #
-    if self.chars is None:
+    if self.isBytes:
+      data= self._readStream(self._CHARCHUNK)
+      while len(data)<2 and self.stream is not None:
+        data= data+self._readStream(self._CHARCHUNK)
       certain= self.encoding is not None and charsetCertain
       if self.encoding is None:
-        if self.bytes[:2] in ('\xff\xfe', '\xfe\xff'):
+        if data[:2] in ('\xff\xfe', '\xfe\xff'):
           self.encoding= 'utf-16'
         else:
           self.encoding= 'utf-8'
-      self.decode(True)
-      if certain:
-        self.bytes= None
+      if not certain:
+        self.bytes= data
+      self._setDecoder(data)
+      self._decode(data)
     else:
-      self.decode(False)
+      self._decode(self._readStream(self._CHARCHUNK))
 
   def setEncoding(self, xmlEncoding= None):
     """ Finished checking for encoding in possible XML declaration. If we were
         uncertain about the character encoding to use before, update the chars
-        from the bytes again with the new encoding.
+        from the bytes again with the new encoding. From now on, check for
+        invalid characters.
     """
     if self.bytes is not None:
       if xmlEncoding is not None and xmlEncoding!=self.encoding:
         self.encoding= xmlEncoding
-        self.decode(True)
+        self._setDecoder(self.bytes)
+        self.chars= ''
+        self.cr= ''
+        self.started= False
+        self._clearLines()
+        self._decode(self.bytes)
       self.bytes= None
-    for ch in NOTCHAR:
-      if ch in self.chars:
-        self.index= string.find(self.chars, ch)
-        self.config._handleError(ParseErr(self,'Invalid chr '+hex(ord(ch))))
-    if isinstance(self.chars, Unicode):
-      for ch in NOTCHARU:
-        if ch in self.chars:
-          self.index= string.find(self.chars, ch)
-          self.config._handleError(ParseErr(self,'Invalid chr '+hex(ord(ch))))
-
-  def decode(self, fromBytes= True):
-    """ Take input from chars or bytes (decoding through encoding property),
-        send result with normalised newlines and no BOM.
+    self.checking= True
+    self._check(self.chars, 0)
+
+  def _readStream(self, size):
+    """ Read the next piece of the underlying stream, noting when it is
+        exhausted. Without incremental decoders, bytes must be read all at
+        once.
     """
-    if fromBytes:
-      if unicode is not None:
-        try:
-          codec= codecs.lookup(self.encoding)
-        except LookupError:
-          self.config._handleError(UnsupportedEncodingErr(None))
-        if codec==codecs.lookup('utf-16'):
-          if self.bytes[:2]=='\xff\xfe':
-            self.encoding= 'utf-16le'
-          elif self.bytes[:2]=='\xfe\xff':
-            self.encoding= 'utf-16be'
-        self.chars= unicode(self.bytes, self.encoding, 'replace')
+    if self.stream is None:
+      return ''
+    if self.isBytes and unicode is not None and not INCREMENTAL:
+      data= self.stream.read()
+    else:
+      data= self.stream.read(size)
+    self.position= self.position+len(data)
+    if not data:
+      if self.closeStream:
+        self.stream.close()
+      self.stream= None
+      data= ''
+    return data
+
+  def _setDecoder(self, data):
+    """ Make a decoder for the current encoding, given the first bytes.
+    """
+    if self.isBytes and unicode is not None:
+      try:
+        codec= codecs.lookup(self.encoding)
+      except LookupError:
+        self.config._handleError(UnsupportedEncodingErr(None))
+      if codec==codecs.lookup('utf-16'):
+        if data[:2]=='\xff\xfe':
+          self.encoding= 'utf-16le'
+        elif data[:2]=='\xfe\xff':
+          self.encoding= 'utf-16be'
+      if INCREMENTAL:
+        self.decoder= codecs.getincrementaldecoder(self.encoding)('replace')
+
+  def _decode(self, data):
+    """ Take a chunk of input as chars or bytes (decoding through encoding
+        property), add result with normalised newlines and no BOM to chars.
+    """
+    final= self.stream is None
+    if self.isBytes and unicode is not None:
+      if self.decoder is not None:
+        chars= self.decoder.decode(data, final)
       else:
-        self.chars= self.bytes
-    for ls in LS:
-      self.chars= r(self.chars, ls, '\n')
-    if isinstance(self.chars, Unicode):
-      for ls in LSU:
-        self.chars= r(self.chars, ls, '\n')
-      if self.chars[:1]==unichr(0xFEFF):
-        self.chars= self.chars[1:]
+        chars= unicode(data, self.encoding, 'replace')
+    else:
+      chars= data
+    chars= self.cr+chars
+    self.cr= ''
+    if not final and chars[-1:]=='\r':
+      self.cr= chars[-1:]
+      chars= chars[:-1]
+
+    # Usually a chunk has no line endings other than LF and no invalid
+    # characters, which one search for any of them establishes. Otherwise
+    # replace only the line endings that are present.
+    #
+    isU= isinstance(chars, Unicode)
+    special= SPECIALS[isU].search(chars) is not None
+    if special:
+      if '\r' in chars:
+        chars= r(r(chars, '\r\n', '\n'), '\r', '\n')
+      if isU:
+        for ls in LSU:
+          if ls in chars:
+            chars= r(chars, ls, '\n')
+    if isU and not self.started and chars[:1]==unichr(0xFEFF):
+      chars= chars[1:]
+    if chars!='':
+      self.started= True
+      start= len(self.chars)
+      self.chars= self.chars+chars
+      if self.checking and special:
+        self._check(chars, start)
+
+  def _check(self, chars, start):
+    """ Check chars, read in at a given index, for invalid characters.
+    """
+    pattern= NOTCHARS[isinstance(chars, Unicode)]
+    match= pattern.search(chars)
+    while match is not None:
+      self.index= start+match.start()
+      char= match.group()
+      self.config._handleError(ParseErr(self, 'Invalid chr '+hex(ord(char))))
+      match= pattern.search(chars, match.end())
+
+  def read(self):
+    """ Read and decode another chunk of input onto the end of chars. Return
+        False if the input has all been read already. Chunks get bigger as
+        the unread part of chars does, so reading a long token takes only a
+        few reads.
+    """
+    if self.stream is None:
+      return False
+    data= self._readStream(max(self._CHARCHUNK, len(self.chars)-self.index))
+    if self.bytes is not None:
+      self.bytes= self.bytes+data
+    self._decode(data)
+    return True
+
+  def need(self, count):
+    """ Read until there are at least a given number of chars after the
+        current index, if the input is that long. Return whether there are.
+    """
+    while len(self.chars)-self.index<count:
+      if not self.read():
+        return False
+    return True
+
+  def release(self):
+    """ Throw away the text before the current index, if this buffer is only
+        read through once. Only done after a chunk's worth has built up, to
+        keep down the cost of copying what is left.
+    """
+    if self.streaming and self.index>=self._CHARCHUNK:
+      self._dropLines(self.index)
+      self.chars= self.chars[self.index:]
+      self.index= 0
+
+  # Line table. The index in chars of the start of each line is recorded, up
+  # to the scanned index, the first time a location is asked for past the
+  # lines already known. After that finding the line and column of any index
+  # is a binary search. lineCount and lineStart give the number of lines, and
+  # the index the current line started at, before the start of chars.
+  #
+  def _clearLines(self):
+    self.lines= []
+    self.scanned= 0
+    self.lineCount= 0
+    self.lineStart= 0
+
+  def _scanLines(self):
+    """ Add the lines in chars not yet scanned to the line table.
+    """
+    chars= self.chars
+    lines= self.lines
+    index= string.find(chars, '\n', self.scanned)
+    while index!=-1:
+      index= index+1
+      lines.append(index)
+      index= string.find(chars, '\n', index)
+    self.scanned= len(chars)
+
+  def _dropLines(self, index):
+    """ Count the lines before an index into chars which is about to become
+        the start of chars, and take them out of the line table.
+    """
+    count= bisect_right(self.lines, index)
+    if count>0:
+      start= self.lines[count-1]
+    else:
+      start= self.lineStart
+    lines= self.lines[count:]
+    if self.scanned<index:
+      newlines= string.count(self.chars, '\n', self.scanned, index)
+      if newlines>0:
+        count= count+newlines
+        start= string.rfind(self.chars, '\n', self.scanned, index)+1
+      self.scanned= index
+    self.lines= map(lambda line, index= index: line-index, lines)
+    self.scanned= self.scanned-index
+    self.lineCount= self.lineCount+count
+    self.lineStart= start-index
 
   def getLocation(self):
     """ Return (line, column) position corresponding to the current index.
     """
-    # Get (line, col) position relative to start of entity, caching the
-    # calculated location for the given index to reduce the amount of
-    # string to search through next time
+    # Get (line, col) position relative to start of entity from the line
+    # table
     #
-    line= string.count(self.chars, '\n', self.cIndex, self.index)
-    if line==0:
-      line= self.cLocation[0]
-      col= self.cLocation[1]+self.index-self.cIndex
+    if self.scanned<self.index:
+      self._scanLines()
+    count= bisect_right(self.lines, self.index)
+    line= self.lineCount+count
+    if count>0:
+      col= self.index-self.lines[count-1]
     else:
-      line= self.cLocation[0]+line
-      col= self.index-string.rfind(self.chars, '\n', self.cIndex,self.index)-1
-    self.cLocation= (line, col)
-    self.cIndex= self.index
+      col= self.index-self.lineStart
 
     # Return the relative-index added to the entity offset. (1-based)
     #
@@ -3293,8 +4607,6 @@ class InputBuffer:
         allow it to be read again.
     """
     self.index= 0
-    self.cIndex= 0
-    self.cLocation= (0, 0)
 
   def swallow(self):
     """ Throw away any previously-parsed part of this buffer.
@@ -3303,6 +4615,21 @@ class InputBuffer:
       self.offset= self.getLocation()
       self.chars= self.chars[self.index:]
       self.index= 0
+      self._clearLines()
+
+  def copy(self, config):
+    """ Make a buffer over the same text for another parse, with its own
+        configuration, to read from. This buffer must have been read through
+        to the end of its input.
+    """
+    buffer= copy.copy(self)
+    buffer.config= config
+    buffer.input= None
+    buffer.decoder= None
+    buffer.parent= None
+    buffer.reset()
+    buffer._clearLines()
+    return buffer
 
 
 # Convenience method for parsers to get an InputBuffer object for a resource
@@ -3324,6 +4651,218 @@ def _DOMConfiguration___resolveResource(self, publicId, systemId, baseURI):
   return InputBuffer(input, (1, 1), self, False)
 
 
+# The NONS singleton is compared by identity, so a pickled cache refers to it
+# by name rather than storing a copy.
+#
+def _persistentId(obj):
+  if obj is NONS:
+    return 'NONS'
+  return None
+def _persistentLoad(pid):
+  if pid=='NONS':
+    return NONS
+  raise pickle.UnpicklingError('unknown persistent id %s' % pid)
+
+def _dumps(obj):
+  file= StringIO.StringIO()
+  pickler= pickle.Pickler(file, PICKLE_PROTOCOL)
+  pickler.persistent_id= _persistentId
+  pickler.dump(obj)
+  return file.getvalue()
+
+def _loads(data):
+  unpickler= pickle.Unpickler(StringIO.StringIO(data))
+  unpickler.persistent_load= _persistentLoad
+  return unpickler.load()
+
+class DTDCache(DOMObject):
+  """ Store of the declarations read from external DTD subsets. A parser with
+      one as its pxdom-dtd-cache parameter takes the declarations from it
+      instead of fetching and parsing a subset again. Once more than 'size'
+      subsets are stored the least recently used are dropped. Given a 'path',
+      the store is read from that file, and written back to it by save() and
+      after every few subsets added. Can be shared between parsers and threads.
+  """
+  _VERSION= 2
+  _SAVE_AFTER= 16
+  def __init__(self, size= 64, path= None):
+    DOMObject.__init__(self)
+    self._size= size
+    self._path= path
+    self._entries= {}
+    self._order= []
+    self._hits= 0
+    self._misses= 0
+    self._unsaved= 0
+    self._lock= _Lock()
+    self._saving= _Lock()
+    if path is not None:
+      self._load()
+
+  def _get_size(self):
+    return self._size
+  def _get_path(self):
+    return self._path
+  def _get_length(self):
+    return len(self._order)
+  def _get_hits(self):
+    return self._hits
+  def _get_misses(self):
+    return self._misses
+  def _set_size(self, value):
+    self._lock.acquire()
+    try:
+      self._size= value
+      self._evict()
+    finally:
+      self._lock.release()
+
+  def clear(self):
+    """ Drop all the stored subsets and reset the counters.
+    """
+    self._lock.acquire()
+    try:
+      self._entries= {}
+      self._order= []
+      self._hits= 0
+      self._misses= 0
+      self._unsaved= self._unsaved+1
+    finally:
+      self._lock.release()
+
+  def save(self):
+    """ Write the stored subsets to the cache's file, if any were added since
+        it was last read or written. The file is written under a new name and
+        renamed over the old, so that other processes never read it
+        half-written; one thread saves at a time.
+    """
+    if self._path is None:
+      return
+    self._saving.acquire()
+    try:
+      self._lock.acquire()
+      try:
+        if self._unsaved==0:
+          return
+        entries= map(lambda key, e= self._entries: (key, e[key]), self._order)
+        unsaved= self._unsaved
+        self._unsaved= 0
+      finally:
+        self._lock.release()
+      try:
+        self._write(entries)
+      except:
+        self._lock.acquire()
+        self._unsaved= self._unsaved+unsaved
+        self._lock.release()
+        raise
+    finally:
+      self._saving.release()
+
+  def _write(self, entries):
+    directory, name= os.path.split(os.path.abspath(self._path))
+    fd, temp= tempfile.mkstemp('.tmp', name+'.', directory)
+    try:
+      file= os.fdopen(fd, 'wb')
+      try:
+        pickler= pickle.Pickler(file, PICKLE_PROTOCOL)
+        pickler.persistent_id= _persistentId
+        pickler.dump((self._VERSION, entries))
+      finally:
+        file.close()
+      os.rename(temp, self._path)
+    except:
+      try:
+        os.remove(temp)
+      except OSError:
+        pass
+      raise
+
+  def _load(self):
+    """ Read stored subsets from the cache's file, if there is one written by
+        this version of the cache. Unpickling can run any code, so a file that
+        others could have written is ignored; so is one that can't be read.
+    """
+    try:
+      file= open(self._path, 'rb')
+    except IOError:
+      return
+    try:
+      if not self._isPrivate(file):
+        return
+      try:
+        unpickler= pickle.Unpickler(file)
+        unpickler.persistent_load= _persistentLoad
+        version, entries= unpickler.load()
+        if version!=self._VERSION:
+          return
+        loaded= {}
+        order= []
+        for key, (record, buffers) in entries:
+          if not isinstance(record, DocumentType) or type(buffers)!=type({}):
+            return
+          if not loaded.has_key(key):
+            order.append(key)
+          loaded[key]= (record, buffers)
+      except Exception:
+        return
+    finally:
+      file.close()
+    self._entries= loaded
+    self._order= order
+    self._evict()
+
+  def _isPrivate(self, file):
+    """ Check the cache's file belongs to this user and only they can write
+        it, where the OS has users.
+    """
+    if not hasattr(os, 'getuid'):
+      return True
+    info= os.fstat(file.fileno())
+    return info.st_uid==os.getuid() and info.st_mode & 022==0
+
+  def _evict(self):
+    while len(self._order)>self._size:
+      del self._entries[self._order[0]]
+      del self._order[0]
+
+  # Lookup and storage for parsers. An entry is a DocumentType owned by no
+  # document holding the declarations, and a dictionary of the InputBuffers
+  # of the entities they declared.
+  #
+  def _get(self, key):
+    self._lock.acquire()
+    try:
+      entry= self._entries.get(key)
+      if entry is None:
+        self._misses= self._misses+1
+      else:
+        self._hits= self._hits+1
+        self._order.remove(key)
+        self._order.append(key)
+    finally:
+      self._lock.release()
+    return entry
+
+  def _put(self, key, entry):
+    self._lock.acquire()
+    try:
+      if self._entries.has_key(key):
+        self._order.remove(key)
+      self._entries[key]= entry
+      self._order.append(key)
+      self._evict()
+      self._unsaved= self._unsaved+1
+      due= self._path is not None and self._unsaved>=self._SAVE_AFTER
+    finally:
+      self._lock.release()
+    if due:
+      try:
+        self.save()
+      except (IOError, OSError):
+        pass
+
+
 class NodeFilter(DOMObject):
   [
     SHOW_ELEMENT,SHOW_ATTRIBUTE,SHOW_TEXT,SHOW_CDATA_SECTION,
@@ -3370,19 +4909,169 @@ class LSFilterInterrupt(Exception):
   pass
 
 
+class _LSEvent(DOMObject):
+  """ Base for the events an LSParser dispatches to its listeners. They are
+      only dispatched at the parser itself, and cannot be cancelled.
+  """
+  [CAPTURING_PHASE, AT_TARGET, BUBBLING_PHASE]= range(1, 4)
+  def __init__(self, type, input):
+    DOMObject.__init__(self)
+    self._type= type
+    self._input= input
+    self._target= None
+    self._currentTarget= None
+    self._timeStamp= long(time.time()*1000)
+  def _get_type(self): return self._type
+  def _get_target(self): return self._target
+  def _get_currentTarget(self): return self._currentTarget
+  def _get_eventPhase(self): return self.AT_TARGET
+  def _get_bubbles(self): return False
+  def _get_cancelable(self): return False
+  def _get_timeStamp(self): return self._timeStamp
+  def _get_input(self): return self._input
+  def stopPropagation(self):
+    pass
+  def preventDefault(self):
+    pass
+
+class LSLoadEvent(_LSEvent):
+  """ Event signalling the end of an asynchronous parse, successful or not.
+  """
+  def __init__(self, input, newDocument):
+    _LSEvent.__init__(self, 'load', input)
+    self._newDocument= newDocument
+  def _get_newDocument(self): return self._newDocument
+
+class LSProgressEvent(_LSEvent):
+  """ Event signalling that more of a document has been read. position and
+      totalSize are counted in bytes, or characters for character input;
+      totalSize is 0 if not known. pxdomNodes is the number of nodes the
+      parser has added so far.
+  """
+  def __init__(self, input, position, totalSize, nodes):
+    _LSEvent.__init__(self, 'progress', input)
+    self._position= position
+    self._totalSize= totalSize
+    self._pxdomNodes= nodes
+  def _get_position(self): return self._position
+  def _get_totalSize(self): return self._totalSize
+  def _get_pxdomNodes(self): return self._pxdomNodes
+
+
+class _NeedMore(Exception):
+  """ Exception raised when a fed document has no more input yet, causing the
+      parser to go back to the start of the current item and wait for more.
+  """
+  pass
+
+
+class _FeedStream:
+  """ Stream of the pieces of a document given to LSParser.pxdomFeed, read by
+      its InputBuffer. Reading past the pieces so far raises _NeedMore, until
+      the stream is closed.
+  """
+  def __init__(self):
+    self.pieces= []
+    self.length= 0
+    self.closed= False
+
+  def write(self, data):
+    if data:
+      self.pieces.append(data)
+      self.length= self.length+len(data)
+
+  def close(self):
+    self.closed= True
+
+  def read(self, size= -1):
+    if not self.closed and (self.length==0 or size<0):
+      raise _NeedMore()
+    data= string.join(self.pieces, '')
+    if size<0 or size>=len(data):
+      self.pieces= []
+    else:
+      data, rest= data[:size], data[size:]
+      self.pieces= [rest]
+    self.length= self.length-len(data)
+    return data
+
+
+class _PullStream:
+  """ Wrapper for the stream of a document read through LSParser.pxdomEvents.
+      Reading lets one chunk through each time ready is set, otherwise raises
+      _NeedMore so the parser stops to hand back the events so far.
+  """
+  def __init__(self, stream):
+    self.stream= stream
+    self.ready= False
+
+  def read(self, size= -1):
+    if not self.ready:
+      raise _NeedMore()
+    self.ready= False
+    return self.stream.read(size)
+
+  def close(self):
+    self.stream.close()
+
+
+class _EventReader:
+  """ Iterator over the (event, node) pairs of a document being parsed by
+      LSParser.pxdomEvents. Events are handed on from the parser a chunk's
+      worth at a time, and not kept once they have been returned.
+  """
+  def __init__(self, parser, stream, document):
+    self._parser= parser
+    self._stream= stream
+    self._events= []
+    self._index= 0
+    self.document= document
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    parser= self._parser
+    if parser is not None and parser._feed is not self._stream:
+      self._parser= None
+      self._events= []
+      self._index= 0
+    while self._index==len(self._events):
+      if self._parser is None:
+        raise StopIteration
+      self._events= []
+      self._index= 0
+      if self._parser._pullParse(self._events):
+        self._parser= None
+    event= self._events[self._index]
+    self._events[self._index]= None
+    self._index= self._index+1
+    return event
+
+  def __getitem__(self, index):
+    try:
+      return self.next()
+    except StopIteration:
+      raise IndexError(index)
+
+
 class LSParser(DOMObject):
   """ DOM Level 3 LS  XML parser.
   """
   [ACTION_APPEND_AS_CHILDREN,ACTION_REPLACE_CHILDREN,ACTION_INSERT_BEFORE,
   ACTION_INSERT_AFTER,ACTION_REPLACE
   ]= range(1, 6)
-  _CHARCHUNK= 1024
-  def __init__(self, config= None):
+  def __init__(self, config= None, mode= DOMImplementation.MODE_SYNCHRONOUS):
     DOMObject.__init__(self)
     if config is None:
       config= ParserConfiguration()
     self._domConfig= config
     self._filter= None
+    self._async= mode==DOMImplementation.MODE_ASYNCHRONOUS
+    self._listeners= {}
+    self._lock= _Lock()
+    self._contexts= []
+    self._feeding= None
   def _get_domConfig(self):
     return self._domConfig
   def _get_filter(self):
@@ -3390,17 +5079,35 @@ class LSParser(DOMObject):
   def _set_filter(self, value):
     self._filter= value
   def _get_async(self):
-    return False
+    return self._async
   def _get_busy(self):
-    return False
+    return len(self._contexts)>0 or self._feeding is not None
+
   def abort(self):
-    pass
+    """ Stop the parses in progress at the next item of content. A synchronous
+        parse returns what it has so far, as if interrupted by a filter; an
+        asynchronous one gives a null newDocument in its load event.
+    """
+    self._lock.acquire()
+    try:
+      for context in self._contexts:
+        context._aborting= True
+      feeding= self._feeding
+      if feeding in self._contexts:
+        feeding= None
+    finally:
+      self._lock.release()
+    if feeding is not None:
+      feeding._stopFeed()
 
   # Standard public parse interfaces
   #
   def parse(self, input):
     """ Parse complete document from an InputSource.
     """
+    if self._async:
+      self._startAsync(input)
+      return None
     document= Document()
     self.pxdomParseBefore(input, document, None)
     return document
@@ -3410,9 +5117,7 @@ class LSParser(DOMObject):
     """
     input= LSInput()
     input.systemId= uri
-    document= Document()
-    self.pxdomParseBefore(input, document, None)
-    return document
+    return self.parse(input)
     
   def parseWithContext(self, input, contextArg, action):
     """ Parse a fragment of document (pxdom interprets this as being the
@@ -3422,6 +5127,13 @@ class LSParser(DOMObject):
     # Find the node that will contain the new content, either the contextArg
     # or, for certain actions, its parent. Check it can receive content.
     #
+    context= self._context('parseWithContext', get_ident())
+    try:
+      return context._parseWithContext(input, contextArg, action)
+    finally:
+      self._leave(context)
+
+  def _parseWithContext(self, input, contextArg, action):
     pnode= [contextArg.parentNode, contextArg][action in (
       LSParser.ACTION_APPEND_AS_CHILDREN, LSParser.ACTION_REPLACE_CHILDREN
     )]
@@ -3447,8 +5159,8 @@ class LSParser(DOMObject):
     if action==LSParser.ACTION_REPLACE:
       parentNode.removeChild(contextArg)
     elif action==LSParser.ACTION_REPLACE_CHILDREN:
-      while contextArg.childNodes.length>0:
-        contextArg.removeChild(contextArg.childNodes.item(0))
+      while len(contextArg._children)>0:
+        contextArg.removeChild(contextArg._children[0])
 
     if nextSibling is None:
       previousSibling= parentNode.lastChild
@@ -3458,12 +5170,8 @@ class LSParser(DOMObject):
     # Mysteriously, according to spec, whitespace removal shouldn't work in
     # parseWithContext.
     #
-    ws= self._domConfig.getParameter('element-content-whitespace')
     self._domConfig.setParameter('element-content-whitespace', True)
-    try:
-      self.pxdomParseBefore(input, parentNode, nextSibling)
-    finally:
-      self._domConfig.setParameter('element-content-whitespace', ws)
+    self._parseBefore(input, parentNode, nextSibling)
 
     # Return the first generated node (if there was one)
     #
@@ -3483,74 +5191,391 @@ class LSParser(DOMObject):
     node.insertBefore. (A slightly saner interface than the parseWithContext
     call uses.)
     """
-    p= self._domConfig.getParameter
+    context= self._context('pxdomParseBefore', get_ident())
+    try:
+      context._parseBefore(input, parentNode, refChild)
+    finally:
+      self._leave(context)
 
-    # Entity state: lookups for parameter and general entities, pointing to
-    # InputBuffers for each; list of entity nesting depth to detect circular
-    # entity definitions.
-    #
-    self._parameterEntities= self._generalEntities= {}
-    self._entityNest= []
-    self._dofilter= True
+  def _parseBefore(self, input, parentNode, refChild):
 
     # If the input source is certified, ignore normalisation options
     #
     if input.certifiedText:
-      nc= p('normalize-characters')
-      ccn= p('check-character-normalization')
       self._domConfig.setParameter('normalize-characters', False)
       self._domConfig.setParameter('check-character-normalization', False)
-    try:
 
-      # Dispatch into internal node parsing interfaces
-      #
-      namespaces= parentNode._getNamespaces(FIXEDNS.copy())
-      self._queue= ''
+    # Dispatch into internal node parsing interfaces
+    #
+    namespaces= parentNode._getNamespaces(FIXEDNS.copy())
+    try:
       try:
         self._buffer= InputBuffer(input, (1, 1), self._domConfig, True)
-        self._inEntity= False
         self._Declaration(parentNode)
         self._Content(parentNode, refChild, namespaces)
         self._end()
-
       except LSFilterInterrupt:
         pass
     finally:
-      self._buffer= None
-      del self._parameterEntities
-      del self._generalEntities
-      del self._entityNest
-      if input.certifiedText:
-        self._domConfig.setParameter('normalize-characters', nc)
-        self._domConfig.setParameter('check-character-normalization', ccn)
+      self._stopParse()
+
+  # Parse contexts. Each parse runs on a context of its own: a copy of the
+  # parser sharing its configuration, filter and listeners, with its own parse
+  # state. So one parser can parse on any number of threads at once. The
+  # contexts of the parses in progress are listed on the parser for busy and
+  # abort. A fed or pulled document keeps its context between calls, as the
+  # parser's feeding, and is listed only while a piece is being parsed. (The
+  # configuration's error count is shared too, so a parse on another thread
+  # can stop a DTD or entity from being cached, but never the reverse.)
+  #
+  def _context(self, name, thread, feeding= False):
+    """ Make the context for a new parse, running on the given thread, with
+        its own copy of the configuration to count errors and change
+        parameters in. A parse cannot start while a document is being fed, or
+        from inside another parse on the same thread (for example from a
+        filter).
+    """
+    context= copy.copy(self)
+    context._domConfig= self._domConfig._copy()
+    context._parser= self
+    context._thread= thread
+    context._startParse()
+    self._lock.acquire()
+    try:
+      if self._feeding is not None or self._parsingHere():
+        raise InvalidStateErr(self, name)
+      if feeding:
+        self._feeding= context
+      else:
+        self._contexts.append(context)
+    finally:
+      self._lock.release()
+    return context
+
+  def _parsingHere(self):
+    thread= get_ident()
+    for context in self._contexts:
+      if context._thread==thread:
+        return True
+    return False
+
+  def _join(self, context):
+    self._lock.acquire()
+    try:
+      self._contexts.append(context)
+    finally:
+      self._lock.release()
+
+  def _leave(self, context):
+    self._lock.acquire()
+    try:
+      self._contexts.remove(context)
+    finally:
+      self._lock.release()
+
+  def _startParse(self):
+    """ Set up parser state. Entity state: lookups for parameter and general
+        entities, pointing to InputBuffers for each; list of entity nesting
+        depth to detect circular entity definitions.
+    """
+    self._parameterEntities= self._generalEntities= {}
+    self._entityNest= []
+    self._dofilter= True
+    self._inEntity= False
+    self._queue= []
+    self._dropWhite= False
+    self._templates= {}
+    self._locations= self._domConfig._snapshot().pxdom_track_locations
+    self._aborting= False
+    self._buffer= None
+    self._events= None
+    self._feed= None
+    self._position= 0
+    self._nodes= 0
+
+  def _stopParse(self):
+    self._buffer= None
+    self._events= None
+    del self._parameterEntities
+    del self._generalEntities
+    del self._entityNest
+
+
+  # Asynchronous parsing. The parse runs on a thread of its own, and its end
+  # is signalled to listeners by an LSLoadEvent. As the parser is an
+  # EventTarget, listeners can also hear LSProgressEvents in either mode.
+  #
+  def _startAsync(self, input):
+    context= self._context('parse', None)
+    try:
+      thread= threading.Thread(target= context._parseAsync, args= (input,))
+      thread.start()
+    except:
+      self._leave(context)
+      raise
+
+  def _parseAsync(self, input):
+    """ Parse a document on the current thread and dispatch its load event.
+        Any error has already gone to the error-handler, if there is one, and
+        leaves a null newDocument. There is no caller to raise other
+        exceptions to, so they go to the error-handler too.
+    """
+    self._thread= get_ident()
+    document= None
+    try:
+      try:
+        document= Document()
+        self._parseBefore(input, document, None)
+        if self._aborting:
+          document= None
+      except DOMException:
+        document= None
+      except Exception, e:
+        document= None
+        try:
+          self._domConfig._handleError(ParseStoppedErr(e))
+        except DOMException:
+          pass
+    finally:
+      self._parser._leave(self)
+      self._parser.dispatchEvent(LSLoadEvent(input, document))
+
+  def addEventListener(self, type, listener, useCapture= False):
+    if not self._listeners.has_key(type):
+      self._listeners[type]= []
+    if listener not in self._listeners[type]:
+      self._listeners[type].append(listener)
+
+  def removeEventListener(self, type, listener, useCapture= False):
+    if listener in self._listeners.get(type, []):
+      self._listeners[type].remove(listener)
+
+  def dispatchEvent(self, evt):
+    evt._target= evt._currentTarget= self
+    for listener in list(self._listeners.get(evt.type, [])):
+      listener.handleEvent(evt)
+    return True
+
+  def _progress(self, buffer):
+    self._position= buffer.position
+    if self._listeners.get('progress'):
+      self._parser.dispatchEvent(LSProgressEvent(
+        buffer.input, buffer.position, buffer.totalSize, self._nodes
+      ))
+
+
+  # Push parsing extension. A document can be given a piece at a time as it
+  # arrives, and is parsed as far as possible after each piece. Between pieces
+  # the context stack of the top-level _Items loop is kept; any item cut off
+  # by the end of the input so far is parsed again from its start next time.
+  #
+  def pxdomFeed(self, data):
+    """ Parse the next piece of a document, as a byte or character string.
+    """
+    context= self._feeding
+    if context is None:
+      context= self._context('pxdomFeed', None, True)
+      context._feed= _FeedStream()
+      context._feedDocument= Document()
+      context._feedStack= None
+      context._feedDone= False
+    elif not self._canFeed():
+      raise InvalidStateErr(self, 'pxdomFeed')
+    context._feed.write(data)
+    context._feedParse()
+
+  def pxdomClose(self):
+    """ Finish parsing a document given through pxdomFeed, and return it.
+    """
+    context= self._feeding
+    if context is None:
+      if self._parsingHere():
+        raise InvalidStateErr(self, 'pxdomClose')
+      self._domConfig._handleError(NoInputErr(None))
+      return None
+    if not self._canFeed():
+      raise InvalidStateErr(self, 'pxdomClose')
+    context._feed.close()
+    context._feedParse()
+    if context._feed is None:
+      return None
+    document= context._feedDocument
+    context._stopFeed()
+    return document
+
+  def _canFeed(self):
+    """ Whether the document being fed can be given more input: it must not
+        be a pulled document, nor be parsing the last piece, nor have another
+        parse in progress on this thread.
+    """
+    context= self._feeding
+    return not (
+      isinstance(context._feed, _PullStream) or context in self._contexts
+      or self._parsingHere()
+    )
+
+  def _feedParse(self):
+    """ Carry on parsing a fed document as far as the input so far allows.
+    """
+    if self._feedDone:
+      return
+    self._parser._join(self)
+    try:
+      try:
+        finished= self._feedStep()
+      except LSFilterInterrupt:
+        finished= True
+    except:
+      self._parser._leave(self)
+      self._stopFeed()
+      raise
+    self._parser._leave(self)
+    if self._aborting:
+      self._stopFeed()
+    elif finished:
+      self._feedDone= True
+
+  def _feedStep(self):
+    # Wait for enough input to detect a byte order mark before making the
+    # buffer, and for all of any XML declaration before reading it.
+    #
+    if self._buffer is None:
+      if self._feed.length<2 and not self._feed.closed:
+        return False
+      input= LSInput()
+      pieces= self._feed.pieces
+      if pieces and isinstance(pieces[0], Unicode):
+        input.characterStream= self._feed
+      else:
+        input.byteStream= self._feed
+      self._buffer= InputBuffer(input, (1, 1), self._domConfig, True)
+    return self._resume()
+
+  def _resume(self):
+    """ Parse as much of a resumable document as the input so far allows.
+        Return whether the end has been reached.
+    """
+    document= self._feedDocument
+    if self._feedStack is None:
+      try:
+        self._Declaration(document)
+      except _NeedMore:
+        self._buffer.reset()
+        return False
+      namespaces= document._getNamespaces(FIXEDNS.copy())
+      self._feedStack= [
+        (None, NodeFilter.FILTER_ACCEPT, document, None, namespaces, None,
+          False
+        )
+      ]
+
+    if not self._Items(self._feedStack, True):
+      return False
+    self._flush(document, None)
+    self._end()
+    return True
+
+  def _stopFeed(self):
+    self._stopParse()
+    self._feed= None
+    self._feedDocument= None
+    self._feedStack= None
+    self._parser._feeding= None
+
+
+  # Pull parsing extension. The document is read a chunk at a time, giving
+  # back the events for the nodes added to it as each chunk is parsed. The
+  # caller can remove finished subtrees from the document as it goes, so that
+  # documents bigger than memory can be processed a record at a time.
+  #
+  def pxdomEvents(self, input):
+    """ Parse a document from an LSInput, returning an iterator of (event,
+        node) pairs as the nodes are added to the document.
+    """
+    context= self._context('pxdomEvents', None, True)
+    try:
+      buffer= InputBuffer(input, (1, 1), context._domConfig, True)
+    except:
+      context._stopFeed()
+      raise
+    context._buffer= buffer
+    context._feed= _PullStream(buffer.stream)
+    if buffer.stream is not None:
+      buffer.stream= context._feed
+    context._feedDocument= Document()
+    context._feedStack= None
+    return _EventReader(context, context._feed, context._feedDocument)
+
+  def _pullParse(self, events):
+    """ Let the next chunk of a pulled document through and parse it, adding
+        events to the given list. Return whether the end has been reached.
+    """
+    self._events= events
+    self._feed.ready= True
+    self._parser._join(self)
+    try:
+      try:
+        finished= self._resume()
+      except LSFilterInterrupt:
+        finished= True
+    except:
+      self._parser._leave(self)
+      self._stopFeed()
+      raise
+    self._parser._leave(self)
+    if finished:
+      self._stopFeed()
+    else:
+      self._events= None
+    return finished
+
+  _nodeEvents= {
+    Node.TEXT_NODE: 'text', Node.CDATA_SECTION_NODE: 'text',
+    Node.COMMENT_NODE: 'comment', Node.PROCESSING_INSTRUCTION_NODE: 'pi'
+  }
+  def _event(self, event, node):
+    if self._events is not None and self._dofilter:
+      self._events.append((event, node))
 
 
   # Parsing utility functions
   #
   def _push(self, text):
-    self._queue= self._queue+text
+    """ Queue text to go in the next Text node. The queue is a list of pieces
+        to be joined when flushed, as text may be built up a character at a
+        time from references.
+    """
+    if text!='':
+      self._queue.append(text)
 
   def _flush(self, parentNode, refChild):
     """ Write any text that has been read and queued into a new Text node.
     """
-    if self._queue=='':
+    if len(self._queue)==0:
       return None
-    text= self._domConfig._cnorm(self._queue, parentNode, True)
-    self._queue= ''
-    node= parentNode._ownerDocument.createTextNode(text)
-    node._setLocation(self._buffer.getLocation())
+    text= self._domConfig._cnorm(string.join(self._queue, ''), parentNode, True)
+    del self._queue[:]
 
-    # If whitespace removal is required, must put the node in place to test
-    # whether it is element content whitespace.
+    # Drop element content whitespace if required, without making a node.
     #
-    if not self._domConfig.getParameter('element-content-whitespace'):
-      node._containerNode= parentNode
-      if node._get_isElementContentWhitespace(self._domConfig):
-        return
-      node._containerNode= None
-
+    if self._dropWhite and (
+      WHITES[isinstance(text, Unicode)].match(text).end()==len(text)
+    ):
+      return
+    node= parentNode._ownerDocument.createTextNode(text)
+    self._locate(node)
     self._insert(node, parentNode, refChild)
 
+  def _isDropWhite(self, parentNode):
+    """ Work out whether whitespace-only text parsed into a node is element
+        content whitespace to be dropped. This is done once for each element,
+        and kept on the stack.
+    """
+    return (
+      not self._domConfig._snapshot().element_content_whitespace
+      and parentNode._isElementContent(self._domConfig)
+    )
+
   def _insert(self, newNode, parentNode, refChild, preserve= False):
     """ Utility method to insert a node into a specific place in the document
         and then find out the filter's point of view if any, possibly removing
@@ -3560,11 +5585,17 @@ class LSParser(DOMObject):
     """
     if newNode._containerNode is not parentNode:
       parentNode.insertBefore(newNode, refChild)
+    if newNode.nodeType!=Node.ELEMENT_NODE:
+      self._nodes= self._nodes+1
     accepted= _acceptNode(self._dofilter and self._filter, newNode)
+    if accepted==NodeFilter.FILTER_ACCEPT and self._events is not None:
+      event= self._nodeEvents.get(newNode.nodeType)
+      if event is not None:
+        self._event(event, newNode)
     if accepted==NodeFilter.FILTER_REJECT:
       parentNode.removeChild(newNode)
     elif accepted==NodeFilter.FILTER_SKIP:
-      for grandchild in newNode.childNodes._list[:]:
+      for grandchild in list(newNode._children):
         baseURI= grandchild.baseURI
         parentNode.insertBefore(grandchild, newNode)
         if grandchild.baseURI!=baseURI and preserve:
@@ -3581,6 +5612,13 @@ class LSParser(DOMObject):
   def _error(self, message):
     self._domConfig._handleError(ParseErr(self._buffer, message))
 
+  def _locate(self, node):
+    """ Record the current position in the input as where a new node was
+        found, unless the pxdom-track-locations parameter says not to.
+    """
+    if self._locations:
+      node._setLocation(self._buffer.getLocation())
+
 
   # Low-level parsing
   #
@@ -3588,40 +5626,79 @@ class LSParser(DOMObject):
     """ Check if a string is the next thing in the queue. Optionally and by
         default step over it if it is.
     """
-    index= self._buffer.index
-    matches= self._buffer.chars[index:index+len(chars)]==chars
+    buffer= self._buffer
+    index= buffer.index
+    matches= buffer.chars[index:index+len(chars)]==chars
+    if not matches and index+len(chars)>len(buffer.chars):
+      if buffer.need(len(chars)):
+        matches= buffer.chars[index:index+len(chars)]==chars
     if stepPast and matches:
-      self._buffer.index= index+len(chars)
+      buffer.index= index+len(chars)
     return matches
 
-  def _upto(self, chars):
+  _delimiters= {}
+  def _upto(self, chars, partial= False):
     """ Read text up until the next occurance of one of a range of characters
-        or strings.
+        or strings. Read more input until one is found, or could not be
+        beaten by a longer one starting earlier but not yet read in full.
+        Optionally, if a fed document has no more input yet, return what
+        there is so far.
     """
-    end= len(self._buffer.chars)
-    for s in chars:
-      index= string.find(self._buffer.chars, s, self._buffer.index, end)
-      if index!=-1 and index<end:
-        end= index
+    key= tuple(chars)
+    if not self._delimiters.has_key(key):
+      self._delimiters[key]= re.compile(string.join(map(re.escape, chars), '|'))
+    delimiter= self._delimiters[key]
+    buffer= self._buffer
+    start= searched= buffer.index
+    while True:
+      l= len(buffer.chars)
+      end= l
+      match= delimiter.search(buffer.chars, searched)
+      if match is not None:
+        end= match.start()
+      if end<l:
+        for s in chars:
+          if end+len(s)>l:
+            break
+        else:
+          break
+      if self._aborting:
+        raise LSFilterInterrupt()
+      try:
+        more= buffer.read()
+      except _NeedMore:
+        if not partial:
+          raise
+        more= False
+      if not more:
+        break
+      searched= min(end, max(start, l-max(map(len, chars))+1))
     try:
-      return self._buffer.chars[self._buffer.index:end]
+      return buffer.chars[start:end]
     finally:
-      self._buffer.index= end
+      buffer.index= end
+
+  def _scan(self, patterns):
+    """ Step over the longest run of characters matching one of a pair of
+        patterns for narrow and Unicode strings, reading more input whilst
+        the run reaches the end of what has been read. Return the run.
+    """
+    buffer= self._buffer
+    start= buffer.index
+    while True:
+      pattern= patterns[isinstance(buffer.chars, Unicode)]
+      buffer.index= pattern.match(buffer.chars, buffer.index).end()
+      if buffer.index<len(buffer.chars):
+        return buffer.chars[start:buffer.index]
+      if self._aborting:
+        raise LSFilterInterrupt()
+      if not buffer.read():
+        return buffer.chars[start:buffer.index]
 
   def _white(self, required= True):
     """ Parse white space.
     """
-    start= self._buffer.index
-    l= len(self._buffer.chars)
-    while True:
-      index= self._buffer.index
-      if index>=l:
-        break
-      c= self._buffer.chars[index]
-      if not (c in WHITE or isinstance(c, Unicode) and c in WHITEU):
-        break
-      self._buffer.index= index+1
-    if required and index<=start:
+    if self._scan(WHITES)=='' and required:
       self._error('Expected whitespace')
 
   def _quote(self):
@@ -3652,73 +5729,38 @@ class LSParser(DOMObject):
   def _hex(self):
     """ Parse and return a hexadecimal number.
     """
-    start= self._buffer.index
-    l= len(self._buffer.chars)
-    while True:
-      index= self._buffer.index
-      if index>=l or self._buffer.chars[index] not in HEX:
-        break
-      self._buffer.index= index+1
-    if index==start:
+    digits= self._scan(HEXES)
+    if digits=='':
       self._error('Expected hex number')
-    return eval('0x'+str(self._buffer.chars[start:self._buffer.index]))
+    return string.atol(str(digits), 16)
 
   def _dec(self):
     """ Parse and return a decimal number.
     """
-    start= self._buffer.index
-    l= len(self._buffer.chars)
-    while True:
-      index= self._buffer.index
-      if index>=l or self._buffer.chars[index] not in HEX:
-        break
-      self._buffer.index= index+1
-    if index==start:
+    digits= self._scan(DECS)
+    if digits=='':
       self._error('Expected decimal number')
-    return int(self._buffer.chars[start:self._buffer.index])
+    return string.atol(str(digits))
 
   def _name(self):
     """ Parse and return an XML name.
     """
-    index= self._buffer.index
-    if index>=len(self._buffer.chars):
+    if not self._buffer.need(1):
       self._error('Expected name')
-    char= self._buffer.chars[index]
-    if char in NOTFIRST:
+    char= self._buffer.chars[self._buffer.index]
+    if char in NOTFIRST or isinstance(char, Unicode) and NOTFIRSTRE.match(char):
       self._error('Expected name')
-    if isinstance(char, Unicode):
-      for c0, c1 in NOTFIRSTU:
-        if ord(char)>=c0 and ord(char)<c1:
-          self._error('Expected name')
     return self._nmtokens()
   def _nmtokens(self):
-    start= self._buffer.index
-    l= len(self._buffer.chars)
-    while True:
-      index= self._buffer.index
-      if index>=l:
-        break
-      char= self._buffer.chars[index]
-      if char in NOTNAME or char in NOTCHAR:
-        break
-      if isinstance(char, Unicode):
-        if char in NOTCHARU:
-          break
-        bad= False
-        for c0, c1 in NOTNAMEU:
-          if ord(char)>=c0 and ord(char)<c1:
-            bad= True
-        if bad:
-          break
-      self._buffer.index= index+1
-    if index==start:
+    name= self._scan(NAMES)
+    if name=='':
       self._error('Expected name tokens')
-    return self._domConfig._cnorm(self._buffer.chars[start:index], None, True)
+    return self._domConfig._cnorm(name, None, True)
 
   def _end(self):
     """ Check there is no more input to come.
     """
-    if self._buffer.index<len(self._buffer.chars):
+    if self._buffer.need(1):
       self._error('Expected end of input')
 
 
@@ -3777,207 +5819,262 @@ class LSParser(DOMObject):
     is set false, potentially leave trailing text content on the queue for
     later possible concatenation.
     """
-    # Context stack. Have to remember namespace setups, baseURI and insertion
-    # point for each level of element nesting encountered. (Insertion points
-    # can't be implied by tree traversal because filters can choose to discard
-    # or reparent elements on the fly.)
-    #
-    stack= [(None, NodeFilter.FILTER_ACCEPT, parentNode, refChild, namespaces, inheritURI)]
-    origfilter= self.filter
+    dropWhite= self._dropWhite
+    stack= [(None, NodeFilter.FILTER_ACCEPT, parentNode, refChild, namespaces, inheritURI, self._isDropWhite(parentNode))]
+    self._Items(stack)
+    if flush:
+      self._flush(parentNode, refChild)
+    self._dropWhite= dropWhite
+
+
+  def _Items(self, stack, resumable= False):
+    """Parse content items until the end of input
+
+    The context stack has to remember namespace setups, baseURI and insertion
+    point for each level of element nesting encountered. (Insertion points
+    can't be implied by tree traversal because filters can choose to discard
+    or reparent elements on the fly.) If resumable, a fed document may run out
+    of input part-way through an item: in that case go back to the start of
+    the item and return False, leaving the stack to carry on from later.
+    Otherwise return True at the end of input.
+    """
+    cfg= self._domConfig._snapshot()
 
     while True:
-      etagname, filtering, parentNode, refChild, namespaces, inheritURI= stack[-1]
+      etagname, filtering, parentNode, refChild, namespaces, inheritURI, dropWhite= stack[-1]
+      self._dropWhite= dropWhite
       isDoc= parentNode.nodeType==Node.DOCUMENT_NODE
+      buffer= self._buffer
+      buffer.release()
+      if self._aborting:
+        raise LSFilterInterrupt()
+      if buffer.position!=self._position and buffer.streaming:
+        self._progress(buffer)
+      mark= buffer.index
+      queued= len(self._queue)
+      try:
 
-      # Get text up until next markup character and push it onto the text
-      # queue
-      #
-      text= self._upto('<&')
-      if text!='':
-        if isDoc:
-          for c in text:
-            if not (c in WHITE or isinstance(c, Unicode) and c in WHITEU):
+        # Get text up until next markup character and push it onto the text
+        # queue
+        #
+        text= self._upto('<&', resumable)
+        if text!='':
+          if isDoc:
+            if WHITES[isinstance(text, Unicode)].match(text).end()<len(text):
               self._error('Text not allowed at document level')
-        else:
-          self._push(text)
-
-      # Dispatch to character and entity reference handlers
-      #
-      elif self._match('&'):
-        if isDoc:
-          self._error('References are not allowed at document level')
-        if self._match('#'):
-          self._Charref(parentNode, refChild, namespaces)
-        else:
-          self._Entref(parentNode, refChild, namespaces)
-
-      # Dispatch to non-element node handlers
-      #
-      elif self._match('<'):
-        if self._match('?'):
-          self._PI(parentNode, refChild, namespaces, inheritURI)
-        elif self._match('!'):
-          if self._match('['):
-            if self._match('CDATA['):
-              if isDoc:
-                self._error('CDATA not allowed at document level')
-              self._CDATA(parentNode, refChild, namespaces)
-            else:
-              self._error('Expected \'CDATA[...]\'')
-          elif self._match('DOCTYPE'):
-            if (not isDoc or
-              parentNode.documentElement is not None or
-              parentNode._ownerDocument.doctype is not None
-            ):
-              self._error('Doctype in unexpected position')
-            if self._domConfig.getParameter('disallow-doctype'):
-              self._domConfig._handleError(DoctypeNotAllowedErr(None))
-            self._Doctype(parentNode, refChild, namespaces)
-          elif self._match('--'):
-            self._Comment(parentNode, refChild, namespaces)
           else:
-            self._error('Expected comment, doctype or CDATA')
+            self._push(text)
 
-        # Start tag
+        # Dispatch to character and entity reference handlers
         #
-        elif not self._match('/'):
-          if isDoc and parentNode.documentElement is not None:
-            self._error('Only one root element is allowed')
-          element, empty, newspaces, baseURI= self._Element(parentNode, refChild, namespaces, inheritURI)
-
-          # Check the filter's initial opinion of whether it wants the element.
-          # (Always accept the document root element as per spec.) If a filter
-          # rejects nodes it's possible that the parsed text nodes will be
-          # non-normalised. There is no obvious way around this.
-          #
-          parentNode.insertBefore(element, refChild)
-          if parentNode.nodeType==Node.DOCUMENT_NODE:
-            accepted= NodeFilter.FILTER_ACCEPT
+        elif self._match('&'):
+          if isDoc:
+            self._error('References are not allowed at document level')
+          if self._match('#'):
+            self._Charref(parentNode, refChild, namespaces)
           else:
-            accepted= _acceptNode(self._dofilter and self._filter, element, startElement= True)
-
-          if accepted in (NodeFilter.FILTER_SKIP, NodeFilter.FILTER_REJECT):
-            parentNode.removeChild(element)
-          if accepted in (NodeFilter.FILTER_ACCEPT, NodeFilter.FILTER_REJECT):
-            parentNode, refChild= element, None
+            self._Entref(parentNode, refChild, namespaces)
 
-          # Push state onto stack. Hack: if the filter has completely rejected
-          # the element, we still have to go through the process of parsing it
-          # all, but we can't let the filter know about any of it.
-          #
-          if not empty:
-            stack.append((element.tagName, accepted, parentNode, refChild, newspaces, baseURI))
-            if accepted==NodeFilter.FILTER_REJECT:
-               self._dofilter= False
-
-        # End tag
+        # Dispatch to non-element node handlers
         #
-        else:
-          name= self._name()
-          if etagname is None:
-            self._error('Unexpected %s end-tag' % name)
-          if name!=etagname:
-            startcontext= ''
-            if filtering==NodeFilter.FILTER_ACCEPT and parentNode.nodeType==parentNode.ELEMENT_NODE:
-              loc= parentNode.pxdomLocation
-              if loc is not None and loc.lineNumber!=-1 and loc.columnNumber!=-1:
-                startcontext= ' to match start-tag at line %i char %i' % (loc.lineNumber, loc.columnNumber)
-            self._error('Expected %s end-tag%s, got %s' % (etagname, startcontext, name))
-          self._white(False)
-          if not self._match('>'):
-            self._error('Expected close angle bracket')
-          self._flush(parentNode, refChild)
-          del stack[-1]
+        elif self._match('<'):
+          if self._match('?'):
+            self._PI(parentNode, refChild, namespaces, inheritURI)
+          elif self._match('!'):
+            if self._match('['):
+              if self._match('CDATA['):
+                if isDoc:
+                  self._error('CDATA not allowed at document level')
+                self._CDATA(parentNode, refChild, namespaces)
+              else:
+                self._error('Expected \'CDATA[...]\'')
+            elif self._match('DOCTYPE'):
+              if (not isDoc or
+                parentNode.documentElement is not None or
+                parentNode._ownerDocument.doctype is not None
+              ):
+                self._error('Doctype in unexpected position')
+              if cfg.disallow_doctype:
+                self._domConfig._handleError(DoctypeNotAllowedErr(None))
+              self._Doctype(parentNode, refChild, namespaces)
+            elif self._match('--'):
+              self._Comment(parentNode, refChild, namespaces)
+            else:
+              self._error('Expected comment, doctype or CDATA')
 
-          # Give filter a chance to reject the completed element (unless it's root)
+          # Start tag
           #
-          if filtering==NodeFilter.FILTER_ACCEPT:
-            element= parentNode
-            etagname, filtering, parentNode, refChild, namespaces, inheritURI= stack[-1]
+          elif not self._match('/'):
+            if isDoc and parentNode.documentElement is not None:
+              self._error('Only one root element is allowed')
+            # _Element flushes queued text before reading the tag, so if the
+            # input runs out there is no text left to go back to
+            #
+            queued= 0
+            element, empty, newspaces, baseURI= self._Element(parentNode, refChild, namespaces, inheritURI)
+
+            # Check the filter's initial opinion of whether it wants the element.
+            # (Always accept the document root element as per spec.) If a filter
+            # rejects nodes it's possible that the parsed text nodes will be
+            # non-normalised. There is no obvious way around this.
+            #
+            parentNode.insertBefore(element, refChild)
             if parentNode.nodeType==Node.DOCUMENT_NODE:
-              parentNode.insertBefore(element, refChild)
+              accepted= NodeFilter.FILTER_ACCEPT
             else:
-              self._insert(element, parentNode, refChild, self._domConfig.getParameter('pxdom-preserve-base-uri'))
-
-          # Revert reject-filter-off hack
+              accepted= _acceptNode(self._dofilter and self._filter, element, startElement= True)
+
+            if accepted in (NodeFilter.FILTER_SKIP, NodeFilter.FILTER_REJECT):
+              parentNode.removeChild(element)
+            if accepted in (NodeFilter.FILTER_ACCEPT, NodeFilter.FILTER_REJECT):
+              parentNode, refChild= element, None
+            self._nodes= self._nodes+1
+            if accepted==NodeFilter.FILTER_ACCEPT:
+              self._event('start', element)
+              if empty:
+                self._event('end', element)
+
+            # Push state onto stack, including whether whitespace-only text
+            # in the element is element content whitespace to be dropped.
+            # Hack: if the filter has completely rejected the element, we
+            # still have to go through the process of parsing it all, but we
+            # can't let the filter know about any of it.
+            #
+            if not empty:
+              stack.append((element.tagName, accepted, parentNode, refChild, newspaces, baseURI, self._isDropWhite(parentNode)))
+              if accepted==NodeFilter.FILTER_REJECT:
+                 self._dofilter= False
+
+          # End tag
           #
-          if filtering==NodeFilter.FILTER_REJECT:
-            self._dofilter= False
+          else:
+            name= self._name()
+            if etagname is None:
+              self._error('Unexpected %s end-tag' % name)
+            if name!=etagname:
+              startcontext= ''
+              if filtering==NodeFilter.FILTER_ACCEPT and parentNode.nodeType==parentNode.ELEMENT_NODE:
+                loc= parentNode.pxdomLocation
+                if loc is not None and loc.lineNumber!=-1 and loc.columnNumber!=-1:
+                  startcontext= ' to match start-tag at line %i char %i' % (loc.lineNumber, loc.columnNumber)
+              self._error('Expected %s end-tag%s, got %s' % (etagname, startcontext, name))
+            self._white(False)
+            if not self._match('>'):
+              self._error('Expected close angle bracket')
+            self._flush(parentNode, refChild)
+            del stack[-1]
+
+            # Give filter a chance to reject the completed element (unless it's root)
+            #
+            if filtering==NodeFilter.FILTER_ACCEPT:
+              element= parentNode
+              etagname, filtering, parentNode, refChild, namespaces, inheritURI, dropWhite= stack[-1]
+              if parentNode.nodeType==Node.DOCUMENT_NODE:
+                parentNode.insertBefore(element, refChild)
+              else:
+                self._insert(element, parentNode, refChild, cfg.pxdom_preserve_base_uri)
+              self._event('end', element)
 
-      else: # eof
-        if len(stack)!=1:
-          self._error('%r element left open' % parentNode.tagName)
-        break
-    if flush:
-      self._flush(parentNode, refChild)
+            # Revert reject-filter-off hack
+            #
+            if filtering==NodeFilter.FILTER_REJECT:
+              self._dofilter= True
+
+        else: # eof
+          if len(stack)!=1:
+            self._error('%r element left open' % parentNode.tagName)
+          break
+      except _NeedMore:
+        if not resumable:
+          raise
+        buffer.index= mark
+        del self._queue[queued:]
+        return False
+    return True
 
 
   def _Element(self, parentNode, refChild, namespaces, baseURI= None):
     """Parse element start-tag
     """
+    cfg= self._domConfig._snapshot()
     self._flush(parentNode, refChild)
     doc= parentNode._ownerDocument
     newspaces= namespaces.copy()
-    ns= self._domConfig.getParameter('namespaces')
+    ns= cfg.namespaces
 
-    # Create element. Check for any default attributes that might introduce
-    # namespaces into scope.
+    # Create element. The name has already been checked by the scanner, so
+    # build the node directly rather than going through createElement. Check
+    # for any default attributes that might introduce namespaces into scope.
     #
-    element= doc.createElement(self._name())
-    element._setLocation(self._buffer.getLocation())
-    if ns:
-      for attr in element.attributes:
-        if attr.namespaceURI==NSNS:
-          newspaces[
-            [attr.localName, None][attr.prefix is None]
-          ]= attr.value or None
-
-    # First pass (parse) over attributes.
+    tagName= self._name()
+    element= Element(doc)
+    element._namespaceURI= NONS
+    element._localName= tagName
+    self._locate(element)
+    doctype= doc.doctype
+    if doctype is None:
+      defaults, types, ids= (), {}, {}
+    else:
+      defaults, types, ids= doctype._getAttributeTable(tagName)
+    if defaults:
+      element._setDefaultAttributes()
+      if ns:
+        for attr in element.attributes:
+          if attr.namespaceURI==NSNS:
+            newspaces[
+              [attr.localName, None][attr.prefix is None]
+            ]= attr.value or None
+
+    # First pass (parse) over attributes. Attrs to be added to the element
+    # are held back until their namespaces are known.
     #
+    attrs= []
+    names= {}
     empty= False
     while True:
+      white= self._scan(WHITES)!=''
       if self._match('>'):
         break
       if self._match('/>'):
         empty= True
         break
-      self._white()
-      if self._match('>'):
-        break
-      if self._match('/>'):
-        empty= True
-        break
+      if not white:
+        self._error('Expected whitespace')
 
       name= self._name()
-      attr= element.getAttributeNode(name)
-      if attr is not None and attr.specified:
+      if names.has_key(name):
         self._error('Duplicate attribute %s' % name)
+      names[name]= True
 
-      # Add attribute node with parsed value. Take note of added namespace
-      # declarations for next pass.
+      # Make attribute node with parsed value. Take note of added namespace
+      # declarations for next pass. The type that would be reported by its
+      # schemaTypeInfo comes from the doctype's attribute table.
       #
-      attr= doc.createAttribute(name)
-      attr._setLocation(self._buffer.getLocation())
+      attr= Attr(doc)
+      attr._namespaceURI= NONS
+      attr._localName= name
+      self._locate(attr)
       self._equal()
       self._Attr(attr, None, namespaces)
 
       prefix, localName= _splitName(name)
       if ns and 'xmlns' in (name, prefix):
         newspaces[[localName, None][prefix is None]]= attr.value or None
-      if not ns or self._domConfig.getParameter('namespace-declarations'):
-        element.setAttributeNode(attr)
-
-      if attr.schemaTypeInfo.typeName=='ID':
-        element.setIdAttributeNode(attr, True)
+        if not cfg.namespace_declarations:
+          continue
+      attrs.append(attr)
+      if ids.has_key(name) or name=='xml:id' and not types.has_key(name):
+        attr._isId= True
 
     # If namespace parsing, use the new in-scope namespaces to work out the
     # namespaceURIs of the element and its attributes, converting them up to
-    # level 2 nodes.
+    # level 2 nodes. Defaulted attributes already on the element have to be
+    # refiled under their new names.
     #
     if ns:
-      prefix, localName= _splitName(element.nodeName)
+      prefix, localName= _splitName(tagName)
       if localName is None:
-        self._error('Element %s not namespace-well-formed' % element.nodeName)
+        self._error('Element %s not namespace-well-formed' % tagName)
       element._prefix= prefix
       element._localName= localName
       if newspaces.has_key(prefix):
@@ -3987,10 +6084,11 @@ class LSParser(DOMObject):
         if prefix is not None:
           self._domConfig._handleError(UnboundNSErr(element, self._inEntity))
 
-      for attr in element.attributes:
-        prefix, localName= _splitName(attr.nodeName)
+      for attr in element._attributes._list+attrs:
+        name= attr.nodeName
+        prefix, localName= _splitName(name)
         if localName is None:
-          self._error('Attr %s not namespace-well-formed' % attr.nodeName)
+          self._error('Attr %s not namespace-well-formed' % name)
         attr._prefix= prefix
         attr._localName= localName
         if prefix is None and localName=='xmlns':
@@ -4002,6 +6100,19 @@ class LSParser(DOMObject):
         else:
           attr._namespaceURI= None
           self._domConfig._handleError(UnboundNSErr(element, self._inEntity))
+        if attr._containerNode is element:
+          attr._renamed()
+
+    # Add the parsed attributes. Only one that overrides a default attribute
+    # needs the full setAttributeNode treatment, to take the default's place.
+    #
+    attributes= element._attributes
+    for attr in attrs:
+      if defaults and attributes.getNamedItem(attr.nodeName) is not None:
+        element.setAttributeNode(attr)
+      else:
+        attr._containerNode= element
+        attributes._append(attr)
 
     # If we are inheriting a skipped baseURI and the element doesn't completely
     # override it with an absolute URI, fix it up
@@ -4023,12 +6134,20 @@ class LSParser(DOMObject):
     """ Parse quoted attribute value. Turn non-escaped whitespace characters
         into actual spaces as XML mysteriously requires.
     """
-    # Attr children are never passed to filter.
+    # Attr children are never passed to filter, or given as events, nor are
+    # they ever element content whitespace. Put things back even if a fed
+    # document runs out of input part-way through.
     #
-    filter= self._filter
-    self._filter= None
-    quote= self._quote()
+    filter, events, dropWhite= self._filter, self._events, self._dropWhite
+    self._filter= self._events= None
+    self._dropWhite= False
+    try:
+      self._AttrValue(parentNode, refChild, namespaces)
+    finally:
+      self._filter, self._events, self._dropWhite= filter, events, dropWhite
 
+  def _AttrValue(self, parentNode, refChild, namespaces):
+    quote= self._quote()
     while True:
       text= self._upto(quote+'<&')
       if text!='':
@@ -4049,8 +6168,22 @@ class LSParser(DOMObject):
         break
     if not self._match(quote):
       self._error('Attr value left open, expected close quote')
-    self._flush(parentNode, refChild)
-    self._filter= filter
+
+    # A value that is all text becomes the only child of the new node, so it
+    # can be linked in directly without the checks of a DOM insertion.
+    #
+    if parentNode._children is NOCHILDREN and len(self._queue)>0:
+      text= string.join(self._queue, '')
+      del self._queue[:]
+      node= parentNode._ownerDocument.createTextNode(
+        self._domConfig._cnorm(text, parentNode, True)
+      )
+      self._locate(node)
+      node._containerNode= parentNode
+      parentNode._children= [node]
+      self._nodes= self._nodes+1
+    else:
+      self._flush(parentNode, refChild)
 
 
   def _Charref(self, parentNode, refChild, namespaces, textonly= False):
@@ -4084,7 +6217,7 @@ class LSParser(DOMObject):
           self._flush(parentNode, refChild)
           ent= EntityReference(parentNode._ownerDocument, 'x')
           ent._nodeName= '#x%x' % value
-          ent._setLocation(self._buffer.getLocation())
+          self._locate(ent)
           ent._recurse(True, readonly= True)
           self._insert(ent, parentNode, refChild)
 
@@ -4109,6 +6242,7 @@ class LSParser(DOMObject):
 
 
   def _Entref(self, parentNode, refChild, namespaces):
+    cfg= self._domConfig._snapshot()
     name= self._name()
     if not self._match(';'):
       self._error('Expected semicolon after entity reference')
@@ -4124,7 +6258,7 @@ class LSParser(DOMObject):
     #
     doctype= parentNode._ownerDocument.doctype
     if doctype is not None:
-      ent= doctype.entities.getNamedItem(name)
+      ent= doctype._lookup('_entities', name)
       if ent is not None and ent.notationName is not None:
         self._error('Reference to unparsed entity')
     isCircular= name in self._entityNest
@@ -4141,49 +6275,147 @@ class LSParser(DOMObject):
       buffer= self._generalEntities[name]
 
     # If entities is on, create an EntityReference node and parse the
-    # replacement text into it. If there is no replacement text available
-    # create an empty EntityReference regardless of the state of entities.
+    # replacement text into it, or copy the nodes it was parsed to before. If
+    # there is no replacement text available create an empty EntityReference
+    # regardless of the state of entities.
     #
-    if buffer is None or self._domConfig.getParameter('entities'):
+    if buffer is None or cfg.entities:
       self._flush(parentNode, refChild)
       ent= EntityReference(parentNode.ownerDocument, name)
+      template= None
       if buffer is not None:
-        parentNode.insertBefore(ent, refChild)
-        oldbuffer= self._buffer
-        self._buffer= buffer
-        self._Content(ent, None, namespaces)
-        self._buffer= oldbuffer
-        buffer.reset()
-      ent._recurse(True, readonly= True)
+        template= self._template(name, buffer, parentNode, namespaces)
+        if template is not None:
+          document= parentNode._ownerDocument
+          nodes= map(lambda node, d= document: node._copy(d), template[0])
+          ent._writeChildren(nodes, None, False)
+        else:
+          parentNode.insertBefore(ent, refChild)
+          oldbuffer= self._buffer
+          self._buffer= buffer
+          self._Content(ent, None, namespaces)
+          self._buffer= oldbuffer
+          buffer.reset()
+      if template is None:
+        ent._recurse(True, readonly= True)
+      else:
+        ent._readonly= True
       self._insert(ent, parentNode, refChild,
-        self._domConfig.getParameter('pxdom-preserve-base-uri')
+        cfg.pxdom_preserve_base_uri
       )
 
     # If entities is off, parse the replacement text from the InputBuffer
-    # directly into the current node
+    # directly into the current node, or copy in the nodes it was parsed to
+    # before. Text at the edges goes on the queue to join up with the text
+    # around the reference.
     #
     else:
-      if self._domConfig.getParameter('pxdom-preserve-base-uri'):
+      if cfg.pxdom_preserve_base_uri:
         inheritURI= None
         if buffer.uri!=parentNode.baseURI:
           inheritURI= buffer.uri
-        oldbuffer= self._buffer
-        self._buffer= buffer
-        self._Content(parentNode, refChild, namespaces, inheritURI, flush= False)
-        self._buffer= oldbuffer
-        buffer.reset()
+        template= None
+        if inheritURI is None:
+          template= self._template(name, buffer, parentNode, namespaces)
+        if template is not None:
+          nodes, location= template
+          start, end= 0, len(nodes)
+          if end>0 and nodes[0].nodeType==Node.TEXT_NODE:
+            self._push(nodes[0].data)
+            start= 1
+          if end>start and nodes[-1].nodeType==Node.TEXT_NODE:
+            end= end-1
+          if start<end:
+            if len(self._queue)>0:
+              self._flush(parentNode, refChild)
+              if refChild is None:
+                parentNode.lastChild._location= location
+              else:
+                refChild.previousSibling._location= location
+            document= parentNode._ownerDocument
+            copies= map(lambda n, d= document: n._copy(d), nodes[start:end])
+            parentNode._writeChildren(copies, refChild, False)
+          if end<len(nodes):
+            self._push(nodes[-1].data)
+        else:
+          oldbuffer= self._buffer
+          self._buffer= buffer
+          self._Content(parentNode, refChild, namespaces, inheritURI, flush= False)
+          self._buffer= oldbuffer
+          buffer.reset()
 
     del self._entityNest[-1]
 
 
+  def _template(self, name, buffer, parentNode, namespaces):
+    """ Get the nodes an entity's replacement text parses to, for copying into
+        references to it instead of parsing it each time, and the location
+        text before the reference would be flushed at if it is included
+        directly. The text is parsed into a template the first time, and again
+        if the in-scope namespaces or the parameters differ. Return None if
+        nodes can't be copied because the parse might give different results
+        for each reference: a filter or event reader is watching, text
+        normalisation or element content whitespace depend on the reference's
+        surroundings, or errors reported by parsing would have to be reported
+        again.
+    """
+    cfg= self._domConfig._snapshot()
+    if (
+      self._events is not None or self._dofilter and self._filter is not None
+      or self._inEntity or not cfg.element_content_whitespace
+      or cfg.normalize_characters or cfg.check_character_normalization
+    ):
+      return None
+    template= self._templates.get(name)
+    if template is not None:
+      snapshot, spaces, count= template[2:]
+      if snapshot is cfg and spaces==namespaces:
+        self._nodes= self._nodes+count
+        return template[:2]
+
+    # Parse into a fragment with a queue of its own. When the content is to
+    # be included directly, start the queue with a marker that can't occur in
+    # text, to find where the first flush of text would have been. When
+    # including entity references, the template nodes are made readonly once,
+    # as the copies of them will need to be.
+    #
+    fragment= DocumentFragment(parentNode._ownerDocument)
+    queue, self._queue= self._queue, []
+    if not cfg.entities:
+      self._queue.append('\0')
+    oldbuffer, self._buffer= self._buffer, buffer
+    nodes, errors= self._nodes, self._domConfig._errors
+    try:
+      self._Content(fragment, None, namespaces)
+    finally:
+      self._queue= queue
+      self._buffer= oldbuffer
+      buffer.reset()
+    template= list(fragment._children)
+    location= -1
+    if cfg.entities:
+      for node in template:
+        node._recurse(True, readonly= True)
+    elif len(template)>0:
+      location= template[0]._location
+      template[0]._data= template[0]._data[1:]
+      if template[0]._data=='':
+        del template[0]
+    template= template, location
+    if self._domConfig._errors==errors:
+      self._templates[name]= template+(cfg, namespaces, self._nodes-nodes)
+    return template
+
+
   def _Comment(self, parentNode, refChild, namespaces):
+    cfg= self._domConfig._snapshot()
     data= self._upto(['--'])
     if not self._match('-->'):
       self._error('Expected --> to close comment')
-    if self._domConfig.getParameter('comments'):
+    if cfg.comments:
       self._flush(parentNode, refChild)
       comment= parentNode._ownerDocument.createComment(data)
-      comment._setLocation(self._buffer.getLocation())
+      self._locate(comment)
       self._insert(comment, parentNode, refChild)
 
 
@@ -4196,7 +6428,7 @@ class LSParser(DOMObject):
       if not self._match('?>'):
         self._error('Expected ?> to close processing instruction')
     pi= parentNode._ownerDocument.createProcessingInstruction(target, data)
-    pi._setLocation(self._buffer.getLocation())
+    self._locate(pi)
     self._flush(parentNode, refChild)
     self._insert(pi, parentNode, refChild)
     if inheritURI is not None:
@@ -4204,32 +6436,28 @@ class LSParser(DOMObject):
 
 
   def _CDATA(self, parentNode, refChild, namespaces):
+    cfg= self._domConfig._snapshot()
     data= self._upto([']]>'])
     if not self._match(']]>'):
       self._error('CDATA left open, expected ]]> to close')
-    if not self._domConfig.getParameter('cdata-sections'):
+    if not cfg.cdata_sections:
       self._push(data)
-    else:
-      cdata= parentNode._ownerDocument.createCDATASection(data)
-      cdata._setLocation(self._buffer.getLocation())
 
-      # Depending on configuration parameter, possibly throw away CDATA
-      # sections in element content that contain only whitespace. It is
-      # currently unclear from spec whether this is the right thing.
-      #
-      if not self._domConfig.getParameter('element-content-whitespace'):
-        cdata._containerNode= parentNode
-        if cdata._get_isElementContentWhitespace(self._domConfig):
-          cdata= None
-        else:
-          cdata._containerNode= None
-
-      if cdata is not None:
-        self._flush(parentNode, refChild)
-        self._insert(cdata, parentNode, refChild)
+    # Depending on configuration parameter, possibly throw away CDATA sections
+    # in element content that contain only whitespace. It is currently unclear
+    # from spec whether this is the right thing.
+    #
+    elif not self._dropWhite or (
+      WHITES[isinstance(data, Unicode)].match(data).end()<len(data)
+    ):
+      cdata= parentNode._ownerDocument.createCDATASection(data)
+      self._locate(cdata)
+      self._flush(parentNode, refChild)
+      self._insert(cdata, parentNode, refChild)
 
 
   def _Doctype(self, parentNode, refChild, namespaces):
+    cfg= self._domConfig._snapshot()
     self._white()
     name= self._name()
     if not self._match('>', False):
@@ -4239,46 +6467,88 @@ class LSParser(DOMObject):
 
     # Create and insert doctype node. Make it temporarily not readonly.
     #
-    if self._domConfig.getParameter('namespaces'):
+    if cfg.namespaces:
         if _splitName(name)[1] is None:
             self._error('Doctype root element name not namespace-well-formed')
     doctype= DocumentType(None, name, publicId, systemId)
     parentNode.insertBefore(doctype, refChild)
 
-    # Parse internal subset if given
+    # Parse internal subset if given. If a fed document runs out of input
+    # part-way through, take the doctype and its declarations out again, so
+    # the whole doctype can be parsed afresh when there is more.
     #
-    self._white(False)
-    if self._match('['):
-      start= self._buffer.index
-      self._DTD(doctype, False)
-      if start<self._buffer.index:
-        doctype.internalSubset= self._buffer.chars[start:self._buffer.index]
-      if not self._match(']'):
-        self._error('Internal subset left open, expected ]')
+    try:
       self._white(False)
-    if not self._match('>'):
-      self._error('Doctype left open, expected >')
-
-    # Resolve and parse external DTD subset
+      if self._match('['):
+        start= self._buffer.index
+        self._DTD(doctype, False)
+        if start<self._buffer.index:
+          doctype.internalSubset= self._buffer.chars[start:self._buffer.index]
+        if not self._match(']'):
+          self._error('Internal subset left open, expected ]')
+        self._white(False)
+      if not self._match('>'):
+        self._error('Doctype left open, expected >')
+    except _NeedMore:
+      parentNode.removeChild(doctype)
+      self._parameterEntities= self._generalEntities= {}
+      raise
+
+    # Resolve and parse external DTD subset. With a pxdom-dtd-cache, share
+    # the declarations kept in it if it has them. Otherwise parse the subset
+    # into a doctype of its own, whose declarations are added to the real
+    # doctype and can be stored in the cache once the doctype is finished.
     #
+    key= None
     if systemId is not None:
       baseURI= parentNode.documentURI
-      buffer= self._buffer
-      self._buffer=self._domConfig._resolveResource(publicId,systemId,baseURI)
-      if self._buffer is None:
-        doctype._processed= False
+      cache= cfg.pxdom_dtd_cache
+      entry= None
+      if cache is not None and doctype._processed:
+        key= self._dtdKey(doctype, publicId, systemId, baseURI)
+        entry= cache._get(key)
+      if entry is not None:
+        doctype._share(entry[0])
+        for entityName, buffer in entry[1].items():
+          if not self._generalEntities.has_key(entityName):
+            if buffer is not None:
+              buffer= buffer.copy(self._domConfig)
+            self._generalEntities[entityName]= buffer
+        key= None
       else:
-        self._Declaration(None)
-        self._DTD(doctype, True)
-        self._end()
-      self._buffer= buffer
+        external= doctype
+        if key is not None:
+          external= DocumentType(doctype._ownerDocument, name)
+          names= self._generalEntities.copy()
+          errors= self._domConfig._errors
+        buffer= self._buffer
+        self._buffer=self._domConfig._resolveResource(publicId,systemId,baseURI)
+        if self._buffer is None:
+          doctype._processed= False
+          key= None
+        else:
+          self._Declaration(None)
+          self._DTD(external, True)
+          self._end()
+        self._buffer= buffer
+        if external is not doctype:
+          doctype._merge(external)
+        if key is not None:
+          entry= DocumentType(None, name), {}
+          entry[0]._merge(external)
+          for entityName, buffer in self._generalEntities.items():
+            if not names.has_key(entityName):
+              entry[1][entityName]= buffer
 
     # Fill in the children of available parsed general entities from the
-    # replacement text in the InputBuffer we made at <!ENTITY> stage.
+    # replacement text in the InputBuffer we made at <!ENTITY> stage. Shared
+    # entities from the cache already have theirs.
     #
     oldbuffer= self._buffer
+    events= self._events
     self._inEntity= True
-    for ent in doctype.entities._list:
+    self._events= None
+    for ent in doctype._entities._list:
       if ent.notationName is None:
         buffer= self._generalEntities.get(ent.nodeName, None)
         if buffer is not None:
@@ -4290,12 +6560,60 @@ class LSParser(DOMObject):
           buffer.reset()
           self._buffer= oldbuffer
     self._inEntity= False
+    self._events= events
+
+    # Store a parsed external subset in the cache, unless it reported errors,
+    # which would have to be reported again by later parses. The entities it
+    # declared are stored with the children just parsed into them. Entities
+    # have to be read to the end to be copied. The general entities have been
+    # by now; parameter entities that weren't referenced can't be any more, so
+    # the rest of them is read without checking it.
+    #
+    if key is not None and self._domConfig._errors==errors:
+      record, buffers= entry
+      for entity in record._entities._list:
+        if buffers.has_key(entity.nodeName):
+          parsed= doctype._entities.getNamedItem(entity.nodeName)
+          entity._writeChildren(map(
+            lambda node: node._copy(None), parsed._children
+          ), None, False)
+          entity._available= parsed._available
+      for entityName, buffer in buffers.items():
+        if buffer is not None:
+          checking, buffer.checking= buffer.checking, False
+          while buffer.read():
+            pass
+          buffer.checking= checking
+          buffers[entityName]= buffer.copy(None)
+      record._recurse(True, readonly= True)
+      cache._put(key, entry)
 
     # Finished, make doctype read-only as per DOM spec
     #
     doctype._recurse(True, readonly= True)
 
 
+  def _dtdKey(self, doctype, publicId, systemId, baseURI):
+    """ Make the key an external subset's declarations are cached under: its
+        public and absolute system identifiers, the internal subset if that
+        declared any entities the external subset could refer to, and the
+        parameters other than those for objects that don't affect parsing.
+    """
+    uri= _encodeURI(systemId)
+    if baseURI is not None:
+      uri= urlparse.urljoin(baseURI, uri)
+    subset= None
+    if len(self._generalEntities)>0:
+      subset= doctype.internalSubset
+    parameters= filter(
+      lambda item: item[0] not in (
+        'error-handler', 'resource-resolver', 'pxdom-dtd-cache'
+      ), self._domConfig._parameters.items()
+    )
+    parameters.sort()
+    return publicId, uri, subset, tuple(parameters)
+
+
   # Parameter entity handling for DTD parsing.
   #
   def _checkPE(self, doctype, white= True, ignorePercent= False):
@@ -4315,6 +6633,7 @@ class LSParser(DOMObject):
       #
       if self._match('%'):
         if ignorePercent:
+          self._buffer.need(1)
           index= self._buffer.index
           if self._buffer.chars[index:index+1] in WHITE+'%':
             self._buffer.index= index-1
@@ -4338,8 +6657,7 @@ class LSParser(DOMObject):
 
       # Step out of PE
       #
-      l= len(self._buffer.chars)
-      if self._buffer.index>=l and self._buffer.parent is not None:
+      if self._buffer.parent is not None and not self._buffer.need(1):
         par= self._buffer.parent
         self._buffer.parent= None
         self._buffer.index= 0
@@ -4373,11 +6691,10 @@ class LSParser(DOMObject):
         parameter entity reference.
     """
     while True:
+      if self._aborting:
+        raise LSFilterInterrupt()
       self._checkPE(doctype)
-      if (
-        self._buffer.index==len(self._buffer.chars) or
-        self._match(']', stepPast=False)
-      ):
+      if not self._buffer.need(1) or self._match(']', stepPast=False):
         break
 
       # Dispatch declarations to appropriate parsing method. Ignore PIs and
@@ -4492,11 +6809,11 @@ class LSParser(DOMObject):
           self._Charref(doctype, None, None, textonly= True)
         else:
           self._checkPE(doctype, white= False)
-          if self._buffer.index==len(self._buffer.chars):
+          if not self._buffer.need(1):
             break
 
-      replacement= self._queue
-      self._queue= ''
+      replacement= string.join(self._queue, '')
+      del self._queue[:]
       self._buffer=realbuf
 
       input= LSInput()
@@ -4740,19 +7057,107 @@ class LSParser(DOMObject):
     return cp
 
 
+class ParserPool(DOMObject):
+  """ Store of idle LSParsers made with the same parameters, lent out for a
+      parse and given back afterwards, so that a parser and its configuration
+      need not be made for each document. Unless the parameters give one, the
+      parsers share a pxdom-dtd-cache of the pool's own. At most 'size' idle
+      parsers are kept. Can be shared between threads.
+  """
+  def __init__(self, parameters= {}, size= 8):
+    DOMObject.__init__(self)
+    config= ParserConfiguration()
+    config.setParameter('pxdom-dtd-cache', DTDCache())
+    for (key, value) in parameters.items():
+      config.setParameter(key, value)
+    self._config= config
+    self._size= size
+    self._parsers= []
+    self._lock= _Lock()
+
+  def _get_size(self):
+    return self._size
+  def _get_length(self):
+    return len(self._parsers)
+  def _set_size(self, value):
+    self._lock.acquire()
+    try:
+      self._size= value
+      del self._parsers[value:]
+    finally:
+      self._lock.release()
+
+  def getParameter(self, name):
+    return self._config.getParameter(name)
+
+  def acquire(self):
+    """ Borrow an idle parser, or a new one if there are none.
+    """
+    self._lock.acquire()
+    try:
+      if len(self._parsers)>0:
+        return self._parsers.pop()
+    finally:
+      self._lock.release()
+    return LSParser(ParserConfiguration(self._config))
+
+  def release(self, parser):
+    """ Give back a borrowed parser. One that is still busy, or has been given
+        a filter, listeners or different parameters, is dropped instead.
+    """
+    if (
+      parser._get_busy() or parser._async or parser._filter is not None
+      or filter(None, parser._listeners.values())
+      or parser._domConfig._parameters!=self._config._parameters
+    ):
+      return
+    self._lock.acquire()
+    try:
+      if len(self._parsers)<self._size:
+        self._parsers.append(parser)
+    finally:
+      self._lock.release()
+
+  def parse(self, input):
+    """ Parse a document from an LSInput with a borrowed parser.
+    """
+    parser= self.acquire()
+    try:
+      return parser.parse(input)
+    finally:
+      self.release(parser)
+
+  def parseURI(self, uri):
+    """ Parse a document from a URI with a borrowed parser.
+    """
+    parser= self.acquire()
+    try:
+      return parser.parseURI(uri)
+    finally:
+      self.release(parser)
+
+
 # Convenience parsing functions. The default parameters for these functions
 # are slightly different than those of a standard LSParser, to emulate the
 # minidom functions of the same name. Other DOMConfiguration parameters may be
-# passed in an optional mapping.
+# passed in an optional mapping; calls without any share the parsers of a
+# ParserPool. Each call, like every parse, keeps its state and count of
+# errors apart, so they can be made from any number of threads at once.
 #
-def parse(fileorpath, parameters= {}):
-  """ Get a Document object from a file.
-  """
+_CONVENIENCE_PARAMETERS= {
+  'cdata-sections': True, 'pxdom-resolve-resources': False
+}
+_convenienceParsers= ParserPool(_CONVENIENCE_PARAMETERS)
+
+def _convenienceParse(src, parameters):
+  if len(parameters)==0:
+    return _convenienceParsers.parse(src)
   parser= LSParser()
-  parser.domConfig.setParameter('cdata-sections', True)
-  parser.domConfig.setParameter('pxdom-resolve-resources', False)
-  for (key, value) in parameters.items():
+  for (key, value) in _CONVENIENCE_PARAMETERS.items()+parameters.items():
     parser.domConfig.setParameter(key, value)
+  return parser.parse(src)
+
+def _fileInput(fileorpath):
   src= _implementation.createLSInput()
   if hasattr(fileorpath, 'read'):
     src.byteStream= fileorpath
@@ -4763,20 +7168,301 @@ def parse(fileorpath, parameters= {}):
     if url[:2]!='//':
       url= '//'+url
     src.systemId= 'file:'+url
-  doc= parser.parse(src)
-  return doc
+  return src
+
+def parse(fileorpath, parameters= {}):
+  """ Get a Document object from a file.
+  """
+  return _convenienceParse(_fileInput(fileorpath), parameters)
 
 def parseString(content, parameters= {}):
   """ Get a Document object from a string.
   """
-  parser= LSParser()
-  parser.domConfig.setParameter('cdata-sections', True)
-  parser.domConfig.setParameter('pxdom-resolve-resources', False)
-  for (key, value) in parameters.items():
-    parser.domConfig.setParameter(key, value)
   src= _implementation.createLSInput()
   src.stringData= content
-  return parser.parse(src)
+  return _convenienceParse(src, parameters)
+
+def iterparse(fileorpath, parameters= {}):
+  """ Get an iterator of (event, node) pairs from a file, with the Document
+      being built as its document property.
+  """
+  parser= LSParser()
+  for (key, value) in _CONVENIENCE_PARAMETERS.items()+parameters.items():
+    parser.domConfig.setParameter(key, value)
+  return parser.pxdomEvents(_fileInput(fileorpath))
+
+
+# Batch parsing. The parser is CPU-bound, so parseMany spreads the documents
+# over a pool of worker processes where multiprocessing is available. Workers
+# keep a ParserPool, made from the parameters when they start, and send back
+# either the document in a packed form or what the reduce function made of
+# it; exceptions are sent back in place of results, one input at a time.
+#
+def parseMany(inputs, workers= None, parameters= {}, ordered= True,
+  reduce= None
+):
+  """ Parse a sequence or iterable of documents, each a file, pathname or
+      LSInput, over a number of worker processes (by default, one per CPU).
+      The inputs are all taken from it at the start. Return an iterator
+      of (index, result, error) for each input, in the order of the inputs or,
+      if not ordered, in the order they are finished. The result is the
+      Document, or what reduce returned when given it in the worker; if either
+      raised an exception it is the error, and the result is None.
+  """
+  parameters= dictadd(_CONVENIENCE_PARAMETERS, parameters)
+  inputs= list(inputs)
+  jobs= map(None, range(len(inputs)), inputs)
+  if workers is None:
+    workers= _cpuCount()
+  if multiprocessing is None or workers<=1:
+    return _ManyReader(None, jobs, ParserPool(parameters), reduce)
+  pool= multiprocessing.Pool(workers, _startWorker, (parameters, reduce))
+  jobs= map(lambda job: (job[0], _portableInput(job[1])), jobs)
+  if ordered:
+    results= pool.imap(_parseJob, jobs)
+  else:
+    results= pool.imap_unordered(_parseJob, jobs)
+  return _ManyReader(pool, results, None, reduce)
+
+def _cpuCount():
+  try:
+    return multiprocessing.cpu_count()
+  except (AttributeError, NotImplementedError):
+    return 1
+
+def _portableInput(item):
+  """ Get an input ready to send to a worker process, by reading any stream it
+      has into a picklable one.
+  """
+  if hasattr(item, 'read'):
+    return StringIO.StringIO(item.read())
+  if isinstance(item, LSInput) and (
+    item.characterStream is not None or item.byteStream is not None
+  ):
+    item= copy.copy(item)
+    if item.characterStream is not None:
+      item.characterStream= StringIO.StringIO(item.characterStream.read())
+    if item.byteStream is not None:
+      item.byteStream= StringIO.StringIO(item.byteStream.read())
+  return item
+
+def _parseOne(parsers, reduce, item):
+  """ Parse one input of a batch, giving the (result, error) pair.
+  """
+  if not isinstance(item, LSInput):
+    item= _fileInput(item)
+  try:
+    document= parsers.parse(item)
+    if reduce is None:
+      return document, None
+    return reduce(document), None
+  except Exception, error:
+    return None, error
+
+_workerParsers= _workerReduce= None
+
+def _startWorker(parameters, reduce):
+  global _workerParsers, _workerReduce
+  _workerParsers= ParserPool(parameters, 1)
+  _workerReduce= reduce
+
+def _parseJob(job):
+  """ Parse one input in a worker process. Results and errors are pickled here
+      as nodes in them may refer to the NONS singleton.
+  """
+  index, item= job
+  result, error= _parseOne(_workerParsers, _workerReduce, item)
+  if error is None:
+    try:
+      if _workerReduce is None:
+        result= _packDocument(result)
+      return index, _dumps(result), None
+    except Exception, error:
+      pass
+  try:
+    return index, None, _dumps(error)
+  except Exception:
+    return index, None, _dumps(RuntimeError(
+      '%s: %s' % (error.__class__.__name__, str(error))
+    ))
+
+class _ManyReader:
+  """ Iterator over the (index, result, error) triples of parseMany, either
+      parsing each input as it is asked for, or reading the results of a pool
+      of worker processes.
+  """
+  def __init__(self, pool, results, parsers, reduce):
+    self._pool= pool
+    self._results= results
+    self._parsers= parsers
+    self._reduce= reduce
+    self._index= 0
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    if self._pool is None:
+      if self._index>=len(self._results):
+        raise StopIteration
+      index, item= self._results[self._index]
+      self._results[self._index]= None
+      self._index= self._index+1
+      result, error= _parseOne(self._parsers, self._reduce, item)
+      return index, result, error
+    try:
+      index, result, error= self._results.next()
+    except StopIteration:
+      self._pool.close()
+      self._pool.join()
+      raise
+    if error is not None:
+      return index, None, _loads(error)
+    result= _loads(result)
+    if self._reduce is None:
+      result= _unpackDocument(result)
+    return index, result, None
+
+  def __getitem__(self, index):
+    try:
+      return self.next()
+    except StopIteration:
+      raise IndexError(index)
+
+  def close(self):
+    """ Stop any workers still parsing, and give no more results.
+    """
+    if self._pool is not None:
+      self._pool.terminate()
+      self._pool.join()
+    self._results= []
+    self._pool= None
+
+
+# Packed documents, for sending back from worker processes. Pickling a whole
+# document would be slow, and would recurse along the sibling links of every
+# list of children. Instead the nodes are packed in document order into a
+# flat list for marshal, each a tuple of plain values: the index of its
+# class, the values of its own slots, its attributes packed the same way, and
+# its number of children. The declarations of a doctype are pickled into a
+# read-only doctype of their own, packed in place of its attributes, which
+# the unpacked doctype shares until they are read.
+#
+_PACKED_CLASSES= [
+  Document, DocumentType, Element, Attr, Text, CDATASection, Comment,
+  ProcessingInstruction, EntityReference
+]
+_PACKED_SKIP= (
+  '_ownerDocument', '_containerNode', '_children', '_childNodes',
+  '_previousSibling', '_nextSibling', '_userData', '_attributes', '__weakref__',
+  '_domConfig', '_userdatacalls', '_tagIndex', '_ids', '_idValues',
+  '_mutations', '_mutationLog', '_entities', '_notations', '_elements',
+  '_attlists', '_shared', '_table'
+)
+_PACKED_NONS= 0
+_packedSlots= {}
+
+def _getPackedSlots(cls):
+  """ Get the names of the slots of a node class that are packed.
+  """
+  names= _packedSlots.get(cls)
+  if names is None:
+    names= []
+    for base in cls.__mro__:
+      for name in base.__dict__.get('__slots__', ()):
+        if name not in _PACKED_SKIP:
+          names.append(name)
+    _packedSlots[cls]= names
+  return names
+
+def _packDocument(document):
+  return marshal.dumps(_packTree(document))
+
+def _unpackDocument(data):
+  return _unpackTree(marshal.loads(data), None, None)
+
+def _packTree(node):
+  """ Pack a node and its descendants into a list, in document order.
+  """
+  packed= []
+  stack= [node]
+  while len(stack)>0:
+    node= stack.pop()
+    packed.append(_packNode(node))
+    children= list(node._children)
+    children.reverse()
+    stack.extend(children)
+  return packed
+
+def _packNode(node):
+  cls= node.__class__
+  names= _getPackedSlots(cls)
+  values= map(lambda name, node= node: getattr(node, name), names)
+  if node._namespaceURI is NONS:
+    values[names.index('_namespaceURI')]= _PACKED_NONS
+  if node.nodeType==Node.DOCUMENT_TYPE_NODE:
+    record= DocumentType(None, node.nodeName)
+    record._merge(node)
+    if node._shared is not None:
+      record._merge(node._shared)
+    record._recurse(True, readonly= True)
+    attributes= _dumps(record)
+  elif node._attributes is None:
+    attributes= None
+  else:
+    attributes= map(_packTree, node._attributes._list)
+  return (
+    _PACKED_CLASSES.index(cls), tuple(values), attributes, len(node._children)
+  )
+
+def _unpackTree(packed, document, parent):
+  """ Rebuild the first node in a packed list, and its descendants after it.
+      The stack holds the nodes still waiting for children, and how many.
+  """
+  root= None
+  stack= []
+  for item in packed:
+    if len(stack)>0:
+      parent= stack[-1][0]
+    node= _unpackNode(item, document, parent)
+    if root is None:
+      root= node
+      if document is None:
+        document= node
+    else:
+      parent._children.append(node)
+      stack[-1][1]= stack[-1][1]-1
+    if item[3]>0:
+      node._children= []
+      stack.append([node, item[3]])
+    while len(stack)>0 and stack[-1][1]==0:
+      node= stack.pop()[0]
+      _linkSiblings(node._children, 0, len(node._children)-1)
+  return root
+
+def _unpackNode(item, document, parent):
+  index, values, attributes, count= item
+  cls= _PACKED_CLASSES[index]
+  node= cls()
+  if document is None:
+    document= node
+  node._ownerDocument= document
+  node._containerNode= parent
+  for name, value in map(None, _getPackedSlots(cls), values):
+    setattr(node, name, value)
+  if node._namespaceURI==_PACKED_NONS:
+    node._namespaceURI= NONS
+  if node.nodeType==Node.DOCUMENT_TYPE_NODE:
+    node._share(_loads(attributes))
+    for nodes in (
+      node._entities, node._notations, node._elements, node._attlists
+    ):
+      nodes._readonly= node._readonly
+  elif attributes is not None:
+    for packedAttr in attributes:
+      node._attributes._append(_unpackTree(packedAttr, document, node))
+    node._attributes._readonly= node._readonly
+  return node
 
 
 # DOM 3 LS Save features
@@ -5126,19 +7812,33 @@ class LSSerializer(DOMObject):
 
 def _Node___writeTo(self, dest, config, filter, newLine, namespaces):
   """ Markup production, for various node types. The default node behaviour is
-      just to recurse to all children.
+      just to recurse to all children. Whether whitespace-only text children
+      are element content whitespace to leave out is worked out once for all
+      of them.
   """
-  for child in self._childNodes:
-    child._writeTo(dest, config, filter, newLine, namespaces)
+  dropWhite= None
+  for child in self._children:
+    if child.nodeType in (Node.TEXT_NODE, Node.CDATA_SECTION_NODE):
+      if dropWhite is None:
+        dropWhite= (
+          not config._snapshot().element_content_whitespace
+          and self._isElementContent(config)
+        )
+      child._writeTo(dest, config, filter, newLine, namespaces,
+        dropWhite= dropWhite
+      )
+    else:
+      child._writeTo(dest, config, filter, newLine, namespaces)
 
 
 def _Document___writeTo(self,dest,config,filter,newLine,namespaces):
-  if config.getParameter('canonical-form') and self._xmlVersion=='1.1':
+  cfg= config._snapshot()
+  if cfg.canonical_form and self._xmlVersion=='1.1':
     config._handleError(CanonicalXmlErr(self))
 
   # Output XML preamble
   #
-  if config.getParameter('xml-declaration'):
+  if cfg.xml_declaration:
     dest.write('<?xml version="')
     dest.write(self._xmlVersion or '1.0', _Complainer(config, self))
     if dest.encoding is not None:
@@ -5153,12 +7853,13 @@ def _Document___writeTo(self,dest,config,filter,newLine,namespaces):
   # Put a single newline between each document-level child, as there are no
   # whitespace nodes
   #
-  for child in self._childNodes:
+  for child in self._children:
     child._writeTo(dest, config, filter, newLine, namespaces)
     dest.setSeparator(newLine)
 
 
 def _Element___writeTo(self, dest, config, filter, newLine, namespaces):
+  cfg= config._snapshot()
   accepted= _acceptNode(filter, self)
   if accepted==NodeFilter.FILTER_SKIP:
     NamedNodeNS._writeTo(self, dest, config, filter, newLine, namespaces)
@@ -5172,7 +7873,7 @@ def _Element___writeTo(self, dest, config, filter, newLine, namespaces):
   attrs= self._attributes._list[:]
   newspaces= namespaces.copy()
   reprefix= []
-  if config.getParameter('namespaces'):
+  if cfg.namespaces:
     for attr in attrs:
       if attr.namespaceURI==NSNS:
         prefix= [attr.localName, None][attr.prefix is None]
@@ -5194,7 +7895,7 @@ def _Element___writeTo(self, dest, config, filter, newLine, namespaces):
 
   # If outputting canonically, put the attribute list in order.
   #
-  if config.getParameter('canonical-form'):
+  if cfg.canonical_form:
     attrs.sort(_canonicalAttrSort)
 
   # Write beginning of start-tag.
@@ -5217,29 +7918,29 @@ def _Element___writeTo(self, dest, config, filter, newLine, namespaces):
     dest.setSeparator(' ')
   dest.setSeparator(None)
 
-  if config.getParameter('canonical-form'):
+  if cfg.canonical_form:
     empty= False
   else:
-    empty= self._childNodes.length==0
-    if config.getParameter('pxdom-html-compatible'):
+    empty= len(self._children)==0
+    if cfg.pxdom_html_compatible:
       empty= empty and (
         self.namespaceURI in (HTNS, None) and self.localName in HTMLEMPTY
       )
 
   if empty:
-    if config.getParameter('pxdom-html-compatible'):
+    if cfg.pxdom_html_compatible:
       dest.write(' ')
     dest.write('/>')
   else:
     dest.write('>')
-    if self._childNodes.length!=0:
+    if len(self._children)!=0:
 
       # Write children, reformatting them in pretty-print mode
       #
-      if not config.getParameter('format-pretty-print') or (
-        self._childNodes.length==1 and
-        self._childNodes[0].nodeType==Node.TEXT_NODE and
-        '\n' not in self._childNodes[0].data
+      if not cfg.format_pretty_print or (
+        len(self._children)==1 and
+        self._children[0].nodeType==Node.TEXT_NODE and
+        '\n' not in self._children[0].data
       ):
         NamedNodeNS._writeTo(
           self, dest, config, filter, newLine, newspaces
@@ -5259,19 +7960,21 @@ def _Element___writeTo(self, dest, config, filter, newLine, namespaces):
 def _Attr___writeTo(
   self, dest, config, filter, newLine, namespaces, prefix= NONS
 ):
+  cfg= config._snapshot()
+
   # Apply LSSerializerFiltering to non-namespace-declaring attributes only
   #
-  isNsDecl= self.namespaceURI==NSNS and config.getParameter('namespaces')
-  if (isNsDecl and not config.getParameter('namespace-declarations')):
+  isNsDecl= self.namespaceURI==NSNS and cfg.namespaces
+  if (isNsDecl and not cfg.namespace_declarations):
     return
   if not isNsDecl and _acceptNode(filter, self)!=NodeFilter.FILTER_ACCEPT:
     return
 
   # Possibly discard default and redundant attributes depending on config
   #
-  if not self._specified and config.getParameter('discard-default-content'):
+  if not self._specified and cfg.discard_default_content:
     return
-  if self.namespaceURI==NSNS and config.getParameter('canonical-form'):
+  if self.namespaceURI==NSNS and cfg.canonical_form:
     p= [self.localName, None][self.prefix is None]
     value= None
     if self._containerNode is not None:
@@ -5293,7 +7996,7 @@ def _Attr___writeTo(
   # no entrefs
   #
   dest.write('="')
-  if config.getParameter('canonical-form'):
+  if cfg.canonical_form:
     s= r(r(r(r(r(r(self.value, '&', '&amp;'), '<','&lt;'),'"','&quot;'),
       '\x0D','&#xD;'),'\n','&#xA'),'\t','&#x9;')
     if isinstance(s, Unicode):
@@ -5304,20 +8007,21 @@ def _Attr___writeTo(
   # children.
   #
   else:
-    for child in self._childNodes:
+    for child in self._children:
       child._writeTo(dest, config, None,'&#10;', namespaces, attr=True)
   dest.write('"')
 
 
 def _Comment___writeTo(self,dest,config,filter,newLine,namespaces):
-  if (not config.getParameter('comments') or
+  cfg= config._snapshot()
+  if (not cfg.comments or
     _acceptNode(filter, self)!=NodeFilter.FILTER_ACCEPT
   ):
     return
   if self.data[-1:]=='-' or string.find(self.data, '--')!=-1:
     config._handleError(WfInvalidCharacterErr(self))
   dest.write('<!--')
-  pretty= config.getParameter('format-pretty-print')
+  pretty= cfg.format_pretty_print
   if pretty and '\n' in string.strip(self.data):
     for line in string.split(self.data, '\n'):
       line= string.strip(line)
@@ -5330,16 +8034,17 @@ def _Comment___writeTo(self,dest,config,filter,newLine,namespaces):
   dest.write('-->')
 
 def _Text___writeTo(
-  self, dest, config, filter, newLine, namespaces, attr= False
+  self, dest, config, filter, newLine, namespaces, attr= False,
+  dropWhite= None
 ):
-  if (
-    not config.getParameter('element-content-whitespace')
-    and self._get_isElementContentWhitespace(config)
-  ) or _acceptNode(filter, self)!=NodeFilter.FILTER_ACCEPT:
+  cfg= config._snapshot()
+  if _isDroppedWhite(self, config, dropWhite) or (
+    _acceptNode(filter, self)!=NodeFilter.FILTER_ACCEPT
+  ):
     return
 
   m= r(r(config._cnorm(self.data, self), '&', '&amp;'), '<', '&lt;')
-  if config.getParameter('canonical-form'): # attr always false here
+  if cfg.canonical_form: # attr always false here
     dest.write(r(r(r(m, '>', '&gt;'), '\r', '&#xD;'), '\n', newLine),
       _Charreffer(True)
     )
@@ -5349,21 +8054,39 @@ def _Text___writeTo(
     m= r(r(m, ']]>', ']]&gt;'), '\r', '&#13;')
     if isinstance(m, Unicode):
       m= r(r(m, unichr(0x85), '&#133;'), unichr(0x2028), '&#8232;')
-    if config.getParameter('format-pretty-print'):
+    if cfg.format_pretty_print:
       m= string.join(map(string.strip, string.split(m, '\n')), newLine)
     else:
       m= r(m, '\n', newLine)
     dest.write(m, _Charreffer())
 
+def _isDroppedWhite(text, config, dropWhite):
+  """ Check whether a Text or CDATASection is element content whitespace to be
+      left out of the output. dropWhite says whether whitespace in its parent
+      is to be left out, if the parent's writeTo has already worked it out.
+  """
+  data= text._data
+  if WHITES[isinstance(data, Unicode)].match(data).end()<len(data):
+    return False
+  if dropWhite is None:
+    parentNode= text.parentNode
+    dropWhite= (
+      not config._snapshot().element_content_whitespace
+      and parentNode is not None and parentNode._isElementContent(config)
+    )
+  return dropWhite
+
 def _CDATASection___writeTo(
-  self, dest, config, filter, newLine, namespaces
+  self, dest, config, filter, newLine, namespaces, dropWhite= None
 ):
-  if not config.getParameter('cdata-sections'):
-    return Text._writeTo(self,dest,config,filter,newLine,namespaces)
-  if (
-    not config.getParameter('element-content-whitespace')
-    and self.isElementContentWhitespace(config)
-  ) or _acceptNode(filter, self)!=NodeFilter.FILTER_ACCEPT:
+  cfg= config._snapshot()
+  if not cfg.cdata_sections:
+    return Text._writeTo(self, dest, config, filter, newLine, namespaces,
+      dropWhite= dropWhite
+    )
+  if _isDroppedWhite(self, config, dropWhite) or (
+    _acceptNode(filter, self)!=NodeFilter.FILTER_ACCEPT
+  ):
     return
 
   m= config._cnorm(self.data, self)
@@ -5398,15 +8121,17 @@ def _ProcessingInstruction___writeTo(
 def _EntityReference___writeTo(self,
   dest, config, filter, newLine, namespaces, attr= False
 ):
+  cfg= config._snapshot()
+
   # If entities parameter is false, skip all bound available entity references
   # otherwise pass to filter as normal
   #
   doctype= self._ownerDocument.doctype
   entity= None
   if doctype is not None:
-    entity= doctype.entities.getNamedItem(self.nodeName)
+    entity= doctype._lookup('_entities', self.nodeName)
   accepted= NodeFilter.FILTER_ACCEPT
-  if not config.getParameter('entities'):
+  if not cfg.entities:
       if entity is not None and entity.pxdomAvailable:
         accepted= NodeFilter.FILTER_SKIP
   if accepted==NodeFilter.FILTER_ACCEPT:
@@ -5420,7 +8145,7 @@ def _EntityReference___writeTo(self,
     dest.write(';')
 
   elif accepted==NodeFilter.FILTER_SKIP:
-    for child in entity._childNodes:
+    for child in entity._children:
       if attr:
         if child.nodeType not in Attr._childTypes:
           config._handleError(InvalidEntityForAttrErr(self))
@@ -5496,6 +8221,17 @@ class DOMException(Exception):
   def __repr__(self):
     return self.message
 
+  # Exceptions sent back from parseMany's worker processes keep their class,
+  # text and location, but not the data they relate to, which may not pickle.
+  #
+  def __reduce__(self):
+    location= self.location
+    if location is not None:
+      location= DOMLocator(None,
+        location.lineNumber, location.columnNumber, location.uri
+      )
+    return _copyException, (self.__class__, str(self), location)
+
   def _get_code(self):
     return self.code
   def _get_relatedData(self):
@@ -5512,6 +8248,16 @@ class DOMException(Exception):
       return False
 
 
+def _copyException(cls, message, location):
+  error= cls.__new__(cls)
+  error.message= message
+  error.location= location
+  error.relatedException= error
+  if cls is ParseErr:
+    error.buffer= None
+  return error
+
+
 # Traditional DOMExceptions
 #
 class IndexSizeErr(DOMException):
@@ -5585,6 +8331,12 @@ class InuseAttributeErr(DOMException):
     DOMException.__init__(self)
     self.message= 'attr %s in use' % repr(attr.name)
 
+class InvalidStateErr(DOMException):
+  code= DOMException.INVALID_STATE_ERR
+  def __init__(self, obj, name):
+    DOMException.__init__(self)
+    self.message= '%s.%s while busy' % (obj.__class__.__name__, name)
+
 
 # Serious parsing problems
 #
@@ -5595,6 +8347,14 @@ class IOErrorErr(DOMException):
     DOMException.__init__(self)
     self.message= 'pxdom could not read resource: '+str(e)
 
+class ParseStoppedErr(DOMException):
+  code= DOMException.PARSE_ERR
+  type= 'pxdom-parse-stopped'
+  def __init__(self, e):
+    DOMException.__init__(self)
+    self.message= 'pxdom parsing stopped by %s: %s' % (e.__class__.__name__, e)
+    self.relatedException= e
+
 class ParseErr(DOMException):
   code= DOMException.PARSE_ERR
   type= 'pxdom-parse-error'
@@ -5605,6 +8365,8 @@ class ParseErr(DOMException):
     line, column= buffer.getLocation()
     self.location= DOMLocator(None, line, column, buffer.uri)
   def __str__(self):
+    if self.buffer is None:
+      return self.message
     LEE= 30
     ch= self.buffer.chars
     ix= self.buffer.index